@@ -0,0 +1,217 @@
+"""Análisis de páginas y agrupamiento automático (propuesta para el sorter).
+
+Para cada página se extraen rasgos baratos con PyMuPDF: el texto (como
+vector de palabras con hashing), un hash perceptual (dHash) de una imagen
+chica, la tinta (para detectar hojas en blanco/separadoras), el tamaño y la
+rotación. Con NumPy se comparan páginas consecutivas para cortar el documento
+en tramos, y los tramos parecidos entre sí se juntan en un mismo grupo.
+
+El análisis corre como trabajo de la cola (`jobs.py`, tipo 'analyze'); la
+extracción va por bloques al pool de procesos de renderizado (con
+`run_background`, sin desplazar a las peticiones del usuario). El progreso y la
+propuesta se consultan en `/jobs/<id>`, y la propuesta se acepta desde el
+sorter con `/batch-ops`.
+"""
+import os
+import re
+import zlib
+from collections import Counter
+
+import numpy as np
+import fitz  # PyMuPDF
+
+from render_pool import render_engine
+from sorted_store import normalize_pdf_name
+
+# Páginas por bloque enviado al pool de procesos
+ANALYSIS_CHUNK_PAGES = 25
+
+# Dimensión del vector de palabras (hashing)
+TEXT_DIM = 256
+
+# Ancho en píxeles de la imagen usada para el dHash y la tinta
+HASH_IMAGE_WIDTH = 64
+
+# Fracción de píxeles con tinta por debajo de la cual la página (sin texto) está en blanco
+BLANK_INK = 0.003
+
+# Un píxel tiene tinta si es al menos esto más oscuro que el papel (la mediana)
+INK_CONTRAST = 30
+
+# Similitud mínima entre páginas consecutivas para seguir en el mismo tramo
+SPLIT_SIMILARITY = 0.55
+
+# Similitud mínima entre tramos para juntarlos en un mismo grupo
+MERGE_TEXT_SIMILARITY = 0.85
+MERGE_HASH_DISTANCE = 8
+
+# Palabras de 4 o más letras (las que cuentan para el texto y los nombres)
+_WORD_RE = re.compile(r"[^\W\d_]{4,}", re.UNICODE)
+
+
+# ---------- Lado del proceso de renderizado ----------
+
+def gray_image(page, width):
+    """Página rasterizada en grises al ancho dado, como matriz alto x ancho."""
+    zoom = width / page.rect.width
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+
+
+def _dhash(gray):
+    """dHash de 64 bits de una imagen en grises (matriz alto x ancho)."""
+    h, w = gray.shape
+    rows = np.linspace(0, h, 9, dtype=int)
+    cols = np.linspace(0, w, 10, dtype=int)
+    small = np.add.reduceat(np.add.reduceat(gray.astype(np.float32), rows[:-1], axis=0),
+                            cols[:-1], axis=1)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def ink_ratio(gray):
+    """Fracción de píxeles con tinta (más oscuros que el papel)."""
+    return float((gray < np.median(gray) - INK_CONTRAST).mean())
+
+
+def extract_features(doc, first, last):
+    """Rasgos de las páginas first..last (corre en el pool de procesos)."""
+    features = []
+    for page_num in range(first, min(last, len(doc)) + 1):
+        page = doc[page_num - 1]
+
+        words = _WORD_RE.findall(page.get_text().lower())
+        vector = np.zeros(TEXT_DIM, dtype=np.float32)
+        if words:
+            buckets = [zlib.crc32(w.encode('utf-8')) % TEXT_DIM for w in words]
+            vector = np.bincount(buckets, minlength=TEXT_DIM).astype(np.float32)
+
+        gray = gray_image(page, HASH_IMAGE_WIDTH)
+
+        features.append({
+            'page': page_num,
+            'text': vector,
+            'keywords': [w for w, _ in Counter(words).most_common(3)],
+            'dhash': _dhash(gray),
+            'ink': ink_ratio(gray),
+            'size': (round(page.rect.width), round(page.rect.height)),
+            'rotation': page.rotation,
+        })
+    return features
+
+
+# ---------- Agrupamiento ----------
+
+def _popcount64(values):
+    """Cantidad de bits en 1 de cada entero de 64 bits de un array."""
+    return np.unpackbits(values.astype('>u8').view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+def propose_groups(features, existing_names=()):
+    """Agrupa páginas a partir de sus rasgos.
+
+    Devuelve {'groups': [{'name', 'pages'}], 'blank': [páginas en blanco]}.
+    """
+    if not features:
+        return {'groups': [], 'blank': []}
+
+    pages = np.array([f['page'] for f in features])
+    text = _normalize_rows(np.stack([f['text'] for f in features]))
+    has_text = np.linalg.norm(text, axis=1) > 0
+    hashes = np.array([f['dhash'] for f in features], dtype=np.uint64)
+    # Poca tinta no alcanza: una hoja con una sola línea de texto no está en blanco
+    blank = (np.array([f['ink'] for f in features]) < BLANK_INK) & ~has_text
+    layout = np.array([(*f['size'], f['rotation']) for f in features])
+
+    # Similitud de cada página con la anterior (visual y, si hay, de texto)
+    visual = 1 - _popcount64(hashes[1:] ^ hashes[:-1]) / 32
+    textual = (text[1:] * text[:-1]).sum(axis=1)
+    both_text = has_text[1:] & has_text[:-1]
+    similarity = np.where(both_text, 0.5 * np.clip(visual, 0, 1) + 0.5 * textual, np.clip(visual, 0, 1))
+
+    # Cortar donde baja la similitud, cambia el tamaño/rotación o hay una hoja en blanco
+    cut = ((similarity < SPLIT_SIMILARITY)
+           | (layout[1:] != layout[:-1]).any(axis=1)
+           | blank[1:] | blank[:-1])
+    segment_ids = np.concatenate([[0], np.cumsum(cut)])
+
+    segments = []
+    for seg in range(segment_ids[-1] + 1):
+        members = np.flatnonzero((segment_ids == seg) & ~blank)
+        if len(members):
+            segments.append(members)
+
+    # Juntar tramos parecidos (mismo tipo de documento) en un grupo
+    centroids = _normalize_rows(np.stack([text[m].sum(axis=0) for m in segments])) \
+        if segments else np.zeros((0, TEXT_DIM), dtype=np.float32)
+    first_hashes = np.array([hashes[m[0]] for m in segments], dtype=np.uint64)
+    seg_has_text = np.linalg.norm(centroids, axis=1) > 0
+    group_of = [-1] * len(segments)
+    groups = []
+    for i in range(len(segments)):
+        if group_of[i] != -1:
+            continue
+        group_of[i] = len(groups)
+        groups.append([i])
+        rest = np.arange(i + 1, len(segments))
+        if not len(rest):
+            continue
+        text_sim = centroids[rest] @ centroids[i]
+        hash_dist = _popcount64(first_hashes[rest] ^ first_hashes[i])
+        # Solo por dHash si ninguno de los dos tramos tiene texto (escaneos)
+        hash_only = ~seg_has_text[rest] & ~seg_has_text[i]
+        similar = (text_sim >= MERGE_TEXT_SIMILARITY) | (hash_only & (hash_dist <= MERGE_HASH_DISTANCE))
+        for j in rest[similar]:
+            if group_of[j] == -1:
+                group_of[j] = group_of[i]
+                groups[-1].append(j)
+
+    used = {n.lower() for n in existing_names}
+    proposal = []
+    for index, members in enumerate(groups, start=1):
+        group_pages = sorted(int(pages[p]) for seg in members for p in segments[seg])
+        name = _group_name(features, segments[members[0]][0], index, used)
+        proposal.append({'name': name, 'pages': group_pages})
+
+    return {'groups': proposal, 'blank': [int(p) for p in pages[blank]]}
+
+
+def _group_name(features, first_index, index, used):
+    """Nombre sugerido para un grupo: palabra clave de su primera página."""
+    keywords = features[first_index]['keywords']
+    base = keywords[0].capitalize() if keywords else f"Grupo {index}"
+    name = base
+    counter = 2
+    while normalize_pdf_name(name).lower() in used:
+        name = f"{base} {counter}"
+        counter += 1
+    used.add(normalize_pdf_name(name).lower())
+    return name
+
+
+# ---------- Trabajo en segundo plano ----------
+
+def analyze_job(job):
+    """Trabajo 'analyze': extrae los rasgos por bloques y propone los grupos.
+
+    Parámetros: {'filename', 'pages', 'existing'} (nombres ya usados en la
+    carpeta sorted). El resultado es el de `propose_groups`.
+    """
+    filename = job.params['filename']
+    total = job.params['pages']
+    path = os.path.join(job.user_folder, filename)
+
+    features = []
+    job.progress(0, total)
+    for first in range(1, total + 1, ANALYSIS_CHUNK_PAGES):
+        last = min(first + ANALYSIS_CHUNK_PAGES - 1, total)
+        features.extend(render_engine.run_background(extract_features, path, first, last,
+                                                     check=job.check_cancelled))
+        job.progress(last)
+
+    return propose_groups(features, job.params.get('existing', ()))
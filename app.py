@@ -1,15 +1,40 @@
 import os
 import re
+import json
 import uuid
 import time
+import shutil
 import threading
-import zipfile
-import tempfile
-from datetime import datetime, timedelta
-from flask import Flask, render_template, send_file, jsonify, request, abort, session
+from flask import Flask, render_template, send_file, jsonify, request, abort, session, url_for, g
 from werkzeug.utils import secure_filename
-import fitz  # PyMuPDF
+from werkzeug.exceptions import HTTPException
 from io import BytesIO
+import metrics
+from render_cache import RenderCache, render_key, prune_session_cache, file_hash
+from doc_pool import document_pool
+from prefetch import PrefetchQueue
+from render_pool import render_engine, RenderBusy
+from zipstream import zip_response
+from analysis import analyze_job
+from jobs import JobQueue, JobError, read_job, list_jobs, is_finished
+from page_render import (render_page, parse_options, preview_options, pick_format, describe,
+                         DEFAULT_OPTIONS, MIMETYPES as PAGE_MIMETYPES)
+from thumbnails import (render_thumbnail, render_sheet, normalize_width, choose_format,
+                        WEBP_AVAILABLE, MIMETYPES, THUMB_SHEET_BLOCK, THUMB_SHEET_MAX_PAGES)
+from uploads import (create_upload, get_upload, write_chunk, finish_upload, discard_upload,
+                     validate_pdf, cleanup_stale_uploads, UploadError, UPLOAD_CHUNK_SIZE)
+from sorted_store import (apply_operations, normalize_pdf_name, export_outputs, exported_outputs,
+                          compact_folder, pending_compaction, split_outputs, SortedOpError,
+                          ExportPending)
+from split import parse_split_request
+from storage import session_store, remove_lock, temp_path
+from cleanup import (touch_session, run_cleanup, session_usage, index_stats, CLEANUP_INTERVAL,
+                     CLEANUP_CHECK_INTERVAL, SESSION_QUOTA_BYTES)
+from session_index import (list_pdfs, pdf_info, record_pdf, forget_pdf, content_hash,
+                           sorted_outputs, identical_pdfs)
+from search_index import (register_file, forget_file, indexing_state, index_job,
+                          search as search_text, SEARCH_MAX_RESULTS)
+from duplicates import fingerprint_job, load_fingerprints, find_duplicates, page_content
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
@@ -18,11 +43,7 @@ app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-producti
 app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', '104857600'))  # 100MB por defecto
 
 # Carpeta base donde se almacenan las sesiones
-BASE_PDF_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdfs')
-
-# Configuración de sesiones
-SESSION_LIFETIME = 3 * 24 * 60 * 60  # 3 días en segundos
-CLEANUP_INTERVAL = 60 * 60  # Limpiar cada hora
+BASE_PDF_FOLDER = os.environ.get('PDF_FOLDER') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdfs')
 
 # Caracteres prohibidos en nombres de archivo
 FORBIDDEN_CHARS = r'[<>:"/\\|?*\x00-\x1f]'
@@ -30,6 +51,11 @@ FORBIDDEN_CHARS = r'[<>:"/\\|?*\x00-\x1f]'
 # Extensiones permitidas para upload
 ALLOWED_EXTENSIONS = {'.pdf'}
 
+# Eventos de progreso de trabajos (SSE): intervalo de consulta, keepalive y duración máxima
+JOB_EVENTS_INTERVAL = 0.5
+JOB_EVENTS_KEEPALIVE = 15
+JOB_EVENTS_MAX_SECONDS = 300
+
 
 def get_session_id():
     """Obtiene o crea un ID de sesión único para el usuario."""
@@ -37,8 +63,9 @@ def get_session_id():
         session['session_id'] = str(uuid.uuid4())
         session['created_at'] = time.time()
     
-    # Actualizar último acceso
+    # Actualizar último acceso (en la cookie y en el índice de sesiones para la limpieza)
     session['last_access'] = time.time()
+    touch_session(BASE_PDF_FOLDER, session['session_id'])
     return session['session_id']
 
 
@@ -51,41 +78,125 @@ def get_user_pdf_folder():
     if not os.path.exists(user_folder):
         os.makedirs(user_folder)
     
+    # Con almacenamiento remoto, traer lo que otra réplica haya cambiado
+    session_store.pull(session_id, user_folder)
     return user_folder
 
 
-def cleanup_old_sessions():
-    """Limpia sesiones inactivas más antiguas que SESSION_LIFETIME."""
+def sync_session(user_folder, relpath=''):
+    """Sube al almacenamiento de sesiones lo que cambió bajo `relpath` (nada en modo local)."""
+    session_store.push(os.path.basename(user_folder), user_folder, relpath)
+
+
+def maintain_session(session_path):
+    """Mantenimiento de una sesión activa (lo llama el barrido de limpieza)."""
+    # Mantener la caché de renderizado dentro de su presupuesto
+    prune_session_cache(session_path)
+    cleanup_stale_uploads(session_path)
+    # Borrar trabajos viejos y retomar los que quedaron a medias
+    job_queue.cleanup(session_path)
+
+
+def cleanup_old_sessions(force=False):
+    """Limpia sesiones inactivas y aplica las cuotas (solo en el worker líder)."""
     try:
-        if not os.path.exists(BASE_PDF_FOLDER):
-            return
-        
-        current_time = time.time()
-        for session_dir in os.listdir(BASE_PDF_FOLDER):
-            session_path = os.path.join(BASE_PDF_FOLDER, session_dir)
-            
-            if os.path.isdir(session_path):
-                # Verificar si la carpeta es muy antigua
-                dir_mtime = os.path.getmtime(session_path)
-                if current_time - dir_mtime > SESSION_LIFETIME:
-                    import shutil
-                    shutil.rmtree(session_path)
-                    print(f"Sesión limpiada: {session_dir}")
+        result = run_cleanup(BASE_PDF_FOLDER, maintain_session, force=force)
+        if result is not None and any(result.values()):
+            print(f"Limpieza: {result}")
+        return result
     except Exception as e:
         print(f"Error en cleanup: {e}")
 
 
+_cleanup_started = False
+_cleanup_started_lock = threading.Lock()
+
+
 def start_cleanup_thread():
-    """Inicia el hilo de limpieza automática."""
+    """Inicia el hilo de limpieza automática (una vez por proceso).
+
+    Todos los workers lo inician (ver gunicorn.conf.py), pero solo el líder
+    barre, como mucho una vez cada CLEANUP_INTERVAL.
+    """
+    global _cleanup_started
+    with _cleanup_started_lock:
+        if _cleanup_started:
+            return
+        _cleanup_started = True
+    
     def cleanup_worker():
         while True:
             cleanup_old_sessions()
-            time.sleep(CLEANUP_INTERVAL)
+            time.sleep(CLEANUP_CHECK_INTERVAL)
     
     cleanup_thread = threading.Thread(target=cleanup_worker, daemon=True)
     cleanup_thread.start()
 
 
+def quota_exceeded(user_folder, extra_bytes):
+    """Indica si agregar `extra_bytes` superaría el espacio de la sesión (sin contar cachés)."""
+    if not SESSION_QUOTA_BYTES:
+        return False
+    usage = session_usage(user_folder)
+    return usage['total'] - usage['cache'] + (extra_bytes or 0) > SESSION_QUOTA_BYTES
+
+
+@app.before_request
+def start_request_metrics():
+    """Marca el inicio de la petición y, si se pidió, empieza a perfilarla."""
+    g.request_start = time.perf_counter()
+    g.profile = metrics.start_profile(metrics.profile_requested(request.args, request.headers))
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Registra la duración y los bytes de la petición (por ruta, no por URL)."""
+    start = g.pop('request_start', None)
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile_file = metrics.finish_profile(profile, BASE_PDF_FOLDER,
+                                              f"{request.method} {request.path}", elapsed)
+        if profile_file:
+            response.headers['X-Profile'] = profile_file
+    
+    metrics.observe('pdfsorter_http_request_duration_seconds', elapsed,
+                    route=route, method=request.method, status=response.status_code)
+    if response.content_length:
+        metrics.inc('pdfsorter_http_response_bytes_total', response.content_length, route=route)
+    metrics.flush(BASE_PDF_FOLDER)
+    return response
+
+
+@app.teardown_request
+def discard_request_profile(exc):
+    """Libera el perfil si la petición falló sin pasar por `record_request_metrics`."""
+    profile = g.pop('profile', None)
+    if profile is not None:
+        metrics.discard_profile(profile)
+
+
+def worker_metrics():
+    """Contadores del pool de documentos y del motor de renderizado de este worker."""
+    pool = document_pool.stats()
+    render = render_engine.stats()
+    return [
+        ('pdfsorter_doc_pool_documents', {}, pool['size']),
+        ('pdfsorter_doc_pool_requests_total', {'result': 'hit'}, pool['hits']),
+        ('pdfsorter_doc_pool_requests_total', {'result': 'miss'}, pool['misses']),
+        ('pdfsorter_doc_pool_evictions_total', {}, pool['evictions']),
+        ('pdfsorter_render_queue_depth', {}, render['queue_depth']),
+        ('pdfsorter_render_rejected_total', {}, render['rejected']),
+    ]
+
+
+metrics.register_collector(worker_metrics)
+
+
 def get_sorted_folder_name(pdf_name):
     """Genera el nombre de la carpeta sorted para un PDF dado."""
     base_name = os.path.splitext(pdf_name)[0]
@@ -98,6 +209,29 @@ def get_sorted_folder_path(pdf_name):
     return os.path.join(user_folder, get_sorted_folder_name(pdf_name))
 
 
+def unique_pdf_path(user_folder, filename):
+    """Sanitiza el nombre de un PDF subido y le agrega un número si ya existe.
+
+    Devuelve (nombre, ruta completa).
+    """
+    filename = secure_filename(filename)
+    if not filename:
+        filename = 'uploaded.pdf'
+    
+    filepath = os.path.join(user_folder, filename)
+    
+    # Si ya existe, agregar número
+    if os.path.exists(filepath):
+        base, ext = os.path.splitext(filename)
+        counter = 1
+        while os.path.exists(filepath):
+            filename = f"{base}_{counter}{ext}"
+            filepath = os.path.join(user_folder, filename)
+            counter += 1
+    
+    return filename, filepath
+
+
 def sanitize_filename(name):
     """Limpia el nombre de archivo de caracteres prohibidos."""
     return re.sub(FORBIDDEN_CHARS, '', name).strip()
@@ -123,25 +257,10 @@ def is_valid_filename(name):
 @app.route('/')
 def index():
     """Página principal con la tabla de PDFs."""
-    pdfs = []
     user_folder = get_user_pdf_folder()
     
-    if os.path.exists(user_folder):
-        for filename in os.listdir(user_folder):
-            if filename.lower().endswith('.pdf'):
-                filepath = os.path.join(user_folder, filename)
-                try:
-                    doc = fitz.open(filepath)
-                    page_count = len(doc)
-                    doc.close()
-                    pdfs.append({
-                        'name': filename,
-                        'pages': page_count
-                    })
-                except Exception as e:
-                    print(f"Error al abrir {filename}: {e}")
-    
-    pdfs.sort(key=lambda x: x['name'].lower())
+    # Nombre, páginas y tamaño salen del índice de la sesión (sin abrir los PDFs)
+    pdfs = list_pdfs(user_folder)
     return render_template('index.html', pdfs=pdfs, session_id=get_session_id())
 
 
@@ -157,7 +276,14 @@ def open_pdf(filename):
 
 @app.route('/download/<filename>')
 def download_pdf(filename):
-    """Descarga el PDF original junto con su carpeta sorted en un ZIP."""
+    """Descarga el PDF original junto con su carpeta sorted en un ZIP.
+
+    El ZIP se genera al vuelo mientras se envía (sin archivo temporal), con
+    Content-Length conocido y soporte de Range para reanudar descargas. Si
+    los PDFs clasificados todavía no están preparados (compactar o construir
+    desde el manifest) no se hace acá: se encola el trabajo 'export' y se
+    responde 202 con su estado, para reintentar cuando termine.
+    """
     user_folder = get_user_pdf_folder()
     pdf_path = os.path.join(user_folder, filename)
     sorted_folder = get_sorted_folder_path(filename)
@@ -165,49 +291,25 @@ def download_pdf(filename):
     if not os.path.exists(pdf_path):
         abort(404)
     
-    # Crear archivo ZIP temporal
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
     zip_filename = f"{os.path.splitext(filename)[0]}_completo.zip"
     
     try:
-        with zipfile.ZipFile(temp_file.name, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            # Agregar PDF original
-            zipf.write(pdf_path, filename)
+        # PDF original + PDFs clasificados (ya compactados o construidos desde el manifest)
+        with exported_outputs(sorted_folder) as outputs:
+            files = [(filename, pdf_path)]
+            for name, file_path in outputs:
+                # Crear ruta relativa dentro del ZIP
+                arcname = os.path.join(get_sorted_folder_name(filename), name)
+                files.append((arcname, file_path))
             
-            # Agregar carpeta sorted si existe
-            if os.path.exists(sorted_folder):
-                for root, dirs, files in os.walk(sorted_folder):
-                    for file in files:
-                        if file.lower().endswith('.pdf'):
-                            file_path = os.path.join(root, file)
-                            # Crear ruta relativa dentro del ZIP
-                            arcname = os.path.join(get_sorted_folder_name(filename), file)
-                            zipf.write(file_path, arcname)
-        
-        # Enviar archivo y programar eliminación
-        def remove_temp_file():
-            try:
-                os.unlink(temp_file.name)
-            except:
-                pass
-        
-        # Programar eliminación del archivo temporal en 5 minutos
-        timer = threading.Timer(300.0, remove_temp_file)
-        timer.start()
-        
-        return send_file(
-            temp_file.name,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name=zip_filename
-        )
-        
+            return zip_response(files, zip_filename, request, app.response_class)
+    except ExportPending:
+        state = job_queue.submit(user_folder, 'export', {'filename': filename},
+                                 key=f"export:{filename}")
+        response = job_response(state, 202)
+        response.headers['Retry-After'] = '1'
+        return response
     except Exception as e:
-        # Limpiar archivo temporal si hay error
-        try:
-            os.unlink(temp_file.name)
-        except:
-            pass
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
@@ -228,25 +330,118 @@ def upload_pdf():
         return jsonify({'success': False, 'error': 'Solo se permiten archivos PDF'}), 400
     
     # Sanitizar nombre de archivo
-    filename = secure_filename(file.filename)
-    if not filename:
-        filename = 'uploaded.pdf'
+    user_folder = get_user_pdf_folder()
+    if quota_exceeded(user_folder, request.content_length):
+        return jsonify({'success': False, 'error': 'Se superó el espacio máximo de la sesión'}), 413
+    filename, filepath = unique_pdf_path(user_folder, file.filename)
+    
+    try:
+        file.save(filepath)
+        metrics.inc('pdfsorter_bytes_written_total', os.path.getsize(filepath), kind='upload')
+        document_pool.invalidate(filepath)
+        
+        # Verificar que sea un PDF legible
+        try:
+            page_count = validate_pdf(filepath)
+        except UploadError as e:
+            os.remove(filepath)
+            return jsonify({'success': False, 'error': e.message}), e.status
+        
+        duplicate_of = register_upload(user_folder, filename, page_count)
+        return jsonify({'success': True, 'filename': filename, 'pages': page_count,
+                        'duplicate_of': duplicate_of})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/uploads', methods=['POST'])
+def start_chunked_upload():
+    """Inicia una subida por partes (reanudable) para PDFs grandes."""
+    data = request.get_json() or {}
+    original_name = data.get('filename', '')
+    size = data.get('size')
+    
+    if not original_name:
+        return jsonify({'success': False, 'error': 'No se seleccionó ningún archivo'}), 400
+    
+    # Verificar extensión
+    ext = os.path.splitext(original_name)[1].lower()
+    if ext not in ALLOWED_EXTENSIONS:
+        return jsonify({'success': False, 'error': 'Solo se permiten archivos PDF'}), 400
     
     user_folder = get_user_pdf_folder()
-    filepath = os.path.join(user_folder, filename)
+    if isinstance(size, int) and quota_exceeded(user_folder, size):
+        return jsonify({'success': False, 'error': 'Se superó el espacio máximo de la sesión'}), 413
     
-    # Si ya existe, agregar número
-    if os.path.exists(filepath):
-        base, ext = os.path.splitext(filename)
-        counter = 1
-        while os.path.exists(filepath):
-            filename = f"{base}_{counter}{ext}"
-            filepath = os.path.join(user_folder, filename)
-            counter += 1
+    try:
+        upload_id = create_upload(user_folder, original_name, size)
+    except UploadError as e:
+        return jsonify({'success': False, 'error': e.message}), e.status
+    
+    response = jsonify({
+        'success': True,
+        'upload_id': upload_id,
+        'offset': 0,
+        'chunk_size': min(UPLOAD_CHUNK_SIZE, app.config['MAX_CONTENT_LENGTH'])
+    })
+    response.status_code = 201
+    response.headers['Location'] = url_for('chunked_upload', upload_id=upload_id)
+    return response
+
+
+@app.route('/uploads/<upload_id>', methods=['HEAD', 'PATCH', 'DELETE'])
+def chunked_upload(upload_id):
+    """Consulta (HEAD), continúa (PATCH) o cancela (DELETE) una subida por partes.
+
+    PATCH recibe la parte en el cuerpo y el offset en la cabecera Upload-Offset.
+    Cuando llega el último byte, valida el PDF y devuelve su nombre y páginas.
+    """
+    user_folder = get_user_pdf_folder()
     
     try:
-        file.save(filepath)
-        return jsonify({'success': True, 'filename': filename})
+        if request.method == 'DELETE':
+            get_upload(user_folder, upload_id)
+            discard_upload(user_folder, upload_id)
+            return jsonify({'success': True})
+        
+        meta, offset = get_upload(user_folder, upload_id)
+        
+        if request.method == 'HEAD':
+            response = app.response_class(status=200)
+            response.headers['Upload-Offset'] = str(offset)
+            response.headers['Upload-Length'] = str(meta['size'])
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+        
+        client_offset = request.headers.get('Upload-Offset', type=int)
+        if client_offset is None:
+            return jsonify({'success': False, 'error': 'Falta la cabecera Upload-Offset'}), 400
+        
+        offset = write_chunk(user_folder, upload_id, client_offset, request.stream)
+        
+        if offset < meta['size']:
+            response = jsonify({'success': True, 'offset': offset, 'complete': False})
+            response.headers['Upload-Offset'] = str(offset)
+            return response
+        
+        # Subida completa: validar y mover a la carpeta del usuario
+        filename, filepath = unique_pdf_path(user_folder, meta['filename'])
+        page_count = finish_upload(user_folder, upload_id, filepath)
+        document_pool.invalidate(filepath)
+        duplicate_of = register_upload(user_folder, filename, page_count)
+        
+        response = jsonify({
+            'success': True,
+            'offset': offset,
+            'complete': True,
+            'filename': filename,
+            'pages': page_count,
+            'duplicate_of': duplicate_of
+        })
+        response.headers['Upload-Offset'] = str(offset)
+        return response
+    except UploadError as e:
+        return jsonify({'success': False, 'error': e.message}), e.status
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -266,62 +461,388 @@ def delete_pdf(filename):
     try:
         # Eliminar PDF
         os.remove(filepath)
+        document_pool.invalidate(filepath)
+        forget_pdf(user_folder, filename)
+        forget_file(user_folder, filename)
+        sync_session(user_folder, filename)
         
         # Eliminar carpeta sorted si se solicita
         if delete_sorted:
             sorted_folder = get_sorted_folder_path(filename)
             if os.path.exists(sorted_folder):
-                import shutil
                 shutil.rmtree(sorted_folder)
+                document_pool.invalidate_prefix(sorted_folder)
+                remove_lock(sorted_folder)
+                sync_session(user_folder, get_sorted_folder_name(filename))
         
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+def page_identity(user_folder, filename, page_num):
+    """(hash, página, alias) de una página en la caché de renderizado.
+
+    Las claves (y los ETags) son siempre por hash del PDF y número de página.
+    Con las huellas de páginas calculadas (`duplicates.py`) el alias es el
+    hash del contenido de la página: las páginas idénticas, en este PDF o en
+    otro de la sesión, se enlazan al mismo archivo de la caché sin volver a
+    renderizarse. Sin huellas, el alias es None.
+    """
+    content = content_hash(user_folder, filename)
+    page = page_content(user_folder, content, page_num)
+    return content, page_num, (f"page:{page}" if page is not None else None)
+
+
+def alias_key(alias, variant, fmt):
+    """Clave de caché de una imagen por el contenido de la página, o None sin alias."""
+    return render_key(alias, 0, variant, fmt) if alias is not None else None
+
+
+def cache_lookup(cache, key, fmt, alias=None):
+    """Bytes de `key` en la caché; si faltan, los enlaza desde `alias` (misma página)."""
+    data = cache.get(key, fmt)
+    if alias is None:
+        return data
+    if data is None:
+        return cache.link(alias, key, fmt)
+    # Renderizada antes de tener las huellas: publicarla para las páginas idénticas
+    if not cache.contains(alias, fmt):
+        cache.link(key, alias, fmt)
+    return data
+
+
+def cache_store(cache, key, fmt, data, alias=None):
+    """Guarda una imagen en la caché y la enlaza también bajo `alias`."""
+    cache.put(key, fmt, data)
+    if alias is not None:
+        cache.link(key, alias, fmt)
+
+
+def page_class_key(content, page_num):
+    """Clave de caché de la clase de una página (color, escaneada)."""
+    return render_key(content, page_num, 'class', 'json')
+
+
+def cached_page_class(cache, content, page_num, alias=None):
+    """Clase de una página guardada en la caché, o None si nunca se renderizó."""
+    class_data = cache_lookup(cache, page_class_key(content, page_num), 'json',
+                              alias_key(alias, 'class', 'json'))
+    return json.loads(class_data) if class_data is not None else None
+
+
+def page_image_key(content, page_num, page_class, options):
+    """Devuelve (clave, formato, opciones) de la imagen de una página."""
+    fmt = pick_format(page_class, options)
+    render_options = describe(options, page_class, fmt)
+    return render_key(content, page_num, render_options, fmt), fmt, render_options
+
+
+def page_cache_key(user_folder, filename, page_num, options):
+    """Como `page_image_key`, o None si todavía no se conoce la clase de la página."""
+    content, page_num, alias = page_identity(user_folder, filename, page_num)
+    page_class = cached_page_class(RenderCache(user_folder), content, page_num, alias)
+    if page_class is None:
+        return None
+    return page_image_key(content, page_num, page_class, options)
+
+
+def render_page_image(user_folder, filename, page_num, options, background=False):
+    """Devuelve (clave, formato, opciones, bytes) de una página, usando la caché.
+
+    Devuelve None si la página no existe en el documento. El render en sí
+    corre en el pool de procesos (`render_engine`), que puede lanzar
+    RenderBusy si su cola está llena.
+    """
+    content, page_num, alias = page_identity(user_folder, filename, page_num)
+    cache = RenderCache(user_folder)
+    page_class = cached_page_class(cache, content, page_num, alias)
+    
+    if page_class is not None:
+        key, fmt, render_options = page_image_key(content, page_num, page_class, options)
+        img_data = cache_lookup(cache, key, fmt, alias_key(alias, render_options, fmt))
+        if img_data is not None:
+            return key, fmt, render_options, img_data
+    
+    # La primera vez el proceso de renderizado también clasifica la página
+    result = render_engine.run(render_page, os.path.join(user_folder, filename),
+                               page_num, options, page_class, background=background)
+    if result is None:
+        return None
+    
+    if page_class is None:
+        cache_store(cache, page_class_key(content, page_num), 'json',
+                    json.dumps(result['class']).encode('utf-8'), alias_key(alias, 'class', 'json'))
+    key = render_key(content, page_num, result['options'], result['format'])
+    cache_store(cache, key, result['format'], result['data'],
+                alias_key(alias, result['options'], result['format']))
+    return key, result['format'], result['options'], result['data']
+
+
+def warm_page(user_folder, filename, page_num, options=None):
+    """Renderiza una página en la caché si todavía no está (para el pre-renderizado).
+
+    Con opciones de tamaño completo también calienta la vista previa, que es
+    lo primero que pide el visor al avanzar.
+    """
+    filepath = os.path.join(user_folder, filename)
+    if not os.path.exists(filepath):
+        return
+    options = options or DEFAULT_OPTIONS
+    variants = [options] if options.preview else [preview_options(options.webp), options]
+    for variant in variants:
+        known = page_cache_key(user_folder, filename, page_num, variant)
+        if known is not None and RenderCache(user_folder).contains(known[0], known[1]):
+            continue
+        try:
+            render_page_image(user_folder, filename, page_num, variant, background=True)
+        except RenderBusy:
+            # El pool está ocupado con peticiones del usuario: no insistir
+            return
+
+
+# Cola de pre-renderizado de las páginas siguientes al cursor del sorter
+prefetch_queue = PrefetchQueue(warm_page)
+
+
 @app.route('/page/<filename>/<int:page_num>')
 def get_page(filename, page_num):
-    """Renderiza una página específica del PDF como imagen PNG."""
+    """Renderiza una página específica del PDF como imagen (con caché en disco).
+
+    Acepta `?w=` (ancho en píxeles) o `?dpi=`, `?q=` (calidad JPEG/WebP) y
+    `?preview=1` (imagen chica y rápida). El formato se elige según la página
+    y la cabecera Accept; la cabecera X-Render-Options describe lo elegido.
+    Con `?prefetch=1` (lo usa el visor del sorter) además encola el
+    pre-renderizado de las páginas siguientes con las mismas opciones (y
+    sus vistas previas).
+    """
     user_folder = get_user_pdf_folder()
     filepath = os.path.join(user_folder, filename)
     if not os.path.exists(filepath):
         abort(404)
     
     try:
-        doc = fitz.open(filepath)
-        if page_num < 1 or page_num > len(doc):
-            doc.close()
-            abort(404)
+        options = parse_options(request.args, request.accept_mimetypes)
+        last_modified = os.path.getmtime(filepath)
         
-        page = doc[page_num - 1]  # PyMuPDF usa índices base 0
+        if request.args.get('prefetch'):
+            prefetch_queue.schedule(user_folder, filename, page_num,
+                                    pdf_info(user_folder, filename)['pages'], options)
         
-        # Renderizar a mayor resolución para mejor calidad
-        zoom = 2.0
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat)
+        # El navegador ya tiene esta versión: responder 304 sin renderizar
+        known = page_cache_key(user_folder, filename, page_num, options)
+        if known is not None and known[0] in request.if_none_match:
+            response = app.response_class(status=304)
+            response.set_etag(known[0])
+            response.last_modified = last_modified
+            response.headers['X-Render-Options'] = known[2]
+            response.vary.add('Accept')
+            return response
         
-        img_bytes = BytesIO(pix.tobytes("png"))
-        doc.close()
+        rendered = render_page_image(user_folder, filename, page_num, options)
+        if rendered is None:
+            abort(404)
+        key, fmt, render_options, img_data = rendered
         
-        return send_file(img_bytes, mimetype='image/png')
+        response = send_file(
+            BytesIO(img_data),
+            mimetype=PAGE_MIMETYPES[fmt],
+            etag=key,
+            last_modified=last_modified,
+            conditional=True
+        )
+        response.cache_control.private = True
+        response.headers['X-Render-Options'] = render_options
+        response.vary.add('Accept')
+        return response
+    except HTTPException:
+        raise
+    except RenderBusy:
+        return render_busy_response()
     except Exception as e:
         print(f"Error al renderizar página: {e}")
         abort(500)
 
 
+def render_busy_response():
+    """Respuesta 503 cuando la cola de renderizado está llena."""
+    response = jsonify({'error': 'Servidor ocupado, reintentar en unos segundos'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '2'
+    return response
+
+
+def render_thumbnail_image(user_folder, filename, page_num, width, fmt):
+    """Devuelve (clave, bytes) de una miniatura, usando la caché de renderizado."""
+    content, page_num, alias = page_identity(user_folder, filename, page_num)
+    key = render_key(content, page_num, f"thumb{width}", fmt)
+    alias = alias_key(alias, f"thumb{width}", fmt)
+    cache = RenderCache(user_folder)
+    img_data = cache_lookup(cache, key, fmt, alias)
+    
+    if img_data is None:
+        img_data = render_engine.run(render_thumbnail, os.path.join(user_folder, filename),
+                                     page_num, width, fmt)
+        if img_data is None:
+            return key, None
+        cache_store(cache, key, fmt, img_data, alias)
+    
+    return key, img_data
+
+
+def render_thumb_sheet(user_folder, filename, first, last, width, fmt, with_image=True):
+    """Devuelve (clave, bytes, layout) de una hoja de miniaturas, usando la caché.
+
+    El layout no depende del formato, así que se guarda aparte: con
+    `with_image=False` alcanza con tenerlo en caché para no renderizar.
+    """
+    content = content_hash(user_folder, filename)
+    pages = f"{first}-{last}"
+    key = render_key(content, pages, f"sheet{width}", fmt)
+    layout_key = render_key(content, pages, f"sheet{width}", 'layout')
+    cache = RenderCache(user_folder)
+    
+    layout_data = cache.get(layout_key, 'json')
+    img_data = cache.get(key, fmt) if with_image else None
+    if layout_data is not None and (img_data is not None or not with_image):
+        return key, img_data, json.loads(layout_data)
+    
+    result = render_engine.run(render_sheet, os.path.join(user_folder, filename),
+                               first, last, width, fmt)
+    if result is None:
+        return key, None, None
+    img_data, layout = result
+    cache.put(key, fmt, img_data)
+    cache.put(layout_key, 'json', json.dumps(layout).encode('utf-8'))
+    return key, img_data, layout
+
+
+def thumb_response(key, img_data, fmt, last_modified):
+    """Respuesta de una imagen de miniaturas (ETag, Vary: Accept)."""
+    response = send_file(
+        BytesIO(img_data),
+        mimetype=MIMETYPES[fmt],
+        etag=key,
+        last_modified=last_modified,
+        conditional=True
+    )
+    response.cache_control.private = True
+    response.vary.add('Accept')
+    return response
+
+
+def thumb_sheet_range(user_folder, filename):
+    """Lee from/to/w de la petición y devuelve (primera, última, ancho) ya acotados."""
+    total_pages = pdf_info(user_folder, filename)['pages']
+    first = request.args.get('from', 1, type=int)
+    last = request.args.get('to', first + THUMB_SHEET_BLOCK - 1, type=int)
+    last = min(last, total_pages, first + THUMB_SHEET_MAX_PAGES - 1)
+    if first < 1 or first > last:
+        abort(400)
+    return first, last, normalize_width(request.args.get('w', type=int))
+
+
+@app.route('/thumb/<filename>/<int:page_num>')
+def get_thumb(filename, page_num):
+    """Miniatura de una página (`?w=` ancho en píxeles), rasterizada a ese tamaño."""
+    user_folder = get_user_pdf_folder()
+    filepath = os.path.join(user_folder, filename)
+    if not os.path.exists(filepath):
+        abort(404)
+    
+    width = normalize_width(request.args.get('w', type=int))
+    fmt = choose_format(request.accept_mimetypes)
+    
+    try:
+        key, img_data = render_thumbnail_image(user_folder, filename, page_num, width, fmt)
+        if img_data is None:
+            abort(404)
+        return thumb_response(key, img_data, fmt, os.path.getmtime(filepath))
+    except HTTPException:
+        raise
+    except RenderBusy:
+        return render_busy_response()
+    except Exception as e:
+        print(f"Error al renderizar miniatura: {e}")
+        abort(500)
+
+
+@app.route('/thumbs/<filename>')
+def get_thumb_sheet(filename):
+    """Mapa JSON de una hoja de miniaturas (`?from=&to=&w=`): URL de la imagen y
+    posición [x, y, ancho, alto] de cada página dentro de ella."""
+    user_folder = get_user_pdf_folder()
+    if not os.path.exists(os.path.join(user_folder, filename)):
+        abort(404)
+    
+    try:
+        first, last, width = thumb_sheet_range(user_folder, filename)
+        fmt = 'webp' if WEBP_AVAILABLE else 'jpeg'
+        _, _, layout = render_thumb_sheet(user_folder, filename, first, last, width, fmt,
+                                          with_image=False)
+        if layout is None:
+            abort(404)
+        
+        params = {'from': first, 'to': last, 'w': width}
+        return jsonify({
+            'image': url_for('get_thumb_sheet_image', filename=filename, **params),
+            'from': first,
+            'to': last,
+            'width': layout['width'],
+            'height': layout['height'],
+            'tiles': layout['tiles']
+        })
+    except HTTPException:
+        raise
+    except RenderBusy:
+        return render_busy_response()
+    except Exception as e:
+        print(f"Error al renderizar hoja de miniaturas: {e}")
+        abort(500)
+
+
+@app.route('/thumbs/<filename>/sheet')
+def get_thumb_sheet_image(filename):
+    """Imagen de una hoja de miniaturas (`?from=&to=&w=`)."""
+    user_folder = get_user_pdf_folder()
+    filepath = os.path.join(user_folder, filename)
+    if not os.path.exists(filepath):
+        abort(404)
+    
+    try:
+        first, last, width = thumb_sheet_range(user_folder, filename)
+        fmt = choose_format(request.accept_mimetypes)
+        key, img_data, _ = render_thumb_sheet(user_folder, filename, first, last, width, fmt)
+        if img_data is None:
+            abort(404)
+        return thumb_response(key, img_data, fmt, os.path.getmtime(filepath))
+    except HTTPException:
+        raise
+    except RenderBusy:
+        return render_busy_response()
+    except Exception as e:
+        print(f"Error al renderizar hoja de miniaturas: {e}")
+        abort(500)
+
+
+@app.route('/prefetch/<filename>/cancel', methods=['POST'])
+def cancel_prefetch(filename):
+    """Cancela el pre-renderizado pendiente de un PDF (el usuario salió del sorter)."""
+    user_folder = get_user_pdf_folder()
+    prefetch_queue.cancel(user_folder, filename)
+    return jsonify({'success': True})
+
+
 @app.route('/page-count/<filename>')
 def get_page_count(filename):
     """Obtiene el número total de páginas de un PDF."""
     user_folder = get_user_pdf_folder()
-    filepath = os.path.join(user_folder, filename)
-    if not os.path.exists(filepath):
-        return jsonify({'error': 'PDF no encontrado'}), 404
     
     try:
-        doc = fitz.open(filepath)
-        count = len(doc)
-        doc.close()
-        return jsonify({'pages': count})
+        info = pdf_info(user_folder, filename)
+        if info is None:
+            return jsonify({'error': 'PDF no encontrado'}), 404
+        return jsonify({'pages': info['pages']})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -337,9 +858,7 @@ def sorter(filename):
     start_page = request.args.get('start', 1, type=int)
     
     try:
-        doc = fitz.open(filepath)
-        total_pages = len(doc)
-        doc.close()
+        total_pages = pdf_info(user_folder, filename)['pages']
     except Exception as e:
         abort(500)
     
@@ -353,14 +872,7 @@ def sorter(filename):
 def list_sorted(filename):
     """Lista los PDFs en la carpeta sorted correspondiente."""
     sorted_folder = get_sorted_folder_path(filename)
-    
-    pdfs = []
-    if os.path.exists(sorted_folder):
-        for f in os.listdir(sorted_folder):
-            if f.lower().endswith('.pdf'):
-                pdfs.append(f)
-    
-    pdfs.sort()
+    pdfs = sorted_outputs(get_user_pdf_folder(), filename, sorted_folder)
     return jsonify({'pdfs': pdfs, 'folder': get_sorted_folder_name(filename)})
 
 
@@ -376,13 +888,11 @@ def check_name(filename):
         return jsonify({'valid': False, 'error': error_msg})
     
     # Agregar extensión si no la tiene
-    if not name.lower().endswith('.pdf'):
-        name = name + '.pdf'
+    name = normalize_pdf_name(name)
     
     sorted_folder = get_sorted_folder_path(filename)
-    pdf_path = os.path.join(sorted_folder, name)
     
-    if os.path.exists(pdf_path):
+    if name in sorted_outputs(get_user_pdf_folder(), filename, sorted_folder):
         return jsonify({'valid': False, 'error': 'Ya existe un PDF con este nombre'})
     
     return jsonify({'valid': True, 'name': name})
@@ -401,33 +911,17 @@ def create_pdf(filename):
         return jsonify({'success': False, 'error': error_msg}), 400
     
     # Agregar extensión si no la tiene
-    if not new_name.lower().endswith('.pdf'):
-        new_name = new_name + '.pdf'
+    new_name = normalize_pdf_name(new_name)
     
     user_folder = get_user_pdf_folder()
     source_path = os.path.join(user_folder, filename)
     sorted_folder = get_sorted_folder_path(filename)
-    
-    # Crear carpeta sorted si no existe
-    if not os.path.exists(sorted_folder):
-        os.makedirs(sorted_folder)
-    
     new_pdf_path = os.path.join(sorted_folder, new_name)
     
-    # Verificar si ya existe
-    if os.path.exists(new_pdf_path):
-        return jsonify({'success': False, 'error': 'Ya existe un PDF con este nombre'}), 400
-    
     try:
-        # Abrir PDF fuente y extraer página
-        source_doc = fitz.open(source_path)
-        new_doc = fitz.open()
-        
-        new_doc.insert_pdf(source_doc, from_page=page_num-1, to_page=page_num-1)
-        new_doc.save(new_pdf_path)
-        
-        source_doc.close()
-        new_doc.close()
+        apply_operations(source_path, sorted_folder,
+                         [{'op': 'create', 'page': page_num, 'name': new_name}])
+        sorted_folder_changed(user_folder, filename, sorted_folder)
         
         return jsonify({
             'success': True, 
@@ -435,6 +929,8 @@ def create_pdf(filename):
             'name': new_name,
             'folder': get_sorted_folder_name(filename)
         })
+    except SortedOpError as e:
+        return jsonify({'success': False, 'error': e.message}), e.status
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -449,45 +945,20 @@ def append_to_pdf(filename):
     user_folder = get_user_pdf_folder()
     source_path = os.path.join(user_folder, filename)
     sorted_folder = get_sorted_folder_path(filename)
-    target_path = os.path.join(sorted_folder, target_pdf)
-    
-    if not os.path.exists(target_path):
-        return jsonify({'success': False, 'error': 'PDF destino no encontrado'}), 404
     
     try:
-        # Abrir ambos PDFs
-        source_doc = fitz.open(source_path)
-        target_doc = fitz.open(target_path)
-        
-        # Agregar página al final
-        target_doc.insert_pdf(source_doc, from_page=page_num-1, to_page=page_num-1)
-        
-        new_page_count = len(target_doc)
-        
-        # Cerrar documentos antes de guardar
-        source_doc.close()
-        
-        # Guardar en archivo temporal primero
-        temp_path = target_path + '.tmp'
-        target_doc.save(temp_path)
-        target_doc.close()
-        
-        # Reemplazar el archivo original
-        os.replace(temp_path, target_path)
+        results = apply_operations(source_path, sorted_folder,
+                                   [{'op': 'append', 'page': page_num, 'target': target_pdf}])
+        sorted_folder_changed(user_folder, filename, sorted_folder)
         
         return jsonify({
             'success': True,
             'target': target_pdf,
-            'new_page_count': new_page_count
+            'new_page_count': results[0]['page_count']
         })
+    except SortedOpError as e:
+        return jsonify({'success': False, 'error': e.message}), e.status
     except Exception as e:
-        # Limpiar archivo temporal si existe
-        temp_path = target_path + '.tmp'
-        if os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except:
-                pass
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
@@ -497,32 +968,464 @@ def remove_page(filename):
     data = request.get_json()
     target_pdf = data.get('target')
     
+    user_folder = get_user_pdf_folder()
+    source_path = os.path.join(user_folder, filename)
+    sorted_folder = get_sorted_folder_path(filename)
+    
+    try:
+        apply_operations(source_path, sorted_folder,
+                         [{'op': 'remove', 'target': target_pdf}])
+        sorted_folder_changed(user_folder, filename, sorted_folder)
+        return jsonify({'success': True})
+    except SortedOpError as e:
+        return jsonify({'success': False, 'error': e.message}), e.status
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/batch-ops/<filename>', methods=['POST'])
+def batch_ops(filename):
+    """Aplica un lote ordenado de operaciones create/append/remove de una vez.
+
+    Cada PDF destino se abre y se guarda una sola vez. Si alguna operación
+    falla no se modifica ningún archivo.
+    """
+    data = request.get_json() or {}
+    operations = data.get('operations')
+    
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'success': False, 'error': 'No se enviaron operaciones'}), 400
+    
+    user_folder = get_user_pdf_folder()
+    source_path = os.path.join(user_folder, filename)
+    sorted_folder = get_sorted_folder_path(filename)
+    
+    if not os.path.exists(source_path):
+        return jsonify({'success': False, 'error': 'PDF no encontrado'}), 404
+    
+    # Validar nombres de los PDFs nuevos antes de tocar nada
+    for index, op in enumerate(operations):
+        if isinstance(op, dict) and op.get('op') == 'create':
+            is_valid, error_msg = is_valid_filename(op.get('name', ''))
+            if not is_valid:
+                return jsonify({'success': False, 'error': error_msg, 'index': index}), 400
+    
+    try:
+        results = apply_operations(source_path, sorted_folder, operations)
+        sorted_folder_changed(user_folder, filename, sorted_folder)
+        return jsonify({
+            'success': True,
+            'results': results,
+            'folder': get_sorted_folder_name(filename)
+        })
+    except SortedOpError as e:
+        return jsonify({'success': False, 'error': e.message, 'index': e.index}), e.status
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+# ---------- Trabajos en segundo plano ----------
+
+def export_job(job):
+    """Trabajo 'export': deja listos los PDFs clasificados para descargar el ZIP."""
+    filename = job.params['filename']
+    source_path = os.path.join(job.user_folder, filename)
+    if not os.path.exists(source_path):
+        raise FileNotFoundError('PDF no encontrado')
+    sorted_folder = os.path.join(job.user_folder, get_sorted_folder_name(filename))
+    outputs = export_outputs(source_path, sorted_folder, progress=job.progress)
+    return {'filename': filename, 'files': len(outputs) + 1}
+
+
+def compact_job(job):
+    """Trabajo 'compact': compacta los PDFs clasificados que pasaron los umbrales."""
+    sorted_folder = os.path.join(job.user_folder, get_sorted_folder_name(job.params['filename']))
+    compact_folder(sorted_folder, progress=job.progress, only_needed=True)
+    sync_session(job.user_folder, get_sorted_folder_name(job.params['filename']))
+
+
+def split_job(job):
+    """Trabajo 'split': crea de una vez los PDFs clasificados de un pedido a `/split`."""
+    filename = job.params['filename']
+    source_path = os.path.join(job.user_folder, filename)
+    sorted_folder = os.path.join(job.user_folder, get_sorted_folder_name(filename))
+    results = split_outputs(source_path, sorted_folder, job.params['outputs'],
+                            replace=job.params['replace'], dedupe=job.params['dedupe'],
+                            progress=job.progress, check=job.check_cancelled)
+    sorted_folder_changed(job.user_folder, filename, sorted_folder)
+    return {'results': results, 'folder': get_sorted_folder_name(filename)}
+
+
+job_queue = JobQueue()
+job_queue.register('analyze', analyze_job)
+job_queue.register('export', export_job)
+job_queue.register('compact', compact_job)
+job_queue.register('split', split_job)
+job_queue.register('index', index_job)
+job_queue.register('fingerprint', fingerprint_job)
+
+
+def schedule_compaction(user_folder, filename, sorted_folder):
+    """Encola la compactación de la carpeta sorted si algún PDF la necesita."""
+    if pending_compaction(sorted_folder):
+        job_queue.submit(user_folder, 'compact', {'filename': filename},
+                         key=f"compact:{filename}")
+
+
+def link_duplicate(user_folder, filename):
+    """Si el PDF subido es idéntico a otro de la sesión, lo reemplaza por un hardlink.
+
+    Devuelve (hash, nombre del PDF original o None).
+    """
+    filepath = os.path.join(user_folder, filename)
+    content = file_hash(filepath)
+    originals = identical_pdfs(user_folder, filename, content)
+    if not originals:
+        return content, None
+    
+    temp = temp_path(filepath)
+    try:
+        os.link(os.path.join(user_folder, originals[0]), temp)
+        os.replace(temp, filepath)
+    except OSError as e:
+        print(f"Error al enlazar {filename} con {originals[0]}: {e}")
+        if os.path.exists(temp):
+            os.remove(temp)
+        return content, None
+    document_pool.invalidate(filepath)
+    metrics.inc('pdfsorter_duplicate_uploads_total')
+    metrics.inc('pdfsorter_deduplicated_bytes_total', os.path.getsize(filepath))
+    return content, originals[0]
+
+
+def register_upload(user_folder, filename, page_count):
+    """Registra un PDF recién subido y encola su indexado y sus huellas de páginas.
+
+    Devuelve el nombre del PDF idéntico con el que comparte el archivo, o None.
+    """
+    content, duplicate_of = link_duplicate(user_folder, filename)
+    record_pdf(user_folder, filename, page_count, content)
+    sync_session(user_folder, filename)
+    schedule_indexing(user_folder, filename, content)
+    try:
+        schedule_fingerprints(user_folder, filename, content)
+    except Exception as e:
+        print(f"Error al encolar las huellas de {filename}: {e}")
+    return duplicate_of
+
+
+def schedule_fingerprints(user_folder, filename, content):
+    """Encola el cálculo de las huellas de páginas si el contenido no las tiene."""
+    if load_fingerprints(user_folder, content) is not None:
+        return None
+    return job_queue.submit(user_folder, 'fingerprint',
+                            {'filename': filename, 'hash': content,
+                             'pages': pdf_info(user_folder, filename)['pages']},
+                            key=f"fingerprint:{content}")
+
+
+def schedule_indexing(user_folder, filename, content=None):
+    """Registra un PDF en el índice de búsqueda y encola la extracción de lo que falte."""
+    try:
+        content = content or content_hash(user_folder, filename)
+        pages = pdf_info(user_folder, filename)['pages']
+        if register_file(user_folder, filename, content, pages):
+            job_queue.submit(user_folder, 'index',
+                             {'filename': filename, 'hash': content, 'pages': pages},
+                             key=f"index:{content}")
+    except Exception as e:
+        print(f"Error al indexar {filename}: {e}")
+
+
+def sorted_folder_changed(user_folder, filename, sorted_folder):
+    """Después de escribir en la carpeta sorted: índice, compactación y sincronización."""
+    sorted_outputs(user_folder, filename, sorted_folder, refresh=True)
+    schedule_compaction(user_folder, filename, sorted_folder)
+    sync_session(user_folder, get_sorted_folder_name(filename))
+
+
+def job_response(state, status=200):
+    response = jsonify(state)
+    response.status_code = status
+    response.cache_control.no_store = True
+    return response
+
+
+def request_flag(data, name):
+    """Opción booleana del cuerpo JSON o de la query string (`?name=1`)."""
+    value = data.get(name, request.args.get(name))
+    return value in (True, 1, '1', 'true')
+
+
+@app.route('/split/<filename>', methods=['POST'])
+def split_pdf(filename):
+    """Crea muchos PDFs clasificados de una vez a partir de rangos de páginas.
+
+    Acepta JSON (`{"outputs": {"A": "1-12", "B": "13-40"}}`) o un CSV
+    `nombre,páginas` (cuerpo text/csv o archivo `file`). Opciones (en el JSON
+    o en la query string): `replace` para sobrescribir PDFs existentes,
+    `dedupe` para unir fuentes/imágenes repetidas y `async` para hacerlo como
+    trabajo en segundo plano (responde 202 con el trabajo).
+    """
+    user_folder = get_user_pdf_folder()
+    source_path = os.path.join(user_folder, filename)
     sorted_folder = get_sorted_folder_path(filename)
-    target_path = os.path.join(sorted_folder, target_pdf)
     
-    if not os.path.exists(target_path):
+    info = pdf_info(user_folder, filename)
+    if info is None:
         return jsonify({'success': False, 'error': 'PDF no encontrado'}), 404
     
+    data = request.get_json(silent=True) or {}
+    csv_text = None
+    if 'file' in request.files:
+        csv_text = request.files['file'].read().decode('utf-8-sig', errors='replace')
+    elif request.mimetype == 'text/csv':
+        csv_text = request.get_data(as_text=True)
+    
+    replace = request_flag(data, 'replace')
+    dedupe = request_flag(data, 'dedupe')
+    
     try:
-        doc = fitz.open(target_path)
+        outputs = parse_split_request(data, csv_text, info['pages'])
+        for index, (name, _) in enumerate(outputs):
+            is_valid, error_msg = is_valid_filename(name)
+            if not is_valid:
+                return jsonify({'success': False, 'error': error_msg, 'index': index}), 400
         
-        if len(doc) <= 1:
-            # Si solo tiene 1 página, eliminar el PDF completo
-            doc.close()
-            os.remove(target_path)
-        else:
-            # Remover última página
-            doc.delete_page(-1)
-            temp_path = target_path + '.tmp'
-            doc.save(temp_path)
-            doc.close()
-            os.replace(temp_path, target_path)
+        if request_flag(data, 'async'):
+            state = job_queue.submit(user_folder, 'split', {
+                'filename': filename, 'outputs': outputs, 'replace': replace, 'dedupe': dedupe
+            })
+            return job_response(state, 202)
         
-        return jsonify({'success': True})
+        results = split_outputs(source_path, sorted_folder, outputs,
+                                replace=replace, dedupe=dedupe)
+        sorted_folder_changed(user_folder, filename, sorted_folder)
+        return jsonify({
+            'success': True,
+            'results': results,
+            'folder': get_sorted_folder_name(filename)
+        })
+    except SortedOpError as e:
+        return jsonify({'success': False, 'error': e.message, 'index': e.index}), e.status
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/analyze/<filename>', methods=['POST'])
+def analyze_pdf(filename):
+    """Encola el análisis de páginas (agrupamiento automático) y devuelve el trabajo.
+
+    Si ya hay un análisis en curso o terminado para esta versión del PDF,
+    devuelve ese trabajo sin empezar otro.
+    """
+    user_folder = get_user_pdf_folder()
+    
+    try:
+        info = pdf_info(user_folder, filename)
+        if info is None:
+            return jsonify({'success': False, 'error': 'PDF no encontrado'}), 404
+        
+        existing = sorted_outputs(user_folder, filename, get_sorted_folder_path(filename))
+        state = job_queue.submit(
+            user_folder, 'analyze',
+            {'filename': filename, 'pages': info['pages'], 'existing': existing},
+            key=f"analyze:{filename}:{content_hash(user_folder, filename)}",
+            reuse_done=True,
+        )
+        return job_response(state, 202)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/export/<filename>', methods=['POST'])
+def export_pdf(filename):
+    """Encola la preparación de la descarga (compactar o construir los PDFs clasificados).
+
+    Cuando el trabajo termina, `/download/<filename>` ya no tiene nada que
+    preparar y empieza a enviar el ZIP de inmediato.
+    """
+    user_folder = get_user_pdf_folder()
+    if not os.path.exists(os.path.join(user_folder, filename)):
+        return jsonify({'success': False, 'error': 'PDF no encontrado'}), 404
+    
+    try:
+        state = job_queue.submit(user_folder, 'export', {'filename': filename},
+                                 key=f"export:{filename}")
+        return job_response(state, 202)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/search')
+def search_pdfs():
+    """Busca texto en los PDFs de la sesión.
+
+    Parámetros: `q` (texto), `file` (opcional, un solo PDF) y `limit`.
+    Devuelve [{'file', 'page', 'snippet'}] y, en `pending`, los PDFs cuyo
+    texto todavía se está extrayendo (sus resultados pueden faltar).
+    """
+    user_folder = get_user_pdf_folder()
+    text = request.args.get('q', '').strip()
+    filename = request.args.get('file') or None
+    limit = request.args.get('limit', SEARCH_MAX_RESULTS, type=int)
+    
+    try:
+        # PDFs nuevos o reemplazados sin pasar por /upload (p. ej. copiados al disco)
+        state = indexing_state(user_folder)
+        pdfs = list_pdfs(user_folder)
+        for name in set(state) - {pdf['name'] for pdf in pdfs}:
+            forget_file(user_folder, name)
+        pending = []
+        for pdf in pdfs:
+            if filename is not None and pdf['name'] != filename:
+                continue
+            entry = state.get(pdf['name'])
+            content = content_hash(user_folder, pdf['name'])
+            if entry is None or entry['hash'] != content or entry['indexed'] < entry['pages']:
+                schedule_indexing(user_folder, pdf['name'], content)
+                pending.append(pdf['name'])
+        
+        results = search_text(user_folder, text, filename, limit) if text else []
+        return jsonify({'success': True, 'results': results, 'pending': pending})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/duplicates/<filename>')
+def get_duplicates(filename):
+    """Páginas repetidas de un PDF (hojas escaneadas dos veces, páginas copiadas).
+
+    Si las huellas de páginas ya están calculadas responde al instante con
+    {'pages', 'duplicates', 'identical'} (`identical`: otros PDFs de la sesión
+    con el mismo contenido). Si no, encola el trabajo 'fingerprint' y
+    devuelve el trabajo (202), cuyo resultado trae `pages` y `duplicates`.
+    """
+    user_folder = get_user_pdf_folder()
+    
+    try:
+        info = pdf_info(user_folder, filename)
+        if info is None:
+            return jsonify({'success': False, 'error': 'PDF no encontrado'}), 404
+        
+        content = content_hash(user_folder, filename)
+        state = schedule_fingerprints(user_folder, filename, content)
+        if state is not None:
+            return job_response(state, 202)
+        fingerprints = load_fingerprints(user_folder, content)
+        
+        return jsonify({
+            'success': True,
+            'pages': info['pages'],
+            'duplicates': find_duplicates(fingerprints),
+            'identical': identical_pdfs(user_folder, filename, content)
+        })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/jobs')
+def get_jobs():
+    """Trabajos de la sesión, del más nuevo al más viejo."""
+    user_folder = get_user_pdf_folder()
+    job_queue.resume_orphaned(user_folder)
+    return job_response({'jobs': list_jobs(user_folder)})
+
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Estado de un trabajo: status, progreso (`done`/`total`) y resultado o error."""
+    user_folder = get_user_pdf_folder()
+    try:
+        state = read_job(user_folder, job_id)
+        if not is_finished(state):
+            # Si su worker se reinició, retomarlo desde este
+            job_queue.resume_orphaned(user_folder)
+            state = read_job(user_folder, job_id)
+        return job_response(state)
+    except JobError as e:
+        return jsonify({'success': False, 'error': e.message}), e.status
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Progreso de un trabajo como Server-Sent Events (un evento por cambio de estado).
+
+    El stream se cierra cuando el trabajo termina o tras JOB_EVENTS_MAX_SECONDS
+    (el cliente puede reconectarse o seguir con `/jobs/<id>`).
+    """
+    user_folder = get_user_pdf_folder()
+    try:
+        read_job(user_folder, job_id)
+    except JobError as e:
+        return jsonify({'success': False, 'error': e.message}), e.status
+    
+    def generate():
+        last_state = None
+        last_sent = started = time.monotonic()
+        while True:
+            try:
+                state = read_job(user_folder, job_id)
+            except JobError:
+                return
+            now = time.monotonic()
+            if state != last_state:
+                yield f"data: {json.dumps(state)}\n\n"
+                last_state = state
+                last_sent = now
+            elif now - last_sent >= JOB_EVENTS_KEEPALIVE:
+                yield ": keepalive\n\n"
+                last_sent = now
+            if is_finished(state) or now - started >= JOB_EVENTS_MAX_SECONDS:
+                return
+            time.sleep(JOB_EVENTS_INTERVAL)
+    
+    response = app.response_class(generate(), mimetype='text/event-stream')
+    response.cache_control.no_store = True
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Pide cancelar un trabajo (la tarea se detiene al informar su próximo progreso)."""
+    try:
+        state = job_queue.cancel(get_user_pdf_folder(), job_id)
+        return job_response(state, 202)
+    except JobError as e:
+        return jsonify({'success': False, 'error': e.message}), e.status
+
+
+@app.route('/pool-stats')
+def pool_stats():
+    """Contadores del pool de documentos, del renderizado, de los trabajos y del almacenamiento."""
+    stats = document_pool.stats()
+    stats['prefetch'] = prefetch_queue.stats()
+    stats['render'] = render_engine.stats()
+    stats['jobs'] = job_queue.stats()
+    stats['storage'] = session_store.stats()
+    return jsonify(stats)
+
+
+@app.route('/metrics')
+def get_metrics():
+    """Métricas de todos los workers del nodo en formato de texto de Prometheus."""
+    gauges = []
+    try:
+        usage = index_stats(BASE_PDF_FOLDER)
+        gauges += [
+            ('pdfsorter_sessions', {}, usage['sessions']),
+            ('pdfsorter_disk_usage_bytes', {}, usage['bytes']),
+            ('pdfsorter_disk_cache_bytes', {}, usage['cache_bytes']),
+        ]
+        gauges.append(('pdfsorter_disk_free_bytes', {}, shutil.disk_usage(BASE_PDF_FOLDER).free))
+    except Exception as e:
+        print(f"Error al leer el uso de disco para métricas: {e}")
+    
+    return app.response_class(metrics.render(BASE_PDF_FOLDER, gauges),
+                              mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     # Crear carpeta base si no existe
     if not os.path.exists(BASE_PDF_FOLDER):
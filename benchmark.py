@@ -0,0 +1,677 @@
+"""Benchmark de las rutas principales: latencia, throughput, memoria y escrituras.
+
+Genera PDFs sintéticos con PyMuPDF (solo texto, escaneados y mixtos, de
+10/100/1000 páginas por defecto) y recorre con ellos las rutas que más pesan:
+subida, `/` (index), `/page` (render en frío y desde la caché),
+`/append-to-pdf`, `/export` y `/download`. Se puede correr contra el
+cliente de pruebas de Flask (en este mismo proceso) y/o contra un gunicorn
+real con los flags que se quieran comparar.
+
+Por cada ruta informa p50/p95 de latencia, throughput con `--concurrency`
+clientes en paralelo, RSS (de todo el árbol de procesos: workers y procesos
+de renderizado) y bytes escritos a disco (según /proc/<pid>/io). El resultado
+se guarda en JSON; con `--compare` se compara contra una corrida anterior y
+se sale con código 1 si alguna ruta empeoró más que `--threshold`.
+
+Uso:
+    python benchmark.py                                  # cliente + gunicorn, todo
+    python benchmark.py --mode client --pages 10,100 --kinds text
+    python benchmark.py --mode gunicorn --gunicorn-args "--workers=4 --threads=2" -o w4.json
+    python benchmark.py -o nuevo.json --compare base.json
+
+Los PDFs generados se guardan en `--pdf-cache` para que las corridas sean
+comparables (el contenido es determinístico).
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shlex
+import random
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz  # PyMuPDF
+import numpy as np
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Tamaños y tipos de PDF a probar
+BENCH_PAGES = (10, 100, 1000)
+BENCH_KINDS = ('text', 'scan', 'mixed')
+
+# Peticiones medidas por ruta y clientes en paralelo
+BENCH_REQUESTS = 30
+BENCH_CONCURRENCY = 4
+
+# Flags de gunicorn por defecto (los del Procfile)
+GUNICORN_ARGS = '--workers=2 --worker-class=gthread --threads=4 --timeout=120'
+
+# Segundos máximos de espera a que gunicorn acepte conexiones
+GUNICORN_START_TIMEOUT = 60
+
+# Empeoramiento relativo de p95 o throughput que cuenta como regresión
+REGRESSION_THRESHOLD = 0.2
+
+# Carpeta donde se guardan los PDFs sintéticos entre corridas
+PDF_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'pdf-sorter-bench')
+
+# Versión del generador (cambiarla invalida los PDFs guardados)
+GENERATOR_VERSION = 1
+
+# Los archivos más grandes que esto se suben por partes (/uploads)
+SINGLE_UPLOAD_MAX = 64 * 1024 * 1024
+
+# Resolución de las páginas "escaneadas" (carta a 100 dpi, escala de grises)
+SCAN_SIZE = (850, 1100)
+
+ACCEPT_IMAGES = 'image/webp,image/png,image/jpeg,*/*;q=0.8'
+
+_WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+          'incididunt ut labore et dolore magna aliqua factura remito pedido cliente '
+          'importe total fecha vencimiento cuenta saldo contrato anexo').split()
+
+
+# ---------- PDFs sintéticos ----------
+
+def _text_page(doc, index):
+    rng = random.Random(index)
+    page = doc.new_page()
+    page.insert_text((54, 60), f"Documento de prueba - página {index + 1}", fontsize=16)
+    lines = []
+    for _ in range(55):
+        lines.append(' '.join(rng.choice(_WORDS) for _ in range(rng.randint(8, 14))))
+    page.insert_textbox(fitz.Rect(54, 80, 558, 750), '\n'.join(lines), fontsize=9)
+    return page
+
+
+def _scan_image(index):
+    """JPEG en escala de grises que se parece a un escaneo (fondo irregular y renglones)."""
+    rng = np.random.default_rng(index)
+    width, height = SCAN_SIZE
+    # Fondo: ruido de baja frecuencia ampliado más grano fino
+    coarse = rng.normal(235, 8, (height // 25 + 1, width // 25 + 1))
+    background = np.kron(coarse, np.ones((25, 25)))[:height, :width]
+    image = background + rng.normal(0, 6, (height, width))
+    # Renglones de "texto": bandas oscuras con cortes al azar
+    for top in range(90, height - 90, 28):
+        mask = rng.random(width) < 0.55
+        mask[:70] = mask[-70:] = False
+        image[top:top + 11, mask] -= rng.uniform(120, 180)
+    samples = np.clip(image, 0, 255).astype(np.uint8).tobytes()
+    pix = fitz.Pixmap(fitz.csGRAY, width, height, samples, False)
+    return pix.tobytes('jpeg', jpg_quality=60)
+
+
+def _scan_page(doc, index):
+    page = doc.new_page()
+    page.insert_image(page.rect, stream=_scan_image(index))
+    return page
+
+
+def _mixed_page(doc, index):
+    # Un tercio escaneadas; el resto texto con algún gráfico vectorial
+    if index % 3 == 0:
+        return _scan_page(doc, index)
+    page = _text_page(doc, index)
+    if index % 3 == 1:
+        for i in range(12):
+            page.draw_rect(fitz.Rect(60 + i * 40, 600 - i * 15, 90 + i * 40, 700),
+                           color=(0, 0.3, 0.6), fill=(0.2, 0.5, 0.8))
+    return page
+
+
+_PAGE_MAKERS = {'text': _text_page, 'scan': _scan_page, 'mixed': _mixed_page}
+
+
+def synthetic_pdf(kind, pages, cache_dir=PDF_CACHE_DIR):
+    """Ruta de un PDF sintético de `kind` con `pages` páginas (se genera una sola vez)."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"v{GENERATOR_VERSION}-{kind}-{pages}.pdf")
+    if os.path.exists(path):
+        return path
+
+    make_page = _PAGE_MAKERS[kind]
+    doc = fitz.open()
+    for index in range(pages):
+        make_page(doc, index)
+    temp = f"{path}.{uuid.uuid4().hex}.tmp"
+    doc.save(temp, garbage=3, deflate=True)
+    doc.close()
+    os.replace(temp, path)
+    return path
+
+
+# ---------- Medición de procesos (Linux) ----------
+
+def _process_tree(root):
+    """Pids de `root` y todos sus descendientes."""
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    tree, pending = [], [root]
+    while pending:
+        pid = pending.pop()
+        tree.append(pid)
+        pending.extend(children.get(pid, []))
+    return tree
+
+
+def _proc_value(pid, filename, field):
+    try:
+        with open(f'/proc/{pid}/{filename}') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def process_usage(root):
+    """{'rss': bytes, 'written': bytes} sumando el árbol de `root` (None sin /proc)."""
+    if not os.path.isdir('/proc'):
+        return {'rss': None, 'written': None}
+    rss = written = 0
+    for pid in _process_tree(root):
+        kb = _proc_value(pid, 'status', 'VmRSS')
+        rss += (kb or 0) * 1024
+        written += _proc_value(pid, 'io', 'write_bytes') or 0
+    return {'rss': rss, 'written': written}
+
+
+# ---------- Clientes ----------
+
+def multipart_body(field, filename, data):
+    """Cuerpo multipart/form-data con un archivo: (bytes, content-type)."""
+    boundary = uuid.uuid4().hex
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; '
+            f'filename="{filename}"\r\nContent-Type: application/pdf\r\n\r\n').encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    return head + data + tail, f'multipart/form-data; boundary={boundary}'
+
+
+class FlaskClient:
+    """Cliente de pruebas de Flask (la app corre en este proceso)."""
+
+    def __init__(self, flask_app, cookie=None):
+        self.app = flask_app
+        self.client = flask_app.test_client()
+        if cookie:
+            self.client.set_cookie('session', cookie)
+
+    def clone(self):
+        """Otro cliente con la misma sesión (para usar desde otro hilo)."""
+        cookie = self.client.get_cookie('session')
+        return FlaskClient(self.app, cookie.value if cookie else None)
+
+    def request(self, method, path, body=None, headers=None):
+        response = self.client.open(path, method=method, data=body, headers=headers or {})
+        data = response.get_data()
+        response.close()
+        return response.status_code, data
+
+
+class HttpClient:
+    """Cliente HTTP con keep-alive contra un servidor real."""
+
+    def __init__(self, host, port, cookie=None):
+        self.host = host
+        self.port = port
+        self.cookie = cookie
+        self.conn = http.client.HTTPConnection(host, port, timeout=300)
+
+    def clone(self):
+        return HttpClient(self.host, self.port, self.cookie)
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookie:
+            headers['Cookie'] = f'session={self.cookie}'
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            # Conexión cerrada por el servidor: reintentar una vez con otra
+            self.conn.close()
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=300)
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+        data = response.read()
+        for header in response.headers.get_all('Set-Cookie') or []:
+            if header.startswith('session='):
+                self.cookie = header.split(';', 1)[0][len('session='):]
+        return response.status, data
+
+
+def post_json(client, path, payload):
+    return client.request('POST', path, json.dumps(payload).encode(),
+                          {'Content-Type': 'application/json'})
+
+
+def upload_pdf(client, path):
+    """Sube un PDF (por partes si es grande) y devuelve su nombre en la sesión."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    name = os.path.basename(path)
+
+    if len(data) <= SINGLE_UPLOAD_MAX:
+        body, content_type = multipart_body('file', name, data)
+        status, response = client.request('POST', '/upload', body, {'Content-Type': content_type})
+        result = json.loads(response)
+    else:
+        status, response = post_json(client, '/uploads', {'filename': name, 'size': len(data)})
+        result = json.loads(response)
+        if status != 201:
+            raise RuntimeError(f"Error al iniciar la subida: {result.get('error')}")
+        upload_id, offset, chunk = result['upload_id'], 0, result['chunk_size']
+        while offset < len(data):
+            status, response = client.request(
+                'PATCH', f"/uploads/{upload_id}", data[offset:offset + chunk],
+                {'Upload-Offset': str(offset), 'Content-Type': 'application/offset+octet-stream'}
+            )
+            result = json.loads(response)
+            if status != 200:
+                break
+            offset = result['offset']
+
+    if status != 200:
+        raise RuntimeError(f"Error al subir {name}: {result.get('error')}")
+    return result['filename']
+
+
+# ---------- Medición de rutas ----------
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def measure(client, requests, concurrency, server_pid, make_client=None):
+    """Ejecuta `requests` [(método, ruta, cuerpo, cabeceras)] con `concurrency` hilos.
+
+    Cada hilo usa su propio clon de `client` (misma sesión), o el que devuelva
+    `make_client(índice de hilo)` si se pasa. Devuelve las estadísticas de la ruta.
+    """
+    local = threading.local()
+    counter = iter(range(concurrency))
+    counter_lock = threading.Lock()
+    latencies, errors, response_bytes = [], [0], [0]
+    results_lock = threading.Lock()
+
+    def run(item):
+        if not hasattr(local, 'client'):
+            with counter_lock:
+                worker = next(counter)
+            local.client = make_client(worker) if make_client else client.clone()
+        method, path, body, headers = item(local) if callable(item) else item
+        start = time.perf_counter()
+        status, data = local.client.request(method, path, body, headers)
+        elapsed = time.perf_counter() - start
+        with results_lock:
+            latencies.append(elapsed)
+            response_bytes[0] += len(data)
+            if status >= 400:
+                errors[0] += 1
+
+    before = process_usage(server_pid)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, requests))
+    wall = time.perf_counter() - start
+    after = process_usage(server_pid)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 2)
+
+    written = None
+    if before['written'] is not None:
+        written = max(0, after['written'] - before['written'])
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'p50_ms': ms(_percentile(latencies, 0.5)),
+        'p95_ms': ms(_percentile(latencies, 0.95)),
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'max_ms': ms(max(latencies)) if latencies else None,
+        'throughput_rps': round(len(latencies) / wall, 2) if wall > 0 else None,
+        'response_bytes': response_bytes[0],
+        'bytes_written': written,
+        'rss_bytes': after['rss'],
+    }
+
+
+def measure_once(operation, server_pid):
+    """Mide una operación que no se repite (subida, exportación). Devuelve (resultado, estadísticas)."""
+    before = process_usage(server_pid)
+    start = time.perf_counter()
+    result = operation()
+    elapsed = time.perf_counter() - start
+    after = process_usage(server_pid)
+    return result, {
+        'requests': 1, 'errors': 0,
+        'p50_ms': round(elapsed * 1000, 2), 'p95_ms': round(elapsed * 1000, 2),
+        'mean_ms': round(elapsed * 1000, 2), 'max_ms': round(elapsed * 1000, 2),
+        'throughput_rps': round(1 / elapsed, 2),
+        'response_bytes': 0,
+        'bytes_written': (max(0, after['written'] - before['written'])
+                          if before['written'] is not None else None),
+        'rss_bytes': after['rss'],
+    }
+
+
+def export_and_wait(client, filename):
+    """Prepara la descarga con el trabajo 'export' (como el botón de la lista) y espera."""
+    status, data = client.request('POST', f'/export/{filename}')
+    job = json.loads(data)
+    while job.get('status') in ('queued', 'running'):
+        time.sleep(0.1)
+        status, data = client.request('GET', f"/jobs/{job['id']}")
+        job = json.loads(data)
+    if job.get('status') != 'done':
+        raise RuntimeError(f"Error al exportar: {job.get('error')}")
+
+
+def run_scenario(client, pdf_path, pages, n, concurrency, server_pid):
+    """Mide las rutas de la app con un PDF ya generado. Devuelve {ruta: estadísticas}."""
+    routes = {}
+
+    filename, routes['upload'] = measure_once(lambda: upload_pdf(client, pdf_path), server_pid)
+
+    # Arranque del pool de renderizado (con otras opciones: no llena la caché medida)
+    client.request('GET', f'/page/{filename}/1?preview=1', headers={'Accept': ACCEPT_IMAGES})
+
+    routes['index'] = measure(client, [('GET', '/', None, None)] * n, concurrency, server_pid)
+
+    # Páginas distintas repartidas por todo el documento: todas se renderizan
+    step = max(1, pages // n)
+    page_nums = [(i * step) % pages + 1 for i in range(n)]
+    page_requests = [('GET', f'/page/{filename}/{p}', None, {'Accept': ACCEPT_IMAGES})
+                     for p in page_nums]
+    routes['page'] = measure(client, page_requests, concurrency, server_pid)
+    # Las mismas páginas otra vez: salen de la caché en disco
+    routes['page_cached'] = measure(client, page_requests, concurrency, server_pid)
+
+    # Cada hilo agrega páginas a su propio PDF sorted (como varias pestañas del sorter)
+    targets = {}
+    for worker in range(concurrency):
+        status, data = post_json(client, f'/create-pdf/{filename}',
+                                 {'page': 1, 'name': f'bench-{worker}'})
+        if status != 200:
+            raise RuntimeError(f"Error al crear el PDF sorted: {json.loads(data).get('error')}")
+        targets[worker] = json.loads(data)['name']
+
+    def make_client(worker):
+        worker_client = client.clone()
+        worker_client.target = targets[worker]
+        return worker_client
+
+    def append_request(page):
+        def build(local):
+            body = json.dumps({'page': page, 'target': local.client.target}).encode()
+            return 'POST', f'/append-to-pdf/{filename}', body, {'Content-Type': 'application/json'}
+        return build
+
+    routes['append'] = measure(client, [append_request(p) for p in page_nums], concurrency,
+                               server_pid, make_client=make_client)
+
+    # /download no prepara nada: antes se compactan los PDFs sorted con el trabajo 'export'
+    _, routes['export'] = measure_once(lambda: export_and_wait(client, filename), server_pid)
+    downloads = max(2, n // 5)
+    routes['download'] = measure(client, [('GET', f'/download/{filename}', None, None)] * downloads,
+                                 min(concurrency, downloads), server_pid)
+    return routes
+
+
+# ---------- Servidores ----------
+
+class InProcessServer:
+    """La app en este proceso, vista a través del cliente de pruebas de Flask."""
+
+    mode = 'client'
+
+    def __init__(self, base_folder, gunicorn_args=None):
+        import app as app_module
+        app_module.BASE_PDF_FOLDER = base_folder
+        self.app = app_module.app
+        self.pid = os.getpid()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def new_client(self):
+        return FlaskClient(self.app)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class GunicornServer:
+    """Un gunicorn real (con los flags pedidos) sobre una carpeta de sesiones temporal."""
+
+    mode = 'gunicorn'
+
+    def __init__(self, base_folder, gunicorn_args=GUNICORN_ARGS):
+        self.base_folder = base_folder
+        self.args = gunicorn_args
+        self.port = _free_port()
+        self.process = None
+        self.pid = None
+
+    def __enter__(self):
+        env = dict(os.environ, PDF_FOLDER=self.base_folder)
+        command = [sys.executable, '-m', 'gunicorn', 'app:app',
+                   '--bind', f'127.0.0.1:{self.port}', *shlex.split(self.args)]
+        self.log = open(os.path.join(self.base_folder, 'gunicorn.log'), 'wb')
+        self.process = subprocess.Popen(command, cwd=APP_DIR, env=env,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+        self.pid = self.process.pid
+
+        deadline = time.monotonic() + GUNICORN_START_TIMEOUT
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"gunicorn terminó al iniciar (ver {self.log.name})")
+            try:
+                status, _ = HttpClient('127.0.0.1', self.port).request('GET', '/pool-stats')
+                if status == 200:
+                    return self
+            except OSError:
+                pass
+            if time.monotonic() > deadline:
+                self.__exit__()
+                raise RuntimeError('gunicorn no respondió a tiempo')
+            time.sleep(0.2)
+
+    def __exit__(self, *exc):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.log.close()
+        return False
+
+    def new_client(self):
+        return HttpClient('127.0.0.1', self.port)
+
+
+SERVERS = {'client': InProcessServer, 'gunicorn': GunicornServer}
+
+
+# ---------- Reporte y comparación ----------
+
+def _mb(value):
+    return '-' if value is None else f"{value / (1024 * 1024):.1f}"
+
+
+def print_run(run):
+    print(f"\n[{run['mode']}] {run['kind']} {run['pages']} páginas "
+          f"({_mb(run['file_bytes'])} MB)")
+    print(f"  {'ruta':<12} {'n':>4} {'err':>4} {'p50 ms':>9} {'p95 ms':>9} {'req/s':>8} "
+          f"{'MB resp':>8} {'MB disco':>9} {'RSS MB':>8}")
+    for route, s in run['routes'].items():
+        print(f"  {route:<12} {s['requests']:>4} {s['errors']:>4} {s['p50_ms']:>9} "
+              f"{s['p95_ms']:>9} {s['throughput_rps']:>8} {_mb(s['response_bytes']):>8} "
+              f"{_mb(s['bytes_written']):>9} {_mb(s['rss_bytes']):>8}")
+
+
+def compare(previous, current, threshold=REGRESSION_THRESHOLD):
+    """Lista de regresiones (texto) de `current` respecto de `previous`."""
+    def index(results):
+        return {(r['mode'], r['kind'], r['pages']): r['routes'] for r in results['runs']}
+
+    old_runs = index(previous)
+    regressions = []
+    for key, routes in index(current).items():
+        old_routes = old_runs.get(key)
+        if old_routes is None:
+            continue
+        for route, stats in routes.items():
+            old = old_routes.get(route)
+            if not old:
+                continue
+            name = f"{key[0]} {key[1]} {key[2]} {route}"
+            if stats['errors'] > old['errors']:
+                regressions.append(f"{name}: errores {old['errors']} -> {stats['errors']}")
+            if stats['p95_ms'] is None:
+                # Ninguna petición medida: no hay latencias que comparar
+                if old['p95_ms'] is not None:
+                    regressions.append(f"{name}: sin peticiones medidas (antes p95 {old['p95_ms']} ms)")
+                continue
+            if old['p95_ms'] and stats['p95_ms'] > old['p95_ms'] * (1 + threshold):
+                regressions.append(f"{name}: p95 {old['p95_ms']} -> {stats['p95_ms']} ms")
+            if (old['throughput_rps'] and stats['throughput_rps'] is not None
+                    and stats['throughput_rps'] < old['throughput_rps'] * (1 - threshold)):
+                regressions.append(f"{name}: throughput {old['throughput_rps']} -> "
+                                   f"{stats['throughput_rps']} req/s")
+    return regressions
+
+
+def _csv(value, cast=str):
+    return [cast(item.strip()) for item in value.split(',') if item.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark de las rutas de PDF Sorter')
+    parser.add_argument('--mode', default='client,gunicorn',
+                        help='client, gunicorn o ambos separados por coma')
+    parser.add_argument('--pages', default=','.join(map(str, BENCH_PAGES)),
+                        help='cantidades de páginas separadas por coma')
+    parser.add_argument('--kinds', default=','.join(BENCH_KINDS),
+                        help='tipos de PDF: text, scan, mixed')
+    parser.add_argument('-n', '--requests', type=int, default=BENCH_REQUESTS,
+                        help='peticiones medidas por ruta')
+    parser.add_argument('-c', '--concurrency', type=int, default=BENCH_CONCURRENCY,
+                        help='clientes en paralelo')
+    parser.add_argument('--gunicorn-args', default=GUNICORN_ARGS,
+                        help='flags de gunicorn (modo gunicorn)')
+    parser.add_argument('--pdf-cache', default=PDF_CACHE_DIR,
+                        help='carpeta donde se guardan los PDFs sintéticos')
+    parser.add_argument('-o', '--output', default='benchmark-results.json',
+                        help='archivo JSON con los resultados')
+    parser.add_argument('--compare', help='JSON de una corrida anterior para detectar regresiones')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='empeoramiento relativo que cuenta como regresión (0.2 = 20%%)')
+    parser.add_argument('--keep', action='store_true',
+                        help='no borrar la carpeta de sesiones al terminar')
+    args = parser.parse_args(argv)
+
+    modes = _csv(args.mode)
+    for mode in modes:
+        if mode not in SERVERS:
+            parser.error(f"Modo desconocido: {mode}")
+    kinds = _csv(args.kinds)
+    for kind in kinds:
+        if kind not in _PAGE_MAKERS:
+            parser.error(f"Tipo de PDF desconocido: {kind}")
+    sizes = _csv(args.pages, int)
+
+    pdfs = {}
+    for kind in kinds:
+        for pages in sizes:
+            start = time.perf_counter()
+            pdfs[kind, pages] = synthetic_pdf(kind, pages, args.pdf_cache)
+            print(f"PDF {kind} de {pages} páginas listo ({time.perf_counter() - start:.1f}s): "
+                  f"{pdfs[kind, pages]}")
+
+    results = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pymupdf': fitz.VersionBind,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': {
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'gunicorn_args': args.gunicorn_args if 'gunicorn' in modes else None,
+            'env': {k: v for k, v in os.environ.items()
+                    if k.startswith(('RENDER_', 'PAGE_', 'SORTED_', 'DOC_POOL', 'PREFETCH_',
+                                     'JOB_', 'COMPACT_'))},
+        },
+        'runs': [],
+    }
+
+    for mode in modes:
+        base_folder = tempfile.mkdtemp(prefix=f'pdf-sorter-bench-{mode}-')
+        try:
+            with SERVERS[mode](base_folder, args.gunicorn_args) as server:
+                for (kind, pages), pdf_path in pdfs.items():
+                    # Una sesión nueva por PDF
+                    routes = run_scenario(server.new_client(), pdf_path, pages, args.requests,
+                                          args.concurrency, server.pid)
+                    run = {'mode': mode, 'kind': kind, 'pages': pages,
+                           'file_bytes': os.path.getsize(pdf_path), 'routes': routes}
+                    results['runs'].append(run)
+                    print_run(run)
+        finally:
+            if args.keep:
+                print(f"Sesiones de {mode} en: {base_folder}")
+            else:
+                shutil.rmtree(base_folder, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResultados guardados en {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        regressions = compare(previous, results, args.threshold)
+        if regressions:
+            print(f"\nRegresiones respecto de {args.compare}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nSin regresiones respecto de {args.compare}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
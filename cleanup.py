@@ -0,0 +1,282 @@
+"""Limpieza de sesiones guiada por un índice de último acceso (SQLite).
+
+Cada petición registra el último acceso de su sesión en `pdfs/.sessions.db`
+(como mucho una escritura por sesión cada ACCESS_WRITE_INTERVAL segundos), así
+el barrido no necesita recorrer las carpetas ni confiar en su mtime, que no
+cambia cuando se modifica un archivo dentro de una carpeta -sorted:
+
+1. Sesiones vencidas: una consulta por `last_access` (indexada) devuelve solo
+   las que hay que borrar.
+2. Sesiones con actividad desde el último barrido: se hace su mantenimiento
+   (caché de renderizado, subidas abandonadas, trabajos) y se mide su uso de
+   disco; si pasan SESSION_QUOTA_BYTES se vacían sus cachés.
+3. Cuota global (DISK_QUOTA_BYTES): primero se vacían las cachés de las
+   sesiones menos usadas y, solo si no alcanza, se borran sesiones completas
+   sin actividad en QUOTA_GRACE_SECONDS.
+
+Todos los workers tienen el hilo de limpieza, pero solo el que consigue el
+lock `pdfs/.cleanup.lock` (el líder) barre, y como mucho una vez cada
+CLEANUP_INTERVAL.
+"""
+import os
+import time
+import shutil
+import sqlite3
+import threading
+
+from render_cache import RENDER_CACHE_DIRNAME
+from search_index import SEARCH_DIRNAME
+from duplicates import FINGERPRINT_DIRNAME
+from sorted_store import EXPORT_DIRNAME
+from storage import file_lock
+
+# Tiempo sin actividad tras el cual se borra una sesión
+SESSION_LIFETIME = int(os.environ.get('SESSION_LIFETIME', str(3 * 24 * 60 * 60)))  # 3 días
+
+# Tiempo mínimo entre barridos (entre todos los workers)
+CLEANUP_INTERVAL = int(os.environ.get('CLEANUP_INTERVAL', str(60 * 60)))  # 1 hora
+
+# Cada cuánto cada worker intenta ser el líder y barrer
+CLEANUP_CHECK_INTERVAL = 5 * 60
+
+# Espacio máximo por sesión (0 = sin límite); se controla al subir y al barrer
+SESSION_QUOTA_BYTES = int(os.environ.get('SESSION_QUOTA_BYTES', str(2 * 1024 * 1024 * 1024)))  # 2GB
+
+# Espacio máximo de todas las sesiones juntas (0 = sin límite)
+DISK_QUOTA_BYTES = int(os.environ.get('DISK_QUOTA_BYTES', '0'))
+
+# Por la cuota global nunca se borran sesiones con actividad más reciente que esto
+QUOTA_GRACE_SECONDS = 60 * 60
+
+# Como mucho una escritura del último acceso por sesión en este intervalo
+ACCESS_WRITE_INTERVAL = 60
+
+SESSIONS_DB_FILENAME = '.sessions.db'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    last_access REAL NOT NULL,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    cache_bytes INTEGER NOT NULL DEFAULT 0,
+    measured_at REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL);
+"""
+
+_local = threading.local()  # conexiones SQLite por hilo
+
+_touch_lock = threading.Lock()
+_last_touch = {}  # (carpeta base, id de sesión) -> momento de la última escritura
+
+
+def _connect(base_folder):
+    """Conexión (por hilo) al índice de sesiones de `base_folder`."""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(base_folder)
+    if conn is None:
+        os.makedirs(base_folder, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(base_folder, SESSIONS_DB_FILENAME),
+                               timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(_SCHEMA)
+        connections[base_folder] = conn
+    return conn
+
+
+def touch_session(base_folder, session_id):
+    """Registra un acceso a la sesión (barato: casi siempre no escribe nada)."""
+    now = time.time()
+    key = (base_folder, session_id)
+    with _touch_lock:
+        last = _last_touch.get(key)
+        if last is not None and now - last < ACCESS_WRITE_INTERVAL:
+            return
+        if len(_last_touch) > 100000:
+            _last_touch.clear()
+        _last_touch[key] = now
+    try:
+        _connect(base_folder).execute(
+            'INSERT INTO sessions (id, last_access) VALUES (?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET last_access = excluded.last_access',
+            (session_id, now),
+        )
+    except sqlite3.Error as e:
+        print(f"Error al registrar el acceso a la sesión {session_id}: {e}")
+
+
+def _dir_size(path):
+    """Bytes de una carpeta; los hardlinks (PDFs subidos dos veces) cuentan una vez."""
+    total = 0
+    seen = set()
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if st.st_nlink > 1:
+                if st.st_ino in seen:
+                    continue
+                seen.add(st.st_ino)
+            total += st.st_size
+    return total
+
+
+def _cache_dirs(session_path):
+    """Carpetas descartables de una sesión (se regeneran solas): la caché de
+    renderizado, el índice de búsqueda, las huellas de páginas y los `.export`
+    de cada carpeta -sorted."""
+    dirs = [os.path.join(session_path, RENDER_CACHE_DIRNAME),
+            os.path.join(session_path, SEARCH_DIRNAME),
+            os.path.join(session_path, FINGERPRINT_DIRNAME)]
+    try:
+        entries = os.listdir(session_path)
+    except OSError:
+        return dirs
+    for name in entries:
+        export = os.path.join(session_path, name, EXPORT_DIRNAME)
+        if os.path.isdir(export):
+            dirs.append(export)
+    return dirs
+
+
+def session_usage(session_path):
+    """Uso de disco de una sesión: {'total': bytes, 'cache': bytes de cachés}."""
+    cache = sum(_dir_size(d) for d in _cache_dirs(session_path) if os.path.isdir(d))
+    return {'total': _dir_size(session_path), 'cache': cache}
+
+
+def evict_caches(session_path):
+    """Vacía las cachés de una sesión (no toca los PDFs del usuario)."""
+    for d in _cache_dirs(session_path):
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def _delete_session(conn, base_folder, session_id):
+    shutil.rmtree(os.path.join(base_folder, session_id), ignore_errors=True)
+    conn.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+    print(f"Sesión limpiada: {session_id}")
+
+
+def _get_meta(conn, key):
+    row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_meta(conn, key, value):
+    conn.execute('INSERT INTO meta (key, value) VALUES (?, ?) '
+                 'ON CONFLICT(key) DO UPDATE SET value = excluded.value', (key, value))
+
+
+def _backfill(conn, base_folder):
+    """Agrega al índice las sesiones que ya estaban en disco (una sola vez)."""
+    if _get_meta(conn, 'backfilled'):
+        return
+    for name in os.listdir(base_folder):
+        path = os.path.join(base_folder, name)
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        conn.execute('INSERT OR IGNORE INTO sessions (id, last_access) VALUES (?, ?)',
+                     (name, os.path.getmtime(path)))
+    _set_meta(conn, 'backfilled', time.time())
+
+
+def sweep(base_folder, maintain=None):
+    """Barre las sesiones: vencidas, activas (mantenimiento y cuota) y cuota global.
+
+    `maintain(carpeta de sesión)` se llama para cada sesión con actividad
+    desde el último barrido. Devuelve contadores de lo que se hizo.
+    """
+    conn = _connect(base_folder)
+    now = time.time()
+    result = {'expired': 0, 'measured': 0, 'caches_evicted': 0, 'sessions_evicted': 0}
+    _backfill(conn, base_folder)
+
+    # 1. Sesiones vencidas (solo se leen las filas a borrar)
+    expired = conn.execute('SELECT id FROM sessions WHERE last_access < ? ORDER BY last_access',
+                           (now - SESSION_LIFETIME,)).fetchall()
+    for (session_id,) in expired:
+        _delete_session(conn, base_folder, session_id)
+        result['expired'] += 1
+
+    # 2. Sesiones con actividad desde su última medición (los accesos se registran
+    # con hasta ACCESS_WRITE_INTERVAL de atraso)
+    active = conn.execute('SELECT id FROM sessions WHERE last_access + ? >= measured_at',
+                          (ACCESS_WRITE_INTERVAL,)).fetchall()
+    for (session_id,) in active:
+        path = os.path.join(base_folder, session_id)
+        if not os.path.isdir(path):
+            conn.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+            continue
+        if maintain is not None:
+            try:
+                maintain(path)
+            except Exception as e:
+                print(f"Error en el mantenimiento de la sesión {session_id}: {e}")
+        usage = session_usage(path)
+        if SESSION_QUOTA_BYTES and usage['total'] > SESSION_QUOTA_BYTES and usage['cache']:
+            evict_caches(path)
+            usage = session_usage(path)
+            result['caches_evicted'] += 1
+        conn.execute('UPDATE sessions SET bytes = ?, cache_bytes = ?, measured_at = ? WHERE id = ?',
+                     (usage['total'], usage['cache'], now, session_id))
+        result['measured'] += 1
+
+    # 3. Cuota global: primero cachés, después sesiones inactivas (las más viejas primero)
+    if DISK_QUOTA_BYTES:
+        total = conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM sessions').fetchone()[0]
+        if total > DISK_QUOTA_BYTES:
+            rows = conn.execute('SELECT id, cache_bytes FROM sessions WHERE cache_bytes > 0 '
+                                'ORDER BY last_access').fetchall()
+            for session_id, cache_bytes in rows:
+                if total <= DISK_QUOTA_BYTES:
+                    break
+                evict_caches(os.path.join(base_folder, session_id))
+                conn.execute('UPDATE sessions SET bytes = bytes - cache_bytes, cache_bytes = 0 '
+                             'WHERE id = ?', (session_id,))
+                total -= cache_bytes
+                result['caches_evicted'] += 1
+        if total > DISK_QUOTA_BYTES:
+            rows = conn.execute('SELECT id, bytes FROM sessions WHERE last_access < ? '
+                                'ORDER BY last_access', (now - QUOTA_GRACE_SECONDS,)).fetchall()
+            for session_id, size in rows:
+                if total <= DISK_QUOTA_BYTES:
+                    break
+                _delete_session(conn, base_folder, session_id)
+                total -= size
+                result['sessions_evicted'] += 1
+
+    return result
+
+
+def index_stats(base_folder):
+    """Totales del índice: {'sessions', 'bytes', 'cache_bytes'} (medidos en el último barrido)."""
+    row = _connect(base_folder).execute(
+        'SELECT COUNT(*), COALESCE(SUM(bytes), 0), COALESCE(SUM(cache_bytes), 0) FROM sessions'
+    ).fetchone()
+    return {'sessions': row[0], 'bytes': row[1], 'cache_bytes': row[2]}
+
+
+def run_cleanup(base_folder, maintain=None, force=False):
+    """Barre si este proceso es el líder y pasó CLEANUP_INTERVAL desde el último barrido.
+
+    Devuelve los contadores del barrido, o None si no le tocaba barrer.
+    """
+    if not os.path.isdir(base_folder):
+        return None
+    try:
+        with file_lock(os.path.join(base_folder, 'cleanup'), blocking=False):
+            conn = _connect(base_folder)
+            last = _get_meta(conn, 'last_sweep')
+            if not force and last is not None and time.time() - last < CLEANUP_INTERVAL:
+                return None
+            result = sweep(base_folder, maintain)
+            _set_meta(conn, 'last_sweep', time.time())
+            return result
+    except BlockingIOError:
+        # Otro worker es el líder y está barriendo
+        return None
@@ -0,0 +1,172 @@
+"""Pool de documentos PyMuPDF abiertos, compartido entre las rutas de un worker.
+
+Abrir un PDF escaneado grande obliga a MuPDF a leer toda la tabla xref, lo que
+suele costar más que el trabajo en sí. El pool mantiene abiertos los últimos
+documentos usados, identificados por ruta y por (inode, tamaño, mtime), de modo
+que un archivo reemplazado nunca se sirve desde un handle viejo.
+
+Los handles de MuPDF no se pueden usar desde varios hilos a la vez, por eso
+cada documento tiene su propio lock y solo se presta dentro de `acquire()`.
+Un documento desalojado o invalidado mientras está prestado se cierra cuando
+quien lo tiene lo devuelve.
+"""
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import fitz  # PyMuPDF
+
+import metrics
+
+# Máximo de documentos abiertos por worker
+DOC_POOL_SIZE = int(os.environ.get('DOC_POOL_SIZE', '16'))
+
+
+def _file_stamp(path):
+    """Identifica una versión concreta de un archivo en disco."""
+    st = os.stat(path)
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class _PooledDocument:
+    """Un documento abierto junto con su lock y la versión del archivo."""
+
+    def __init__(self, path, stamp):
+        self.path = path
+        self.stamp = stamp
+        self.lock = threading.Lock()
+        with metrics.span('fitz_open'):
+            self.doc = fitz.open(path)
+        self.retired = False
+        self.closed = False
+
+    def close_locked(self):
+        """Cierra el documento; quien llama debe tener el lock."""
+        if not self.closed:
+            self.doc.close()
+            self.closed = True
+
+    def retire(self):
+        """Saca el documento de uso y lo cierra en cuanto nadie lo tenga prestado."""
+        self.retired = True
+        if self.lock.acquire(blocking=False):
+            try:
+                self.close_locked()
+            finally:
+                self.lock.release()
+
+
+class DocumentPool:
+    """Pool acotado (LRU) de documentos abiertos, seguro entre hilos."""
+
+    def __init__(self, max_size=DOC_POOL_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # ruta -> _PooledDocument
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @contextmanager
+    def acquire(self, path):
+        """Presta el documento de `path` con uso exclusivo mientras dure el bloque.
+
+        El documento prestado es de solo lectura para quien lo toma: para
+        modificar un PDF hay que abrirlo aparte y luego llamar a `invalidate`.
+        """
+        path = os.path.abspath(path)
+
+        while True:
+            entry = self._get_entry(path)
+            with entry.lock:
+                # Pudo retirarse (desalojo o invalidación) mientras esperábamos
+                if entry.retired:
+                    entry.close_locked()
+                    continue
+                try:
+                    yield entry.doc
+                finally:
+                    if entry.retired:
+                        entry.close_locked()
+                return
+
+    def _get_entry(self, path):
+        stamp = _file_stamp(path)
+        stale = []
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.stamp == stamp:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry
+
+            if entry is not None:
+                stale.append(self._entries.pop(path))
+                self.invalidations += 1
+            self.misses += 1
+
+        # Abrir fuera del lock global para no bloquear a otros documentos
+        new_entry = _PooledDocument(path, stamp)
+
+        with self._lock:
+            current = self._entries.get(path)
+            if current is not None and current.stamp == stamp:
+                # Otro hilo lo abrió primero: usar el suyo
+                stale.append(new_entry)
+                new_entry = current
+            else:
+                if current is not None:
+                    stale.append(self._entries.pop(path))
+                self._entries[path] = new_entry
+            self._entries.move_to_end(path)
+
+            while len(self._entries) > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                stale.append(evicted)
+                self.evictions += 1
+
+        for old in stale:
+            old.retire()
+        return new_entry
+
+    def invalidate(self, path):
+        """Cierra y descarta el documento de `path` (tras subirlo, borrarlo o guardarlo)."""
+        path = os.path.abspath(path)
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self.invalidations += 1
+        if entry is not None:
+            entry.retire()
+
+    def invalidate_prefix(self, folder):
+        """Descarta todos los documentos dentro de una carpeta."""
+        folder = os.path.join(os.path.abspath(folder), '')
+        with self._lock:
+            paths = [p for p in self._entries if p.startswith(folder)]
+        for path in paths:
+            self.invalidate(path)
+
+    def page_count(self, path):
+        """Número de páginas de un PDF usando el pool."""
+        with self.acquire(path) as doc:
+            return len(doc)
+
+    def stats(self):
+        """Contadores de uso del pool."""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+# Pool compartido por todas las rutas del worker
+document_pool = DocumentPool()
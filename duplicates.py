@@ -0,0 +1,290 @@
+"""Páginas repetidas de un PDF, por hash de contenido y hash perceptual.
+
+Por cada página se calcula una huella en el pool de procesos de
+renderizado:
+
+- `content`: hash de lo que dibuja la página (content stream, recursos con
+  sus fuentes e imágenes, anotaciones, tamaño y rotación). Los objetos se
+  recorren siguiendo sus referencias, así que no dependen de los números de
+  objeto: la misma página copiada dentro del PDF, o en otro PDF, da el
+  mismo hash.
+- `changed`: qué fracción de una grilla de 64x64 promedios de gris cambió
+  respecto de la página anterior, más la tinta (para saltear hojas en
+  blanco) y un hash del texto, para las hojas escaneadas dos veces (dos
+  imágenes casi iguales pero no idénticas: el ruido del escáner se pierde
+  en los promedios).
+
+Las huellas se guardan por hash del PDF en `.pages/<hash>.json` dentro de
+la sesión. Con ellas `/duplicates/<filename>` marca las páginas repetidas, y
+la caché de renderizado enlaza (hardlink) las imágenes de las páginas con
+el mismo `content`: se renderizan y ocupan disco una sola vez, aunque cada
+una conserva su clave (y su ETag) por PDF y número de página.
+"""
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+from analysis import gray_image, ink_ratio, BLANK_INK
+from render_pool import render_engine
+from session_index import content_hash
+from storage import temp_path
+
+# Carpeta (dentro de la sesión) con las huellas de páginas
+FINGERPRINT_DIRNAME = '.pages'
+FINGERPRINT_VERSION = 1
+
+# Páginas por bloque enviado al pool de procesos
+FINGERPRINT_CHUNK_PAGES = 25
+
+# Lado menor (en píxeles) de la imagen en grises y celdas por lado de la grilla
+GRID_IMAGE_SIZE = 256
+GRID_SIZE = 64
+
+# Una celda cambió si difiere en más de esto (niveles de gris) de la página anterior
+DUPLICATE_CELL_DIFFERENCE = 24
+
+# Dos páginas seguidas son la misma hoja si, como mucho, cambió esta fracción de celdas
+DUPLICATE_CELLS_CHANGED = float(os.environ.get('DUPLICATE_CELLS_CHANGED', '0.0005'))
+
+# Huellas de PDFs que se mantienen en memoria
+FINGERPRINT_MEMO_SIZE = 64
+
+# Claves de una página que determinan lo que se dibuja
+_PAGE_KEYS = ('Resources', 'Annots', 'Group')
+
+# Referencia a otro objeto ("12 0 R")
+_REF_RE = re.compile(r"\b(\d+)\s+\d+\s+R\b")
+
+# Referencias hacia arriba (a la página o al árbol de páginas): no cambian el dibujo
+_BACKREF_RE = re.compile(r"/(?:P|Parent)\s+\d+\s+\d+\s+R\b")
+
+# Espacios en blanco de un content stream
+_SPACES_RE = re.compile(rb"\s+")
+
+_memo_lock = threading.Lock()
+_memo = OrderedDict()  # ruta de las huellas -> lista de huellas
+
+
+# ---------- Lado del proceso de renderizado ----------
+
+def _canonical(doc, source, memo, visiting):
+    """Texto de un objeto con cada referencia reemplazada por el hash del objeto."""
+    source = _BACKREF_RE.sub('', source)
+    return _REF_RE.sub(lambda m: _object_digest(doc, int(m.group(1)), memo, visiting), source)
+
+
+def _object_digest(doc, xref, memo, visiting):
+    """Hash de un objeto y de todo lo que referencia (sin números de objeto)."""
+    if xref in memo:
+        return memo[xref]
+    if xref in visiting:
+        return 'cycle'
+    visiting.add(xref)
+    digest = hashlib.sha1(_canonical(doc, doc.xref_object(xref, compressed=True),
+                                     memo, visiting).encode('utf-8'))
+    if doc.xref_is_stream(xref):
+        digest.update(doc.xref_stream_raw(xref))
+    visiting.discard(xref)
+    memo[xref] = digest.hexdigest()
+    return memo[xref]
+
+
+def _page_key(doc, xref, key):
+    """Valor de una clave de la página, heredado del árbol de páginas si falta."""
+    while True:
+        kind, value = doc.xref_get_key(xref, key)
+        if kind != 'null' or key != 'Resources':
+            return value
+        kind, parent = doc.xref_get_key(xref, 'Parent')
+        if kind != 'xref':
+            return value
+        xref = int(parent.split()[0])
+
+
+def page_digest(doc, page, memo):
+    """Hash de lo que dibuja una página (`memo` comparte objetos entre páginas).
+
+    El content stream se toma decodificado, concatenado y con los espacios
+    normalizados: da igual si está partido en varios objetos o comprimido de
+    otra forma (como al copiar páginas).
+    """
+    contents = b' '.join(doc.xref_stream(xref) or b'' for xref in page.get_contents())
+    digest = hashlib.sha1(_SPACES_RE.sub(b' ', contents).strip())
+    parts = [repr(tuple(page.mediabox)), repr(tuple(page.cropbox)), str(page.rotation)]
+    for key in _PAGE_KEYS:
+        parts.append(_canonical(doc, _page_key(doc, page.xref, key), memo, set()))
+    digest.update('\n'.join(parts).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _grid(gray):
+    """Promedios de gris (int16) de una grilla GRID_SIZE x GRID_SIZE sobre la imagen."""
+    h, w = gray.shape
+    rows = np.linspace(0, h, GRID_SIZE + 1, dtype=int)
+    cols = np.linspace(0, w, GRID_SIZE + 1, dtype=int)
+    sums = np.add.reduceat(np.add.reduceat(gray.astype(np.float32), rows[:-1], axis=0),
+                           cols[:-1], axis=1)
+    return (sums / np.outer(np.diff(rows), np.diff(cols))).round().astype(np.int16)
+
+
+def _page_gray(page):
+    """Página en grises con su lado menor de GRID_IMAGE_SIZE píxeles."""
+    width = GRID_IMAGE_SIZE * max(1.0, page.rect.width / page.rect.height)
+    with metrics.span('get_pixmap'):
+        return gray_image(page, width)
+
+
+def page_fingerprints(doc, first, last):
+    """Huellas de las páginas first..last (corre en el pool de procesos)."""
+    memo = {}
+    fingerprints = []
+    # La primera página del bloque se compara con la última del bloque anterior
+    previous = _grid(_page_gray(doc[first - 2])) if first > 1 else None
+    for page_num in range(first, min(last, len(doc)) + 1):
+        page = doc[page_num - 1]
+        with metrics.span('page_digest'):
+            content = page_digest(doc, page, memo)
+        gray = _page_gray(page)
+        grid = _grid(gray)
+        changed = None
+        if previous is not None:
+            changed = float((np.abs(grid - previous) > DUPLICATE_CELL_DIFFERENCE).mean())
+        previous = grid
+        text = ' '.join(page.get_text().lower().split())
+
+        fingerprints.append({
+            'page': page_num,
+            'content': content,
+            'changed': changed,
+            'ink': ink_ratio(gray),
+            'text': hashlib.sha1(text.encode('utf-8')).hexdigest() if text else None,
+            'size': [round(page.rect.width), round(page.rect.height), page.rotation],
+        })
+    return fingerprints
+
+
+# ---------- Huellas guardadas ----------
+
+def _fingerprint_path(user_folder, content):
+    return os.path.join(user_folder, FINGERPRINT_DIRNAME, f"{content}.json")
+
+
+def load_fingerprints(user_folder, content):
+    """Huellas de las páginas de un PDF (por su hash), o None si no están calculadas."""
+    path = _fingerprint_path(user_folder, content)
+    with _memo_lock:
+        if path in _memo:
+            _memo.move_to_end(path)
+            return _memo[path]
+
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get('version') != FINGERPRINT_VERSION:
+        return None
+    return _remember(path, data['pages'])
+
+
+def _remember(path, pages):
+    with _memo_lock:
+        _memo[path] = pages
+        _memo.move_to_end(path)
+        while len(_memo) > FINGERPRINT_MEMO_SIZE:
+            _memo.popitem(last=False)
+    return pages
+
+
+def save_fingerprints(user_folder, content, pages):
+    """Guarda las huellas de un PDF de forma atómica (temporal + rename)."""
+    path = _fingerprint_path(user_folder, content)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = temp_path(path)
+    with open(temp, 'w') as f:
+        json.dump({'version': FINGERPRINT_VERSION, 'pages': pages}, f)
+    os.replace(temp, path)
+    _remember(path, pages)
+
+
+def page_content(user_folder, content, page_num):
+    """Hash del contenido de una página, o None si el PDF no tiene huellas todavía."""
+    pages = load_fingerprints(user_folder, content)
+    if pages is None or not 1 <= page_num <= len(pages):
+        return None
+    return pages[page_num - 1]['content']
+
+
+# ---------- Páginas repetidas ----------
+
+def _same_sheet(a, b):
+    """True si dos páginas seguidas parecen la misma hoja escaneada dos veces."""
+    if a['size'] != b['size']:
+        return False
+    if a['text'] is not None and b['text'] is not None and a['text'] != b['text']:
+        return False
+    return b['changed'] is not None and b['changed'] <= DUPLICATE_CELLS_CHANGED
+
+
+def find_duplicates(pages):
+    """Páginas repetidas a partir de las huellas.
+
+    Devuelve [{'page', 'duplicate_of', 'match'}]: 'exact' si el contenido es
+    idéntico a una página anterior (en cualquier lugar del PDF), 'similar'
+    si es casi igual a la página anterior (hoja pasada dos veces por el
+    escáner). Las hojas en blanco (poca tinta y sin texto) no cuentan: suelen
+    ser separadores. Una hoja con poco texto (una carátula, una línea) sí.
+    """
+    first_seen = {}  # hash de contenido -> primera página
+    original = {}  # página repetida -> página original
+    duplicates = []
+    previous = None
+    for fp in pages:
+        if fp['ink'] < BLANK_INK and fp['text'] is None:
+            previous = None
+            continue
+        page = fp['page']
+        first = first_seen.setdefault(fp['content'], page)
+        if first != page:
+            original[page] = first
+            duplicates.append({'page': page, 'duplicate_of': first, 'match': 'exact'})
+        elif previous is not None and _same_sheet(previous, fp):
+            original[page] = original.get(previous['page'], previous['page'])
+            duplicates.append({'page': page, 'duplicate_of': original[page], 'match': 'similar'})
+        previous = fp
+    return duplicates
+
+
+# ---------- Trabajo en segundo plano ----------
+
+def fingerprint_job(job):
+    """Trabajo 'fingerprint': calcula las huellas de las páginas de un PDF.
+
+    Parámetros: {'filename', 'hash', 'pages'}. El resultado es
+    {'pages', 'duplicates'} (ver `find_duplicates`).
+    """
+    filename = job.params['filename']
+    content = job.params['hash']
+    total = job.params['pages']
+    path = os.path.join(job.user_folder, filename)
+
+    pages = load_fingerprints(job.user_folder, content)
+    if pages is None:
+        pages = []
+        job.progress(0, total)
+        for first in range(1, total + 1, FINGERPRINT_CHUNK_PAGES):
+            if content_hash(job.user_folder, filename) != content:
+                raise RuntimeError('El PDF cambió mientras se analizaba')
+            last = min(first + FINGERPRINT_CHUNK_PAGES - 1, total)
+            pages.extend(render_engine.run_background(page_fingerprints, path, first, last,
+                                                      check=job.check_cancelled))
+            job.progress(last)
+        save_fingerprints(job.user_folder, content, pages)
+
+    return {'pages': total, 'duplicates': find_duplicates(pages)}
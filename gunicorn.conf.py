@@ -0,0 +1,10 @@
+"""Configuración de gunicorn (se carga sola desde el directorio de trabajo).
+
+Las opciones de arranque siguen en el Procfile / railway.json; acá solo se
+inicia el hilo de limpieza de sesiones en cada worker (solo el líder barre).
+"""
+
+
+def post_worker_init(worker):
+    from app import start_cleanup_thread
+    start_cleanup_thread()
@@ -0,0 +1,348 @@
+"""Cola de trabajos en segundo plano (exportar, dividir, analizar, compactar).
+
+Las tareas largas no corren dentro de la petición: la ruta crea un trabajo y
+devuelve su id, y el cliente consulta `/jobs/<id>` (o escucha
+`/jobs/<id>/events`) hasta que termina. Cada trabajo guarda su estado en
+`.jobs/<id>.json` dentro de la sesión:
+
+  {'id', 'kind', 'key', 'params', 'status', 'done', 'total', 'message',
+   'result', 'error', 'attempts', 'created_at', 'updated_at'}
+
+con status 'queued' | 'running' | 'done' | 'error' | 'cancelled'.
+
+Como el estado está en disco, cualquier worker de gunicorn puede responder
+por un trabajo, y los trabajos que quedaron a medias porque su worker se
+reinició se retoman: un trabajo en curso cuyo estado no se actualiza hace
+más de JOB_STALE_SECONDS se vuelve a encolar (las tareas deben poder
+repetirse desde cero sin problema). Para que dos workers no retomen el mismo
+trabajo, cada intento se reclama creando `.jobs/<id>.claim-<n>` en exclusiva;
+para que no creen dos veces el mismo trabajo (misma `key`), `submit` toma
+el lock `.jobs/.submit.lock`.
+
+La cancelación crea `.jobs/<id>.cancel`; la tarea lo ve la próxima vez que
+informa su progreso.
+"""
+import os
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import file_lock
+
+# Carpeta (dentro de la sesión) con el estado de los trabajos
+JOBS_DIRNAME = '.jobs'
+
+# Hilos que ejecutan trabajos (por worker)
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+
+# Cada cuánto el worker confirma que sus trabajos siguen vivos
+JOB_HEARTBEAT_SECONDS = 10
+
+# Un trabajo sin novedades durante este tiempo se considera huérfano
+JOB_STALE_SECONDS = 60
+
+# Intentos máximos de un trabajo (contando los retomados)
+JOB_MAX_ATTEMPTS = 3
+
+# Los trabajos terminados se borran después de este tiempo
+JOB_RETENTION_SECONDS = 24 * 60 * 60  # 1 día
+
+ACTIVE_STATUSES = ('queued', 'running')
+FINISHED_STATUSES = ('done', 'error', 'cancelled')
+
+
+class JobCancelled(Exception):
+    """El usuario canceló el trabajo."""
+
+
+class JobError(Exception):
+    """Error de la API de trabajos (id inválido, trabajo inexistente)."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _jobs_folder(user_folder):
+    return os.path.join(user_folder, JOBS_DIRNAME)
+
+
+def _job_path(user_folder, job_id, suffix='.json'):
+    # El id se usa en rutas de archivo: solo se aceptan ids generados por nosotros
+    try:
+        job_id = uuid.UUID(job_id).hex
+    except (ValueError, TypeError, AttributeError):
+        raise JobError('Trabajo no encontrado', 404)
+    return os.path.join(_jobs_folder(user_folder), f"{job_id}{suffix}")
+
+
+def read_job(user_folder, job_id):
+    """Estado de un trabajo (lanza JobError 404 si no existe)."""
+    try:
+        with open(_job_path(user_folder, job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        raise JobError('Trabajo no encontrado', 404)
+
+
+def _write_job(user_folder, state):
+    path = _job_path(user_folder, state['id'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    state['updated_at'] = time.time()
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(temp_path, path)
+
+
+def list_jobs(user_folder):
+    """Trabajos de una sesión, del más nuevo al más viejo."""
+    jobs = []
+    folder = _jobs_folder(user_folder)
+    if not os.path.isdir(folder):
+        return jobs
+    for f in os.listdir(folder):
+        if not f.endswith('.json'):
+            continue
+        try:
+            jobs.append(read_job(user_folder, f[:-len('.json')]))
+        except JobError:
+            pass
+    jobs.sort(key=lambda j: j['created_at'], reverse=True)
+    return jobs
+
+
+def is_finished(state):
+    return state['status'] in FINISHED_STATUSES
+
+
+def _is_stale(state):
+    return (state['status'] in ACTIVE_STATUSES
+            and time.time() - state['updated_at'] > JOB_STALE_SECONDS)
+
+
+class Job:
+    """Trabajo en ejecución: lo que recibe la función de cada tipo de trabajo."""
+
+    def __init__(self, queue, user_folder, state):
+        self.queue = queue
+        self.user_folder = user_folder
+        self.state = state
+        self.id = state['id']
+        self.kind = state['kind']
+        self.params = state['params']
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return os.path.exists(_job_path(self.user_folder, self.id, '.cancel'))
+
+    def check_cancelled(self):
+        """Lanza JobCancelled si el usuario pidió cancelar."""
+        if self.cancelled:
+            raise JobCancelled()
+
+    def progress(self, done, total=None, message=None):
+        """Informa el progreso (y corta el trabajo si se canceló)."""
+        self.check_cancelled()
+        with self._lock:
+            self.state['done'] = done
+            if total is not None:
+                self.state['total'] = total
+            if message is not None:
+                self.state['message'] = message
+            _write_job(self.user_folder, self.state)
+
+    def _finish(self, status, **fields):
+        with self._lock:
+            self.state['status'] = status
+            self.state.update(fields)
+            _write_job(self.user_folder, self.state)
+
+    def _heartbeat(self):
+        with self._lock:
+            if self.state['status'] in ACTIVE_STATUSES:
+                _write_job(self.user_folder, self.state)
+
+
+class JobQueue:
+    """Ejecuta trabajos en un pool de hilos, con estado persistente por sesión."""
+
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        self._handlers = {}  # tipo -> función(job) que devuelve el resultado
+        self._lock = threading.Lock()
+        self._executor = None
+        self._heartbeat_thread = None
+        self._active = {}  # id -> Job (en este worker)
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.resumed = 0
+
+    def register(self, kind, handler):
+        """Registra la función que ejecuta los trabajos de un tipo."""
+        self._handlers[kind] = handler
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='job'
+                )
+                self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+                self._heartbeat_thread.start()
+            return self._executor
+
+    def submit(self, user_folder, kind, params, key=None, reuse_done=False):
+        """Crea (y encola) un trabajo y devuelve su estado.
+
+        Si ya hay uno activo con la misma `key` se devuelve ese; con
+        `reuse_done=True` también se reutiliza uno terminado con éxito. La
+        búsqueda y la creación van bajo un lock de la carpeta de trabajos,
+        así dos workers no crean el mismo trabajo a la vez.
+        """
+        if kind not in self._handlers:
+            raise JobError(f'Tipo de trabajo desconocido: {kind}')
+
+        with self._lock, file_lock(os.path.join(_jobs_folder(user_folder), 'submit')):
+            if key is not None:
+                for state in list_jobs(user_folder):
+                    if state.get('key') != key:
+                        continue
+                    if state['status'] in ACTIVE_STATUSES and not _is_stale(state):
+                        return state
+                    if reuse_done and state['status'] == 'done':
+                        return state
+
+            now = time.time()
+            state = {
+                'id': uuid.uuid4().hex,
+                'kind': kind,
+                'key': key,
+                'params': params,
+                'status': 'queued',
+                'done': 0,
+                'total': None,
+                'message': None,
+                'result': None,
+                'error': None,
+                'attempts': 0,
+                'created_at': now,
+            }
+            _write_job(user_folder, state)
+            self.submitted += 1
+
+        self._start(user_folder, state)
+        return state
+
+    def _claim(self, user_folder, state):
+        """Reclama el próximo intento de un trabajo (solo un worker lo consigue)."""
+        attempt = state['attempts'] + 1
+        try:
+            fd = os.open(_job_path(user_folder, state['id'], f'.claim-{attempt}'),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.close(fd)
+        state['attempts'] = attempt
+        return True
+
+    def _start(self, user_folder, state):
+        if not self._claim(user_folder, state):
+            return
+        job = Job(self, user_folder, state)
+        with self._lock:
+            self._active[job.id] = job
+        self._get_executor().submit(self._run, job)
+
+    def _run(self, job):
+        try:
+            job.check_cancelled()
+            job._finish('running')
+            result = self._handlers[job.kind](job)
+            job._finish('done', result=result)
+            self.completed += 1
+        except JobCancelled:
+            job._finish('cancelled')
+            self.cancelled += 1
+        except Exception as e:
+            print(f"Error en el trabajo {job.kind} {job.id}: {e}")
+            job._finish('error', error=str(e))
+            self.failed += 1
+        finally:
+            with self._lock:
+                self._active.pop(job.id, None)
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(JOB_HEARTBEAT_SECONDS)
+            with self._lock:
+                jobs = list(self._active.values())
+            for job in jobs:
+                try:
+                    job._heartbeat()
+                except OSError:
+                    pass
+
+    def cancel(self, user_folder, job_id):
+        """Pide cancelar un trabajo y devuelve su estado."""
+        state = read_job(user_folder, job_id)
+        if is_finished(state):
+            return state
+        open(_job_path(user_folder, job_id, '.cancel'), 'a').close()
+        if state['status'] == 'queued' and _is_stale(state):
+            # Nadie lo está ejecutando: marcarlo cancelado directamente
+            state['status'] = 'cancelled'
+            _write_job(user_folder, state)
+        return state
+
+    def resume_orphaned(self, user_folder):
+        """Retoma los trabajos de una sesión que quedaron a medias en otro worker."""
+        for state in list_jobs(user_folder):
+            if not _is_stale(state) or state['id'] in self._active:
+                continue
+            if state['kind'] not in self._handlers:
+                continue
+            if state['attempts'] >= JOB_MAX_ATTEMPTS:
+                state['status'] = 'error'
+                state['error'] = 'El trabajo se interrumpió demasiadas veces'
+                _write_job(user_folder, state)
+                continue
+            state['status'] = 'queued'
+            self.resumed += 1
+            self._start(user_folder, state)
+
+    def cleanup(self, user_folder, max_age=JOB_RETENTION_SECONDS):
+        """Borra los trabajos terminados hace más de `max_age` y retoma los huérfanos."""
+        folder = _jobs_folder(user_folder)
+        if not os.path.isdir(folder):
+            return
+        now = time.time()
+        for state in list_jobs(user_folder):
+            if is_finished(state) and now - state['updated_at'] > max_age:
+                prefix = state['id']
+                for f in os.listdir(folder):
+                    if f.startswith(prefix):
+                        try:
+                            os.remove(os.path.join(folder, f))
+                        except OSError:
+                            pass
+        self.resume_orphaned(user_folder)
+
+    def stats(self):
+        """Contadores de la cola de trabajos."""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'active': len(self._active),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'cancelled': self.cancelled,
+                'resumed': self.resumed,
+            }
@@ -0,0 +1,470 @@
+"""Métricas al estilo Prometheus y perfilado de peticiones puntuales.
+
+Cada proceso acumula sus métricas en memoria: contadores (`inc`) e
+histogramas (`observe`, y `span(nombre)` para medir un bloque: fitz.open,
+get_pixmap, codificación, insert_pdf, save, escritura del ZIP). Los procesos
+de renderizado devuelven lo que midieron junto con el resultado (`drain`) y
+el worker lo suma a su registro (`merge`).
+
+Cada worker de gunicorn vuelca su registro, como mucho cada
+METRICS_FLUSH_INTERVAL segundos, en `pdfs/.metrics/<host>-<pid>.json`;
+`/metrics` suma los archivos de los workers vivos del nodo y responde en el
+formato de texto de Prometheus. Los valores de cada worker son acumulados
+desde que arrancó: si un worker se reinicia, sus contadores vuelven a cero
+(Prometheus lo trata como un reinicio de contador).
+
+Perfilado: con PROFILE_TOKEN configurado, una petición con `?profile=1` y la
+cabecera `X-Profile-Token` corre bajo cProfile y deja las estadísticas en
+`pdfs/.profiles/`. Con PROFILE_SAMPLE_RATE además se perfila una fracción de
+las peticiones y se guardan solo las que tardan más que PROFILE_SLOW_SECONDS.
+"""
+import io
+import os
+import json
+import time
+import hmac
+import pstats
+import random
+import socket
+import cProfile
+import threading
+from contextlib import contextmanager
+
+from storage import temp_path
+
+# Registrar métricas (0 = desactivado; `span` no mide nada)
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+
+# Carpeta (dentro de la carpeta base) con el volcado de cada worker
+METRICS_DIRNAME = '.metrics'
+
+# Segundos mínimos entre volcados de un worker
+METRICS_FLUSH_INTERVAL = 5
+
+# Límites de los histogramas de duración, en segundos
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Token que habilita el perfilado de una petición (vacío = desactivado)
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+
+# Fracción de las peticiones que se perfila sola (0 = solo a pedido)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+
+# Las peticiones perfiladas por muestreo solo se guardan si tardan más que esto
+PROFILE_SLOW_SECONDS = float(os.environ.get('PROFILE_SLOW_SECONDS', '1'))
+
+# Carpeta (dentro de la carpeta base) con los perfiles y cuántos se conservan
+PROFILE_DIRNAME = '.profiles'
+PROFILE_KEEP = 50
+
+# Nombre -> (tipo, ayuda) de cada métrica
+METRICS = {
+    'pdfsorter_http_request_duration_seconds': (
+        'histogram', 'Duración de las peticiones por ruta, método y estado'),
+    'pdfsorter_http_response_bytes_total': (
+        'counter', 'Bytes enviados por ruta (cuerpos con Content-Length)'),
+    'pdfsorter_span_duration_seconds': (
+        'histogram', 'Duración de operaciones internas (fitz_open, get_pixmap, encode_*, insert_pdf, save, zip_write)'),
+    'pdfsorter_cache_requests_total': (
+        'counter', 'Consultas a cachés por resultado (hit/miss)'),
+    'pdfsorter_bytes_written_total': (
+        'counter', 'Bytes escritos a disco por tipo'),
+    'pdfsorter_duplicate_uploads_total': (
+        'counter', 'Subidas idénticas a otro PDF de la sesión (guardadas como hardlink)'),
+    'pdfsorter_deduplicated_bytes_total': (
+        'counter', 'Bytes de subidas repetidas que no ocupan disco'),
+    'pdfsorter_doc_pool_documents': (
+        'gauge', 'Documentos abiertos en los pools de los workers'),
+    'pdfsorter_doc_pool_requests_total': (
+        'counter', 'Préstamos del pool de documentos por resultado (hit/miss)'),
+    'pdfsorter_doc_pool_evictions_total': (
+        'counter', 'Documentos desalojados del pool'),
+    'pdfsorter_render_queue_depth': (
+        'gauge', 'Renders en vuelo en los motores de renderizado'),
+    'pdfsorter_render_rejected_total': (
+        'counter', 'Renders rechazados por cola llena (503)'),
+    'pdfsorter_workers': (
+        'gauge', 'Procesos que reportaron métricas'),
+    'pdfsorter_sessions': (
+        'gauge', 'Sesiones en el índice de último acceso'),
+    'pdfsorter_disk_usage_bytes': (
+        'gauge', 'Espacio usado por las sesiones (medido en el último barrido de limpieza)'),
+    'pdfsorter_disk_cache_bytes': (
+        'gauge', 'Parte del espacio usado que son cachés descartables'),
+    'pdfsorter_disk_free_bytes': (
+        'gauge', 'Espacio libre en el disco de la carpeta base'),
+}
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Registry:
+    """Contadores e histogramas de un proceso, seguros entre hilos."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}  # (nombre, etiquetas) -> valor
+        self.histograms = {}  # (nombre, etiquetas) -> [cuenta por límite..., +Inf, suma]
+
+    def inc(self, name, value=1, labels=()):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(DURATION_BUCKETS) + 2)
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    hist[i] += 1
+                    break
+            else:
+                hist[len(DURATION_BUCKETS)] += 1
+            hist[-1] += value
+
+    def snapshot(self, reset=False):
+        """Contenido del registro en forma serializable (JSON o pickle)."""
+        with self._lock:
+            data = {
+                'counters': [[n, [list(p) for p in l], v] for (n, l), v in self.counters.items()],
+                'histograms': [[n, [list(p) for p in l], list(h)]
+                               for (n, l), h in self.histograms.items()],
+            }
+            if reset:
+                self.counters = {}
+                self.histograms = {}
+        return data
+
+    def merge(self, data):
+        """Suma al registro un `snapshot` de otro proceso."""
+        with self._lock:
+            for name, labels, value in data.get('counters', []):
+                key = (name, tuple(tuple(p) for p in labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, values in data.get('histograms', []):
+                key = (name, tuple(tuple(p) for p in labels))
+                hist = self.histograms.get(key)
+                if hist is None:
+                    self.histograms[key] = list(values)
+                else:
+                    for i, v in enumerate(values):
+                        hist[i] += v
+
+
+registry = Registry()
+
+_collectors = []  # funciones que devuelven [(nombre, etiquetas, valor)] del proceso
+
+
+def inc(name, value=1, **labels):
+    """Suma `value` a un contador."""
+    if METRICS_ENABLED:
+        registry.inc(name, value, _labels_key(labels))
+
+
+def observe(name, value, **labels):
+    """Registra una observación (en segundos) en un histograma."""
+    if METRICS_ENABLED:
+        registry.observe(name, value, _labels_key(labels))
+
+
+@contextmanager
+def span(name):
+    """Mide la duración del bloque como `pdfsorter_span_duration_seconds{span=name}`."""
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe('pdfsorter_span_duration_seconds', time.perf_counter() - start,
+                         (('span', name),))
+
+
+def timed(iterable, name):
+    """Recorre `iterable` midiendo (como un span) solo el tiempo que tarda en producir.
+
+    Para respuestas en streaming: no cuenta el tiempo que espera el cliente.
+    """
+    if not METRICS_ENABLED:
+        yield from iterable
+        return
+    busy = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                busy += time.perf_counter() - start
+            yield item
+    finally:
+        registry.observe('pdfsorter_span_duration_seconds', busy, (('span', name),))
+
+
+def drain():
+    """Devuelve y vacía lo medido en este proceso (lo usan los procesos de renderizado)."""
+    return registry.snapshot(reset=True)
+
+
+def merge(data):
+    """Suma al registro de este proceso lo medido en otro (`drain`)."""
+    if data:
+        registry.merge(data)
+
+
+def register_collector(func):
+    """Registra `func()` -> [(nombre, {etiquetas}, valor)], que se evalúa al volcar.
+
+    Sirve para exponer contadores que ya existen en otros módulos (pool de
+    documentos, motor de renderizado) sin instrumentarlos de nuevo.
+    """
+    _collectors.append(func)
+
+
+# ---------- Volcado y exposición ----------
+
+_HOST = socket.gethostname()
+_flush_lock = threading.Lock()
+_last_flush = [0.0]
+_pending_flush = [None]  # carpeta base con cambios sin volcar (o None)
+_flusher = [None]
+
+
+def _metrics_dir(base_folder):
+    return os.path.join(base_folder, METRICS_DIRNAME)
+
+
+def flush(base_folder, force=False):
+    """Vuelca el registro de este proceso a disco (como mucho cada METRICS_FLUSH_INTERVAL).
+
+    Si todavía no toca, el volcado queda pendiente y lo hace un hilo al
+    cumplirse el intervalo (así un worker inactivo no queda desactualizado).
+    """
+    if not METRICS_ENABLED:
+        return
+    now = time.monotonic()
+    with _flush_lock:
+        if not force and now - _last_flush[0] < METRICS_FLUSH_INTERVAL:
+            _pending_flush[0] = base_folder
+            if _flusher[0] is None:
+                _flusher[0] = threading.Thread(target=_flush_pending, daemon=True)
+                _flusher[0].start()
+            return
+        _last_flush[0] = now
+        _pending_flush[0] = None
+
+    data = registry.snapshot()
+    data['collected'] = []
+    for collector in _collectors:
+        try:
+            for name, labels, value in collector():
+                data['collected'].append([name, [list(p) for p in _labels_key(labels)], value])
+        except Exception as e:
+            print(f"Error al recolectar métricas: {e}")
+
+    folder = _metrics_dir(base_folder)
+    path = os.path.join(folder, f"{_HOST}-{os.getpid()}.json")
+    try:
+        os.makedirs(folder, exist_ok=True)
+        temp = temp_path(path)
+        with open(temp, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp, path)
+    except OSError as e:
+        print(f"Error al guardar métricas: {e}")
+
+
+def _flush_pending():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        base_folder = _pending_flush[0]
+        if base_folder is not None:
+            flush(base_folder, force=True)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _load_node(base_folder):
+    """Suma los volcados de los procesos vivos de este nodo (borra los de procesos muertos)."""
+    total = Registry()
+    gauges = {}  # (nombre, etiquetas) -> valor
+    workers = 0
+    folder = _metrics_dir(base_folder)
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        names = []
+
+    for name in names:
+        host, _, pid = name[:-len('.json')].rpartition('-') if name.endswith('.json') else ('', '', '')
+        if host != _HOST or not pid.isdigit():
+            continue
+        path = os.path.join(folder, name)
+        if not _pid_alive(int(pid)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        total.merge(data)
+        for metric, labels, value in data.get('collected', []):
+            key = (metric, tuple(tuple(p) for p in labels))
+            gauges[key] = gauges.get(key, 0) + value
+        workers += 1
+
+    gauges[('pdfsorter_workers', ())] = workers
+    return total, gauges
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render(base_folder, gauges=None):
+    """Texto de /metrics (formato Prometheus) con lo de todos los workers del nodo.
+
+    `gauges` agrega valores del nodo que no son de un worker (sesiones,
+    disco), como lista de (nombre, {etiquetas}, valor).
+    """
+    flush(base_folder, force=True)
+    total, collected = _load_node(base_folder)
+    for name, labels, value in gauges or []:
+        collected[(name, _labels_key(labels))] = value
+
+    samples = {}  # nombre -> [líneas]
+    for (name, labels), value in sorted(total.counters.items()):
+        samples.setdefault(name, []).append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    for (name, labels), value in sorted(collected.items()):
+        samples.setdefault(name, []).append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    for (name, labels), hist in sorted(total.histograms.items()):
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(DURATION_BUCKETS + ('+Inf',), hist[:-1]):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, (('le', bound),))} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(float(hist[-1]))}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+    out = []
+    for name in sorted(samples):
+        kind, help_text = METRICS.get(name, ('untyped', ''))
+        if help_text:
+            out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {kind}")
+        out.extend(samples[name])
+    return '\n'.join(out) + '\n'
+
+
+# ---------- Perfilado ----------
+
+# cProfile no admite dos perfiles activos a la vez (Python 3.12): de a uno por proceso
+_profile_lock = threading.Lock()
+
+
+def profile_requested(args, headers):
+    """Indica si la petición pidió perfilarse (`?profile=1` con el token correcto)."""
+    if not PROFILE_TOKEN or not args.get('profile'):
+        return False
+    token = headers.get('X-Profile-Token', '')
+    return hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode())
+
+
+def start_profile(requested):
+    """Empieza a perfilar si se pidió o si toca por muestreo.
+
+    Devuelve (profiler, pedido) o None si no se perfila (o ya hay otro en curso).
+    """
+    if not requested and not (PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE):
+        return None
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Otra herramienta de perfilado ya está activa
+        _profile_lock.release()
+        return None
+    return profiler, requested
+
+
+def discard_profile(state):
+    """Termina un perfil sin guardarlo (la petición falló antes de terminar)."""
+    profiler, _ = state
+    try:
+        profiler.disable()
+    finally:
+        _profile_lock.release()
+
+
+def finish_profile(state, base_folder, label, elapsed):
+    """Termina un perfil; lo guarda si se pidió o si la petición fue lenta.
+
+    Devuelve el nombre del archivo `.prof` o None si no se guardó.
+    """
+    profiler, requested = state
+    try:
+        profiler.disable()
+    finally:
+        _profile_lock.release()
+    if not requested and elapsed < PROFILE_SLOW_SECONDS:
+        return None
+
+    folder = os.path.join(base_folder, PROFILE_DIRNAME)
+    safe_label = ''.join(c if c.isalnum() else '_' for c in label).strip('_')[:60]
+    filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{int(elapsed * 1000)}ms-{safe_label}.prof"
+    try:
+        os.makedirs(folder, exist_ok=True)
+        profiler.dump_stats(os.path.join(folder, filename))
+        _prune_profiles(folder)
+    except OSError as e:
+        print(f"Error al guardar el perfil: {e}")
+        return None
+
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+    print(f"Perfil de {label} ({elapsed:.3f}s) guardado en {filename}\n{summary.getvalue()}")
+    return filename
+
+
+def _prune_profiles(folder):
+    profiles = sorted(f for f in os.listdir(folder) if f.endswith('.prof'))
+    for name in profiles[:-PROFILE_KEEP]:
+        try:
+            os.remove(os.path.join(folder, name))
+        except OSError:
+            pass
@@ -0,0 +1,191 @@
+"""Renderizado adaptativo de páginas para /page.
+
+El tamaño sale del ancho (`w`) o DPI (`dpi`) que pide el visor, y el formato
+de lo que hay en la página y de lo que acepta el navegador:
+
+- Páginas escaneadas (una imagen cubre casi toda la página): JPEG o WebP con
+  la calidad pedida; si la imagen escaneada es de 1 bit, PNG blanco y negro.
+- Páginas de texto o vectoriales: PNG (nítido y comprime bien).
+- Si la página no tiene color se renderiza directamente en escala de grises.
+- La vista previa (`preview=1`) es siempre una imagen chica con pérdida.
+
+La clasificación de cada página se guarda aparte en la caché; con ella y las
+opciones de la petición se arma la descripción que va en la cabecera
+X-Render-Options, y esa misma descripción forma parte de la clave de caché.
+
+Las funciones de renderizado corren dentro de los procesos de `render_pool`.
+"""
+import io
+import os
+import math
+from collections import namedtuple
+
+import fitz  # PyMuPDF
+
+import metrics
+from thumbnails import choose_format
+
+try:
+    from PIL import Image  # Opcional: WebP y PNG de 1 bit
+except ImportError:
+    Image = None
+
+# Resolución por defecto (equivale al zoom 2.0 de antes) y límites
+PAGE_DEFAULT_DPI = 144
+PAGE_MIN_DPI = 36
+PAGE_MAX_DPI = 600
+
+# Límites del ancho pedido; se redondea a múltiplos del paso (menos variantes en caché)
+PAGE_MIN_WIDTH = 200
+PAGE_MAX_WIDTH = 5000
+PAGE_WIDTH_STEP = 100
+
+# Tope de píxeles de una página renderizada (protege la memoria con páginas enormes)
+PAGE_MAX_PIXELS = 40 * 1000 * 1000
+
+# Calidad por defecto y límites para JPEG/WebP
+PAGE_QUALITY = int(os.environ.get('PAGE_QUALITY', '80'))
+PAGE_MIN_QUALITY = 30
+PAGE_MAX_QUALITY = 95
+
+# Vista previa rápida que el visor muestra mientras llega la página completa
+PAGE_PREVIEW_DPI = 48
+PAGE_PREVIEW_QUALITY = 40
+
+# Fracción de la página cubierta por imágenes para considerarla escaneada
+SCANNED_COVERAGE = 0.5
+
+# Un píxel es "de color" si sus canales difieren más que esto
+COLOR_TOLERANCE = 24
+
+# Fracción máxima de píxeles de color para tratar la página como gris
+COLOR_PIXELS_MAX = 0.002
+
+# Zoom del render de muestra usado para detectar color
+PROBE_ZOOM = 0.2
+
+MIMETYPES = {'png': 'image/png', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+# Opciones de una petición a /page (dpi o width, nunca ambos)
+RenderOptions = namedtuple('RenderOptions', 'dpi width quality webp preview')
+
+# Opciones sin parámetros en la petición (para el pre-renderizado sin visor)
+DEFAULT_OPTIONS = RenderOptions(PAGE_DEFAULT_DPI, None, PAGE_QUALITY, False, False)
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+def preview_options(webp):
+    """Opciones de la vista previa de una página (`preview=1`)."""
+    return RenderOptions(PAGE_PREVIEW_DPI, None, PAGE_PREVIEW_QUALITY, webp, True)
+
+
+def parse_options(args, accept_mimetypes):
+    """Arma las opciones de renderizado a partir de la query string y de Accept."""
+    webp = choose_format(accept_mimetypes) == 'webp'
+    if args.get('preview'):
+        return preview_options(webp)
+
+    quality = _clamp(args.get('q', PAGE_QUALITY, type=int), PAGE_MIN_QUALITY, PAGE_MAX_QUALITY)
+    width = args.get('w', type=int)
+    if width:
+        width = _clamp(width, PAGE_MIN_WIDTH, PAGE_MAX_WIDTH)
+        width = -(-width // PAGE_WIDTH_STEP) * PAGE_WIDTH_STEP
+        return RenderOptions(None, width, quality, webp, False)
+
+    dpi = _clamp(args.get('dpi', PAGE_DEFAULT_DPI, type=int), PAGE_MIN_DPI, PAGE_MAX_DPI)
+    return RenderOptions(dpi, None, quality, webp, False)
+
+
+def classify_page(page):
+    """Clasifica una página: {'color': 'color'|'gray'|'bilevel', 'scanned': bool}."""
+    area = abs(page.rect)
+    covered = 0
+    one_bit = True
+    for img in page.get_images(full=True):
+        xref, bpc = img[0], img[4]
+        for rect in page.get_image_rects(xref):
+            covered += abs(rect & page.rect)
+        if bpc != 1:
+            one_bit = False
+    scanned = area > 0 and covered >= SCANNED_COVERAGE * area
+
+    probe = page.get_pixmap(matrix=fitz.Matrix(PROBE_ZOOM, PROBE_ZOOM), alpha=False)
+    colorful = sum(count for color, count in probe.color_count(colors=True).items()
+                   if max(color) - min(color) > COLOR_TOLERANCE)
+
+    if colorful > COLOR_PIXELS_MAX * probe.width * probe.height:
+        color = 'color'
+    elif scanned and one_bit:
+        color = 'bilevel'
+    else:
+        color = 'gray'
+    return {'color': color, 'scanned': scanned}
+
+
+def pick_format(page_class, options):
+    """Elige el formato de salida según la clase de la página y las opciones."""
+    if page_class['color'] == 'bilevel' and not options.preview:
+        return 'png'
+    if options.preview or page_class['scanned']:
+        return 'webp' if options.webp else 'jpeg'
+    return 'png'
+
+
+def describe(options, page_class, fmt):
+    """Descripción de las elecciones de renderizado (cabecera y clave de caché)."""
+    size = f"width={options.width}" if options.width else f"dpi={options.dpi}"
+    parts = [size, f"format={fmt}", f"color={page_class['color']}"]
+    if fmt != 'png':
+        parts.append(f"quality={options.quality}")
+    if options.preview:
+        parts.append('preview')
+    return '; '.join(parts)
+
+
+def _encode(pix, fmt, color, quality):
+    if fmt == 'jpeg':
+        return pix.tobytes('jpeg', jpg_quality=quality)
+    if fmt == 'webp':
+        img = Image.frombytes('L' if pix.n == 1 else 'RGB', (pix.width, pix.height), pix.samples)
+        buf = io.BytesIO()
+        img.save(buf, 'WEBP', quality=quality)
+        return buf.getvalue()
+    if color == 'bilevel' and Image is not None:
+        # PNG de 1 bit: mucho más chico que escala de grises para escaneos B/N
+        img = Image.frombytes('L', (pix.width, pix.height), pix.samples)
+        buf = io.BytesIO()
+        img.point(lambda v: 255 if v >= 128 else 0, mode='1').save(buf, 'PNG', optimize=True)
+        return buf.getvalue()
+    return pix.tobytes('png')
+
+
+def render_page(doc, page_num, options, page_class=None):
+    """Renderiza una página con las opciones dadas.
+
+    Devuelve None si la página no existe, o {'class', 'format', 'options',
+    'data'}; si no se pasa `page_class`, la página se clasifica primero.
+    """
+    if page_num < 1 or page_num > len(doc):
+        return None
+    page = doc[page_num - 1]  # PyMuPDF usa índices base 0
+    if page_class is None:
+        page_class = classify_page(page)
+    fmt = pick_format(page_class, options)
+
+    zoom = options.width / page.rect.width if options.width else options.dpi / 72
+    zoom = min(zoom, math.sqrt(PAGE_MAX_PIXELS / max(1.0, abs(page.rect))))
+    colorspace = fitz.csRGB if page_class['color'] == 'color' else fitz.csGRAY
+    with metrics.span('get_pixmap'):
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace, alpha=False)
+    with metrics.span(f'encode_{fmt}'):
+        data = _encode(pix, fmt, page_class['color'], options.quality)
+
+    return {
+        'class': page_class,
+        'format': fmt,
+        'options': describe(options, page_class, fmt),
+        'data': data,
+    }
@@ -0,0 +1,143 @@
+"""Pre-renderizado en segundo plano de las páginas que siguen al cursor del sorter.
+
+Cuando el sorter pide la página n, se encolan n+1 … n+k para que estén en la
+caché de renderizado antes de que el usuario avance. Si el usuario salta a otra
+parte del documento (o sale del sorter) los trabajos pendientes se cancelan.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Hilos dedicados a pre-renderizar (por worker); pocos para no competir con las
+# peticiones en primer plano
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', '1'))
+
+# Cuántas páginas por delante del cursor se pre-renderizan
+PREFETCH_AHEAD = int(os.environ.get('PREFETCH_AHEAD', '3'))
+
+# Máximo de trabajos encolados en total (por worker)
+PREFETCH_MAX_PENDING = int(os.environ.get('PREFETCH_MAX_PENDING', '64'))
+
+# Máximo de documentos con cursor recordado
+PREFETCH_MAX_CURSORS = 256
+
+
+class _Cursor:
+    """Posición del sorter en un documento y sus trabajos pendientes."""
+
+    def __init__(self, page_num, options=None):
+        self.page = page_num
+        self.options = options
+        self.generation = 0
+        self.futures = {}  # página -> Future
+
+
+class PrefetchQueue:
+    """Cola acotada de pre-renderizado con cancelación por salto de página."""
+
+    def __init__(self, warm_fn, workers=PREFETCH_WORKERS, ahead=PREFETCH_AHEAD,
+                 max_pending=PREFETCH_MAX_PENDING):
+        self.warm_fn = warm_fn
+        self.workers = workers
+        self.ahead = ahead
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._executor = None
+        self._cursors = {}  # (carpeta, archivo) -> _Cursor
+        self._pending = 0
+        self.scheduled = 0
+        self.completed = 0
+        self.cancelled = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix='prefetch'
+            )
+        return self._executor
+
+    def schedule(self, user_folder, filename, page_num, total_pages=None, options=None):
+        """Mueve el cursor a page_num y encola las páginas siguientes.
+
+        `options` se pasa tal cual a `warm_fn` (las opciones de renderizado
+        con las que el visor pide las páginas).
+        """
+        if self.workers <= 0 or self.ahead <= 0:
+            return
+
+        key = (user_folder, filename)
+        last_page = page_num + self.ahead
+        if total_pages is not None:
+            last_page = min(last_page, total_pages)
+
+        with self._lock:
+            cursor = self._cursors.get(key)
+            if cursor is None:
+                if len(self._cursors) >= PREFETCH_MAX_CURSORS:
+                    self._drop_idle_cursors()
+                cursor = self._cursors[key] = _Cursor(page_num, options)
+            elif (not (cursor.page - 1 <= page_num <= cursor.page + self.ahead)
+                  or cursor.options != options):
+                # Salto (o cambio de tamaño del visor): lo encolado ya no sirve
+                self._cancel_cursor(cursor)
+            cursor.page = page_num
+            cursor.options = options
+
+            for p in range(page_num + 1, last_page + 1):
+                if p in cursor.futures or self._pending >= self.max_pending:
+                    continue
+                self._pending += 1
+                self.scheduled += 1
+                future = self._get_executor().submit(
+                    self._run, key, cursor.generation, user_folder, filename, p, options
+                )
+                cursor.futures[p] = future
+
+    def cancel(self, user_folder, filename):
+        """Cancela todo lo pendiente para un documento (el usuario salió del sorter)."""
+        with self._lock:
+            cursor = self._cursors.pop((user_folder, filename), None)
+            if cursor is not None:
+                self._cancel_cursor(cursor)
+
+    def _cancel_cursor(self, cursor):
+        cursor.generation += 1
+        for future in cursor.futures.values():
+            if future.cancel():
+                self._pending -= 1
+                self.cancelled += 1
+        cursor.futures = {}
+
+    def _drop_idle_cursors(self):
+        for key in [k for k, c in self._cursors.items() if not c.futures]:
+            del self._cursors[key]
+
+    def _run(self, key, generation, user_folder, filename, page_num, options):
+        try:
+            with self._lock:
+                cursor = self._cursors.get(key)
+                if cursor is None or cursor.generation != generation:
+                    self.cancelled += 1
+                    return
+            self.warm_fn(user_folder, filename, page_num, options)
+            self.completed += 1
+        except Exception as e:
+            print(f"Error al pre-renderizar {filename} página {page_num}: {e}")
+        finally:
+            with self._lock:
+                self._pending -= 1
+                cursor = self._cursors.get(key)
+                if cursor is not None and cursor.generation == generation:
+                    cursor.futures.pop(page_num, None)
+
+    def stats(self):
+        """Contadores de la cola de pre-renderizado."""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'ahead': self.ahead,
+                'pending': self._pending,
+                'scheduled': self.scheduled,
+                'completed': self.completed,
+                'cancelled': self.cancelled,
+            }
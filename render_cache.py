@@ -0,0 +1,208 @@
+"""Caché en disco de páginas renderizadas.
+
+Las imágenes se guardan dentro de la carpeta de cada sesión, con un nombre
+derivado del contenido del PDF (hash), la página, el zoom y el formato. Así
+un mismo PDF subido con otro nombre reutiliza las imágenes, y un PDF
+reemplazado nunca sirve imágenes viejas.
+"""
+import os
+import time
+import uuid
+import hashlib
+import threading
+
+import metrics
+
+# Carpeta (dentro de la sesión) donde se guardan las imágenes renderizadas
+RENDER_CACHE_DIRNAME = '.render-cache'
+
+# Presupuesto de disco por sesión para la caché de renderizado
+RENDER_CACHE_MAX_BYTES = int(os.environ.get('RENDER_CACHE_MAX_BYTES', str(200 * 1024 * 1024)))  # 200MB
+
+# Al desalojar, se borra hasta quedar en este porcentaje del presupuesto
+RENDER_CACHE_LOW_WATER = 0.9
+
+# Máximo de hashes de archivo que se recuerdan en memoria
+FILE_HASH_MEMO_SIZE = 1024
+
+_hash_lock = threading.Lock()
+_hash_memo = {}  # ruta -> ((tamaño, mtime_ns, inode), hash)
+
+_size_lock = threading.Lock()
+_cache_sizes = {}  # carpeta de caché -> bytes estimados
+
+
+def file_hash(path):
+    """Calcula (y recuerda) el hash SHA-256 del contenido de un archivo."""
+    st = os.stat(path)
+    stamp = (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    with _hash_lock:
+        memo = _hash_memo.get(path)
+        if memo and memo[0] == stamp:
+            return memo[1]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    value = digest.hexdigest()
+
+    with _hash_lock:
+        if len(_hash_memo) >= FILE_HASH_MEMO_SIZE:
+            _hash_memo.clear()
+        _hash_memo[path] = (stamp, value)
+    return value
+
+
+def render_key(content_hash, page_num, zoom, fmt):
+    """Genera la clave (y ETag) de una página renderizada."""
+    raw = f"{content_hash}:{page_num}:{zoom}:{fmt}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """Caché LRU de imágenes renderizadas dentro de la carpeta de una sesión."""
+
+    def __init__(self, user_folder, max_bytes=None):
+        self.folder = os.path.join(user_folder, RENDER_CACHE_DIRNAME)
+        self.max_bytes = RENDER_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+
+    def _path(self, key, fmt):
+        return os.path.join(self.folder, f"{key}.{fmt}")
+
+    def contains(self, key, fmt):
+        """Indica si la imagen ya está en la caché (sin leerla)."""
+        return os.path.exists(self._path(key, fmt))
+
+    def get(self, key, fmt):
+        """Devuelve los bytes de una imagen cacheada o None si no existe."""
+        path = self._path(key, fmt)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            metrics.inc('pdfsorter_cache_requests_total', cache='render', result='miss')
+            return None
+        metrics.inc('pdfsorter_cache_requests_total', cache='render', result='hit')
+
+        # Marcar como usada recientemente (la antigüedad define el desalojo)
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, fmt, data):
+        """Guarda una imagen en la caché y desaloja las más viejas si hace falta."""
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder, exist_ok=True)
+
+        path = self._path(key, fmt)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        metrics.inc('pdfsorter_bytes_written_total', len(data), kind='render_cache')
+
+        with _size_lock:
+            if self.folder not in _cache_sizes:
+                _cache_sizes[self.folder] = cache_size(self.folder)
+            else:
+                _cache_sizes[self.folder] += len(data)
+            over_budget = _cache_sizes[self.folder] > self.max_bytes
+
+        if over_budget:
+            self.prune()
+        return data
+
+    def link(self, source_key, key, fmt):
+        """Guarda bajo `key` la misma imagen que `source_key` (hardlink, sin copiarla).
+
+        Devuelve los bytes de la imagen, o None si `source_key` no está en la caché.
+        """
+        source = self._path(source_key, fmt)
+        path = self._path(key, fmt)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.link(source, temp_path)
+        except OSError:
+            return None
+        os.replace(temp_path, path)
+        return self.get(key, fmt)
+
+    def prune(self):
+        """Desaloja las imágenes menos usadas hasta entrar en el presupuesto."""
+        remaining = prune_cache_folder(self.folder, int(self.max_bytes * RENDER_CACHE_LOW_WATER))
+        with _size_lock:
+            _cache_sizes[self.folder] = remaining
+        return remaining
+
+
+def cache_size(cache_folder):
+    """Suma el tamaño de los archivos de una carpeta de caché (los hardlinks, una vez)."""
+    total = 0
+    seen = set()
+    try:
+        with os.scandir(cache_folder) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+                if st.st_ino not in seen:
+                    seen.add(st.st_ino)
+                    total += st.st_size
+    except OSError:
+        pass
+    return total
+
+
+def prune_cache_folder(cache_folder, max_bytes):
+    """Borra los archivos más antiguos (por último uso) hasta quedar bajo max_bytes.
+
+    Una imagen enlazada con varios nombres (páginas idénticas) ocupa disco
+    una sola vez y recién se libera al borrar su último nombre.
+    """
+    files = []
+    links = {}  # inode -> nombres en la carpeta
+    total = 0
+    try:
+        with os.scandir(cache_folder) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+                # Temporales abandonados por escrituras interrumpidas
+                if entry.name.endswith('.tmp') and time.time() - st.st_mtime > 3600:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+                    continue
+                files.append((st.st_mtime, st.st_size, st.st_ino, entry.path))
+                if st.st_ino not in links:
+                    total += st.st_size
+                links[st.st_ino] = links.get(st.st_ino, 0) + 1
+    except OSError:
+        return 0
+
+    files.sort()
+    for _, size, inode, path in files:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        links[inode] -= 1
+        if links[inode] == 0:
+            total -= size
+    return total
+
+
+def prune_session_cache(user_folder, max_bytes=None):
+    """Aplica el presupuesto de la caché de renderizado de una sesión."""
+    cache = RenderCache(user_folder, max_bytes)
+    if not os.path.isdir(cache.folder):
+        return 0
+    return cache.prune()
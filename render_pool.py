@@ -0,0 +1,315 @@
+"""Motor de renderizado en procesos separados.
+
+`page.get_pixmap` y la codificación PNG son trabajo de CPU que retiene el GIL,
+así que los hilos de gunicorn (gthread) terminan renderizando de a uno. Este
+módulo envía cada render a un `ProcessPoolExecutor`; cada proceso mantiene sus
+propios documentos abiertos y devuelve los bytes de la imagen ya codificada.
+
+La cantidad de trabajos en vuelo está acotada (control de admisión): cuando la
+cola está llena, `render()` lanza `RenderBusy` en lugar de encolar sin límite.
+Los trabajos en segundo plano (pre-renderizado) solo pueden ocupar la mitad de
+la cola, para que nunca desplacen a las peticiones del usuario.
+
+El trabajo por lotes de la cola de trabajos (análisis, indexado, huellas,
+división) va por `run_background()` a un pool aparte y más chico: nunca
+ocupa los procesos ni la cola de las peticiones, espera su turno en lugar de
+lanzar `RenderBusy` y corta al vencer su plazo o si el trabajo se canceló.
+"""
+import os
+import time
+import atexit
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+import fitz  # PyMuPDF
+
+import metrics
+from doc_pool import document_pool
+
+# Procesos de renderizado por worker de gunicorn (0 = renderizar en el mismo hilo)
+RENDER_PROCESSES = int(os.environ.get('RENDER_PROCESSES', str(max(1, (os.cpu_count() or 2) // 2))))
+
+# Máximo de renders en vuelo (encolados + en ejecución) por worker
+RENDER_QUEUE_MAX = int(os.environ.get('RENDER_QUEUE_MAX', str(max(4, RENDER_PROCESSES * 4))))
+
+# Segundos máximos de espera por un render
+RENDER_TIMEOUT = int(os.environ.get('RENDER_TIMEOUT', '60'))
+
+# Documentos abiertos que recuerda cada proceso de renderizado
+RENDER_WORKER_DOCS = 8
+
+# Procesos para el trabajo por lotes (run_background) y cuántos bloques en vuelo admite
+RENDER_BACKGROUND_PROCESSES = int(os.environ.get('RENDER_BACKGROUND_PROCESSES', '1'))
+RENDER_BACKGROUND_QUEUE = max(1, RENDER_BACKGROUND_PROCESSES * 2)
+
+# Segundos máximos (espera + ejecución) de un bloque de trabajo por lotes
+RENDER_BACKGROUND_TIMEOUT = int(os.environ.get('RENDER_BACKGROUND_TIMEOUT', '600'))
+
+# Cada cuánto se revisa la cancelación mientras se espera un bloque
+RENDER_BACKGROUND_POLL = 0.5
+
+
+class RenderBusy(Exception):
+    """La cola de renderizado está llena; el cliente debe reintentar más tarde."""
+
+
+# ---------- Lado del proceso de renderizado ----------
+
+_worker_docs = OrderedDict()  # ruta -> (versión, documento)
+
+
+def _worker_open(path, stamp):
+    """Abre (o reutiliza) un documento dentro del proceso de renderizado."""
+    cached = _worker_docs.get(path)
+    if cached is not None:
+        if cached[0] == stamp:
+            _worker_docs.move_to_end(path)
+            return cached[1]
+        cached[1].close()
+        del _worker_docs[path]
+
+    with metrics.span('fitz_open'):
+        doc = fitz.open(path)
+    _worker_docs[path] = (stamp, doc)
+    while len(_worker_docs) > RENDER_WORKER_DOCS:
+        _, (_, old_doc) = _worker_docs.popitem(last=False)
+        old_doc.close()
+    return doc
+
+
+def render_document_page(doc, page_num, zoom, fmt):
+    """Renderiza una página de un documento abierto y devuelve la imagen codificada."""
+    if page_num < 1 or page_num > len(doc):
+        return None
+    page = doc[page_num - 1]  # PyMuPDF usa índices base 0
+    with metrics.span('get_pixmap'):
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+    with metrics.span(f'encode_{fmt}'):
+        return pix.tobytes(fmt)
+
+
+def _worker_run(func, path, stamp, args):
+    doc = _worker_open(path, stamp)
+    result = func(doc, *args)
+    # Lo medido en este proceso viaja con el resultado y se suma en el worker web
+    return result, metrics.drain()
+
+
+# ---------- Lado del worker web ----------
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class RenderEngine:
+    """Despacha renders a un pool de procesos con control de admisión."""
+
+    def __init__(self, processes=RENDER_PROCESSES, max_queue=RENDER_QUEUE_MAX,
+                 timeout=RENDER_TIMEOUT, background_processes=RENDER_BACKGROUND_PROCESSES):
+        self.processes = processes
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.background_processes = background_processes
+        self._lock = threading.Lock()
+        self._executors = {}  # 'foreground' | 'background' -> ProcessPoolExecutor
+        self._background_slots = threading.BoundedSemaphore(RENDER_BACKGROUND_QUEUE)
+        self._in_flight = 0
+        self._background_in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.background_completed = 0
+        self.background_failed = 0
+
+    def _get_executor(self, kind='foreground'):
+        with self._lock:
+            executor = self._executors.get(kind)
+            if executor is None:
+                # spawn: los procesos no heredan hilos ni handles de MuPDF del worker
+                executor = self._executors[kind] = ProcessPoolExecutor(
+                    max_workers=self.processes if kind == 'foreground' else self.background_processes,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+            return executor
+
+    def _submit(self, kind, func, path, args):
+        """Envía `func` al pool `kind`; si un proceso murió, recrea el pool una vez."""
+        job = (_worker_run, func, os.path.abspath(path), _file_stamp(path), args)
+        try:
+            return self._get_executor(kind).submit(*job)
+        except BrokenProcessPool:
+            self._reset_executor(kind)
+            return self._get_executor(kind).submit(*job)
+
+    def _release(self, future):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _submit_admitted(self, func, path, args):
+        """Envía un render ya admitido; su lugar en la cola se libera recién al terminar."""
+        try:
+            future = self._submit('foreground', func, path, args)
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _admit(self, background):
+        limit = self.max_queue // 2 if background else self.max_queue
+        with self._lock:
+            if self._in_flight >= max(1, limit):
+                self.rejected += 1
+                raise RenderBusy()
+            self._in_flight += 1
+            self.submitted += 1
+
+    def render(self, path, page_num, zoom, fmt, background=False):
+        """Renderiza una página y devuelve los bytes, o None si la página no existe."""
+        return self.run(render_document_page, path, page_num, zoom, fmt, background=background)
+
+    def run(self, func, path, *args, background=False):
+        """Ejecuta `func(doc, *args)` sobre el documento de `path` en el pool.
+
+        `func` debe ser una función de nivel de módulo (se envía por pickle al
+        proceso de renderizado) y devolver algo serializable. Si no termina en
+        `timeout` segundos lanza RenderBusy; el render sigue contando en la
+        cola hasta que su proceso lo termine, así no se admiten más detrás.
+        """
+        if self.processes <= 0:
+            with document_pool.acquire(path) as doc:
+                return func(doc, *args)
+
+        self._admit(background)
+        ok = False
+        future = self._submit_admitted(func, path, args)
+        try:
+            try:
+                result, measured = future.result(timeout=self.timeout)
+            except BrokenProcessPool:
+                # Un proceso murió (p. ej. por memoria): recrear el pool y reintentar
+                self._reset_executor('foreground')
+                with self._lock:
+                    self._in_flight += 1
+                future = self._submit_admitted(func, path, args)
+                result, measured = future.result(timeout=self.timeout)
+            metrics.merge(measured)
+            ok = True
+            return result
+        except FuturesTimeout:
+            # Si todavía no empezó, sale de la cola; si ya corre, ocupa su lugar hasta terminar
+            future.cancel()
+            with self._lock:
+                self.timed_out += 1
+            raise RenderBusy()
+        finally:
+            with self._lock:
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+    def run_background(self, func, path, *args, check=None, timeout=RENDER_BACKGROUND_TIMEOUT):
+        """Como `run`, pero para trabajo por lotes (trabajos de la cola).
+
+        Corre en un pool aparte de `background_processes` procesos, así las
+        peticiones del usuario nunca esperan detrás de un lote. Si el pool
+        está lleno espera su turno; `check()` (p. ej. `job.check_cancelled`)
+        se llama mientras espera y puede lanzar para cortar. Pasados
+        `timeout` segundos lanza TimeoutError.
+        """
+        if self.processes <= 0:
+            if check is not None:
+                check()
+            with document_pool.acquire(path) as doc:
+                return func(doc, *args)
+
+        deadline = time.monotonic() + timeout
+
+        def wait_step():
+            if check is not None:
+                check()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError('El trabajo de fondo superó el tiempo máximo')
+            return min(RENDER_BACKGROUND_POLL, remaining)
+
+        while not self._background_slots.acquire(timeout=wait_step()):
+            pass
+        with self._lock:
+            self._background_in_flight += 1
+        ok = False
+        future = None
+        try:
+            future = self._submit('background', func, path, args)
+            retried = False
+            while True:
+                step = wait_step()
+                try:
+                    result, measured = future.result(timeout=step)
+                    break
+                except FuturesTimeout:
+                    continue
+                except BrokenProcessPool:
+                    if retried:
+                        raise
+                    retried = True
+                    self._reset_executor('background')
+                    future = self._submit('background', func, path, args)
+            metrics.merge(measured)
+            ok = True
+            return result
+        finally:
+            if future is not None and not ok:
+                future.cancel()
+            self._background_slots.release()
+            with self._lock:
+                self._background_in_flight -= 1
+                if ok:
+                    self.background_completed += 1
+                else:
+                    self.background_failed += 1
+
+    def _reset_executor(self, kind='foreground'):
+        with self._lock:
+            executor = self._executors.pop(kind, None)
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @property
+    def queue_depth(self):
+        """Renders en vuelo (encolados + ejecutándose)."""
+        return self._in_flight
+
+    def shutdown(self):
+        for kind in ('foreground', 'background'):
+            self._reset_executor(kind)
+
+    def stats(self):
+        """Contadores del motor de renderizado."""
+        with self._lock:
+            return {
+                'processes': self.processes,
+                'max_queue': self.max_queue,
+                'queue_depth': self._in_flight,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'failed': self.failed,
+                'timed_out': self.timed_out,
+                'background_processes': self.background_processes,
+                'background_in_flight': self._background_in_flight,
+                'background_completed': self.background_completed,
+                'background_failed': self.background_failed,
+            }
+
+
+# Motor compartido por todas las rutas del worker
+render_engine = RenderEngine()
+atexit.register(render_engine.shutdown)
@@ -0,0 +1,228 @@
+"""Búsqueda de texto en los PDFs de una sesión (SQLite FTS5).
+
+Al subir un PDF se encola un trabajo 'index' (`jobs.py`) que extrae el texto
+de cada página con `page.get_text` por bloques, en el pool de lotes
+(`render_engine.run_background`), y lo guarda en `.search/search.db`
+dentro de la sesión. `/search?q=` consulta el índice FTS5 y devuelve
+(archivo, página, fragmento) sin abrir ningún PDF.
+
+El texto se guarda por hash de contenido, no por nombre: un PDF subido otra
+vez (o con otro nombre) reutiliza lo ya extraído, y un trabajo interrumpido
+sigue desde la última página guardada. Solo se indexan los PDFs fuente; los
+PDFs -sorted son copias de sus páginas y no se vuelven a extraer.
+"""
+import os
+import re
+import html
+import sqlite3
+from contextlib import closing
+
+import metrics
+from render_pool import render_engine
+from session_index import content_hash
+
+# Carpeta (dentro de la sesión) con el índice de búsqueda
+SEARCH_DIRNAME = '.search'
+SEARCH_DB_FILENAME = 'search.db'
+
+# Páginas por bloque enviado al pool de procesos
+SEARCH_CHUNK_PAGES = 50
+
+# Máximo de resultados por búsqueda
+SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', '50'))
+
+# Palabras de contexto en cada fragmento
+SNIPPET_WORDS = 12
+
+# Marcas (no imprimibles) que delimitan las coincidencias dentro del fragmento
+_MARK_START = '\x02'
+_MARK_END = '\x03'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    hash TEXT PRIMARY KEY,
+    pages INTEGER NOT NULL,
+    indexed INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+CREATE VIRTUAL TABLE IF NOT EXISTS pages USING fts5(
+    text, hash UNINDEXED, page UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _connect(user_folder):
+    folder = os.path.join(user_folder, SEARCH_DIRNAME)
+    os.makedirs(folder, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(folder, SEARCH_DB_FILENAME), timeout=10,
+                           isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(_SCHEMA)
+    return closing(conn)
+
+
+def register_file(user_folder, name, content, pages):
+    """Asocia un PDF de la sesión a su hash. Devuelve True si falta extraer texto."""
+    with _connect(user_folder) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        previous = conn.execute('SELECT hash FROM files WHERE name = ?', (name,)).fetchone()
+        conn.execute('INSERT INTO files (name, hash) VALUES (?, ?) '
+                     'ON CONFLICT(name) DO UPDATE SET hash = excluded.hash', (name, content))
+        conn.execute('INSERT OR IGNORE INTO documents (hash, pages) VALUES (?, ?)',
+                     (content, pages))
+        if previous is not None and previous[0] != content:
+            _drop_unused(conn, previous[0])
+        indexed, total = conn.execute('SELECT indexed, pages FROM documents WHERE hash = ?',
+                                      (content,)).fetchone()
+        conn.execute('COMMIT')
+    return indexed < total
+
+
+def forget_file(user_folder, name):
+    """Quita un PDF borrado; su texto se borra si ningún otro archivo lo comparte."""
+    if not os.path.exists(os.path.join(user_folder, SEARCH_DIRNAME, SEARCH_DB_FILENAME)):
+        return
+    with _connect(user_folder) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT hash FROM files WHERE name = ?', (name,)).fetchone()
+        conn.execute('DELETE FROM files WHERE name = ?', (name,))
+        if row is not None:
+            _drop_unused(conn, row[0])
+        conn.execute('COMMIT')
+
+
+def _drop_unused(conn, content):
+    if conn.execute('SELECT 1 FROM files WHERE hash = ? LIMIT 1', (content,)).fetchone():
+        return
+    conn.execute('DELETE FROM pages WHERE hash = ?', (content,))
+    conn.execute('DELETE FROM documents WHERE hash = ?', (content,))
+
+
+def indexing_state(user_folder):
+    """{nombre: {'hash', 'indexed', 'pages'}} de los PDFs registrados."""
+    with _connect(user_folder) as conn:
+        rows = conn.execute('SELECT f.name, f.hash, d.indexed, d.pages FROM files f '
+                            'JOIN documents d ON d.hash = f.hash').fetchall()
+    return {name: {'hash': content, 'indexed': indexed, 'pages': pages}
+            for name, content, indexed, pages in rows}
+
+
+# ---------- Lado del proceso de renderizado ----------
+
+def extract_text(doc, first, last):
+    """Texto de las páginas first..last (corre en el pool de procesos)."""
+    with metrics.span('get_text'):
+        return [doc[page_num - 1].get_text('text') for page_num in range(first, last + 1)]
+
+
+# ---------- Trabajo en segundo plano ----------
+
+def index_job(job):
+    """Trabajo 'index': extrae el texto que falta de un PDF y lo guarda en el índice.
+
+    Parámetros: {'filename', 'hash', 'pages'}. Sigue desde la última página
+    guardada; si el archivo ya no tiene ese hash (se reemplazó), no hace nada.
+    """
+    filename = job.params['filename']
+    content = job.params['hash']
+    total = job.params['pages']
+    path = os.path.join(job.user_folder, filename)
+
+    with _connect(job.user_folder) as conn:
+        row = conn.execute('SELECT indexed FROM documents WHERE hash = ?', (content,)).fetchone()
+    if row is None:
+        return {'indexed': 0, 'skipped': True}
+    indexed = row[0]
+
+    job.progress(indexed, total)
+    while indexed < total:
+        if content_hash(job.user_folder, filename) != content:
+            return {'indexed': indexed, 'skipped': True}
+        first, last = indexed + 1, min(indexed + SEARCH_CHUNK_PAGES, total)
+        texts = render_engine.run_background(extract_text, path, first, last,
+                                             check=job.check_cancelled)
+
+        with _connect(job.user_folder) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            # Otro trabajo (otro nombre con el mismo contenido) pudo avanzar primero
+            current = conn.execute('SELECT indexed FROM documents WHERE hash = ?',
+                                   (content,)).fetchone()
+            if current is None:
+                conn.execute('ROLLBACK')
+                return {'indexed': indexed, 'skipped': True}
+            if current[0] == indexed:
+                conn.executemany('INSERT INTO pages (text, hash, page) VALUES (?, ?, ?)',
+                                 [(text, content, first + i) for i, text in enumerate(texts)])
+                conn.execute('UPDATE documents SET indexed = ? WHERE hash = ?', (last, content))
+                indexed = last
+            else:
+                indexed = current[0]
+            conn.execute('COMMIT')
+        job.progress(indexed)
+
+    return {'indexed': indexed}
+
+
+# ---------- Búsqueda ----------
+
+def build_query(text):
+    """Convierte lo que escribe el usuario en una consulta FTS5 segura.
+
+    Cada palabra separada por espacios tiene que aparecer (AND); una palabra
+    con guiones o barras ("A-0001-123") se busca como frase, y la última
+    admite prefijo para poder buscar mientras se escribe. Devuelve None si no
+    hay nada que buscar.
+    """
+    phrases = []
+    for word in text.split():
+        terms = _TERM_RE.findall(word)
+        if terms:
+            phrases.append('"' + ' '.join(terms) + '"')
+    if not phrases:
+        return None
+    phrases[-1] += '*'
+    return ' '.join(phrases)
+
+
+def search(user_folder, text, filename=None, limit=SEARCH_MAX_RESULTS):
+    """Busca `text` en los PDFs de la sesión (o solo en `filename`).
+
+    Devuelve [{'file', 'page', 'snippet'}] ordenado por relevancia; el
+    fragmento es HTML escapado con las coincidencias entre <mark></mark>.
+    """
+    query = build_query(text)
+    if query is None:
+        return []
+    limit = max(1, min(limit, SEARCH_MAX_RESULTS))
+
+    sql = ('SELECT f.name, pages.page, '
+           'snippet(pages, 0, ?, ?, \'…\', ?) FROM pages '
+           'JOIN files f ON f.hash = pages.hash '
+           'WHERE pages MATCH ?')
+    args = [_MARK_START, _MARK_END, SNIPPET_WORDS, query]
+    if filename is not None:
+        sql += ' AND f.name = ?'
+        args.append(filename)
+    sql += ' ORDER BY rank LIMIT ?'
+    args.append(limit)
+
+    with _connect(user_folder) as conn:
+        try:
+            rows = conn.execute(sql, args).fetchall()
+        except sqlite3.OperationalError as e:
+            print(f"Error en la búsqueda '{text}': {e}")
+            return []
+
+    results = []
+    for name, page, snippet in rows:
+        snippet = ' '.join(html.escape(snippet).split())
+        snippet = snippet.replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+        results.append({'file': name, 'page': int(page), 'snippet': snippet})
+    return results
@@ -0,0 +1,343 @@
+"""Índice persistente de metadatos de cada sesión.
+
+Guarda, por PDF de la sesión, su tamaño, mtime, hash, cantidad de páginas y
+los PDFs clasificados de su carpeta -sorted, en un JSON escrito de forma
+atómica dentro de `.index/`. Así la página principal, `/list-sorted` y
+`/check-name` no vuelven a abrir cada PDF ni a recorrer las carpetas.
+
+Las rutas que modifican archivos actualizan el índice al terminar. Además,
+cada lectura compara el mtime de la carpeta y de cada PDF con el guardado:
+solo si no coinciden se vuelve a listar la carpeta o a leer ese PDF.
+"""
+import os
+import copy
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+from render_cache import file_hash
+from doc_pool import document_pool
+from sorted_store import list_outputs, outputs_stamp
+from storage import file_lock
+
+# Carpeta (dentro de la sesión) con el índice; sus escrituras no cambian el
+# mtime de la carpeta de la sesión
+INDEX_DIRNAME = '.index'
+INDEX_FILENAME = 'index.json'
+INDEX_VERSION = 1
+
+# Un listado de carpeta con mtime más reciente que esto no se da por válido
+# (un archivo creado en el mismo instante podría no haber aparecido)
+RACY_WINDOW_NS = 2 * 10**9
+
+# Índices de sesión que se mantienen en memoria
+INDEX_MEMO_SIZE = 256
+
+_locks_lock = threading.Lock()
+_locks = {}  # carpeta de sesión -> Lock
+
+_memo_lock = threading.Lock()
+_memo = OrderedDict()  # carpeta de sesión -> (marca del archivo de índice, datos)
+
+
+def _folder_lock(user_folder):
+    with _locks_lock:
+        lock = _locks.get(user_folder)
+        if lock is None:
+            lock = _locks[user_folder] = threading.Lock()
+        return lock
+
+
+def _index_path(user_folder):
+    return os.path.join(user_folder, INDEX_DIRNAME, INDEX_FILENAME)
+
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def _dir_stamp(path):
+    """Marca de una carpeta, o None si es demasiado reciente para confiar en ella."""
+    mtime_ns = os.stat(path).st_mtime_ns
+    if time.time_ns() - mtime_ns < RACY_WINDOW_NS:
+        return None
+    return mtime_ns
+
+
+def _empty_index():
+    return {'version': INDEX_VERSION, 'dir_mtime_ns': None, 'files': {}}
+
+
+def _load(user_folder):
+    """Lee el índice de una sesión (desde memoria si el archivo no cambió)."""
+    path = _index_path(user_folder)
+    try:
+        stamp = _file_stamp(path)
+    except OSError:
+        return _empty_index()
+
+    with _memo_lock:
+        memo = _memo.get(user_folder)
+        if memo is not None and memo[0] == stamp:
+            _memo.move_to_end(user_folder)
+            return memo[1]
+
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return _empty_index()
+    if data.get('version') != INDEX_VERSION:
+        return _empty_index()
+
+    _remember(user_folder, stamp, data)
+    return data
+
+
+def _remember(user_folder, stamp, data):
+    with _memo_lock:
+        _memo[user_folder] = (stamp, data)
+        _memo.move_to_end(user_folder)
+        while len(_memo) > INDEX_MEMO_SIZE:
+            _memo.popitem(last=False)
+
+
+def _save(user_folder, data):
+    """Escribe el índice de forma atómica (temporal + rename)."""
+    path = _index_path(user_folder)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+    _remember(user_folder, _file_stamp(path), data)
+
+
+def _read(user_folder):
+    """Índice actual de una sesión, solo para leer (no se debe modificar).
+
+    Toma el flock compartido: varias lecturas no se esperan entre sí y nunca
+    ven el índice a mitad de un `_update` de otro worker.
+    """
+    with file_lock(_index_path(user_folder), shared=True):
+        return _load(user_folder)
+
+
+def _update(user_folder, change):
+    """Carga el índice, aplica `change(datos)` y lo guarda si devolvió True.
+
+    Los cambios se hacen sobre una copia: quien ya tenga el índice anterior
+    puede seguir leyéndolo sin bloqueos. El flock evita que dos workers
+    pierdan cambios al leer y reescribir el índice a la vez.
+    """
+    with _folder_lock(user_folder), file_lock(_index_path(user_folder)):
+        current = _load(user_folder)
+        data = copy.deepcopy(current)
+        if change(data):
+            _save(user_folder, data)
+            return data
+        return current
+
+
+def _describe(path, entry=None, pages=None):
+    """Entrada del índice para un PDF; conserva lo que siga valiendo de `entry`."""
+    stamp = _file_stamp(path)
+    if entry is not None and entry.get('stamp') == stamp:
+        if pages is not None:
+            entry['pages'] = pages
+        return entry
+
+    if pages is None:
+        pages = document_pool.page_count(path)
+    return {
+        'stamp': stamp,
+        'pages': pages,
+        'hash': None,
+        'sorted': entry.get('sorted') if entry else None,
+    }
+
+
+def _sync_files(user_folder, data):
+    """Pone al día las entradas con la carpeta; devuelve True si algo cambió."""
+    files = data['files']
+    changed = False
+
+    dir_mtime = _dir_stamp(user_folder)
+    if dir_mtime is None or dir_mtime != data['dir_mtime_ns']:
+        names = {f for f in os.listdir(user_folder)
+                 if f.lower().endswith('.pdf') and os.path.isfile(os.path.join(user_folder, f))}
+        for name in list(files):
+            if name not in names:
+                del files[name]
+                changed = True
+        for name in names - set(files):
+            files[name] = None
+            changed = True
+        if data['dir_mtime_ns'] != dir_mtime:
+            data['dir_mtime_ns'] = dir_mtime
+            changed = True
+
+    for name, entry in list(files.items()):
+        path = os.path.join(user_folder, name)
+        try:
+            if entry is not None and entry['stamp'] == _file_stamp(path):
+                continue
+            files[name] = _describe(path, entry)
+        except FileNotFoundError:
+            del files[name]
+        except Exception as e:
+            print(f"Error al abrir {name}: {e}")
+            del files[name]
+        changed = True
+
+    return changed
+
+
+def _files_current(user_folder, data):
+    """True si las entradas coinciden con la carpeta (`_sync_files` no cambiaría nada)."""
+    dir_mtime = _dir_stamp(user_folder)
+    if dir_mtime is None or dir_mtime != data['dir_mtime_ns']:
+        return False
+    try:
+        return all(entry is not None and entry['stamp'] == _file_stamp(os.path.join(user_folder, name))
+                   for name, entry in data['files'].items())
+    except FileNotFoundError:
+        return False
+
+
+def list_pdfs(user_folder):
+    """PDFs de la sesión como [{'name', 'pages', 'size'}], ordenados por nombre."""
+    data = _read(user_folder)
+    if not _files_current(user_folder, data):
+        data = _update(user_folder, lambda d: _sync_files(user_folder, d))
+    pdfs = [{'name': name, 'pages': entry['pages'], 'size': entry['stamp'][0]}
+            for name, entry in data['files'].items()]
+    pdfs.sort(key=lambda x: x['name'].lower())
+    return pdfs
+
+
+def _refresh_entry(user_folder, data, name):
+    """Pone al día la entrada de un PDF; devuelve True si cambió."""
+    entry = data['files'].get(name)
+    try:
+        fresh = _describe(os.path.join(user_folder, name), entry)
+    except FileNotFoundError:
+        return data['files'].pop(name, None) is not None
+    data['files'][name] = fresh
+    return fresh is not entry
+
+
+def pdf_info(user_folder, name):
+    """Entrada del índice de un PDF ({'stamp', 'pages', 'hash', 'sorted'}) o None si no existe."""
+    # Camino rápido: el índice en memoria nunca se modifica en el lugar
+    entry = _read(user_folder)['files'].get(name)
+    try:
+        if entry is not None and entry['stamp'] == _file_stamp(os.path.join(user_folder, name)):
+            return entry
+    except FileNotFoundError:
+        pass
+
+    data = _update(user_folder, lambda d: _refresh_entry(user_folder, d, name))
+    return data['files'].get(name)
+
+
+def record_pdf(user_folder, name, pages=None, content=None):
+    """Registra un PDF recién subido o reemplazado (con su hash, si ya se calculó)."""
+    path = os.path.join(user_folder, name)
+
+    def change(data):
+        entry = _describe(path, data['files'].get(name), pages)
+        if content is not None:
+            entry['hash'] = content
+        data['files'][name] = entry
+        return True
+
+    _update(user_folder, change)
+
+
+def forget_pdf(user_folder, name):
+    """Quita un PDF borrado del índice."""
+    _update(user_folder, lambda data: data['files'].pop(name, None) is not None)
+
+
+def content_hash(user_folder, name):
+    """Hash del contenido de un PDF; se calcula una sola vez por versión del archivo."""
+    path = os.path.join(user_folder, name)
+    entry = pdf_info(user_folder, name)
+    if entry is None:
+        raise FileNotFoundError(path)
+    if entry['hash'] is not None:
+        return entry['hash']
+
+    value = file_hash(path)
+
+    def change(data):
+        current = data['files'].get(name)
+        if current is None or current['stamp'] != entry['stamp']:
+            return False
+        current['hash'] = value
+        return True
+
+    _update(user_folder, change)
+    return value
+
+
+def identical_pdfs(user_folder, name, content):
+    """Otros PDFs de la sesión con el mismo contenido que `name`.
+
+    Solo se calcula el hash de los que tienen el mismo tamaño.
+    """
+    size = os.path.getsize(os.path.join(user_folder, name))
+    names = []
+    for pdf in list_pdfs(user_folder):
+        if pdf['name'] == name or pdf['size'] != size:
+            continue
+        try:
+            if content_hash(user_folder, pdf['name']) == content:
+                names.append(pdf['name'])
+        except FileNotFoundError:
+            pass
+    return names
+
+
+def sorted_outputs(user_folder, name, sorted_folder, refresh=False):
+    """PDFs clasificados de un PDF, desde el índice si la carpeta -sorted no cambió.
+
+    Con `refresh=True` (después de modificar la carpeta) se vuelve a listar.
+    """
+    stamp = outputs_stamp(sorted_folder)
+    if stamp and time.time_ns() - stamp[-1] < RACY_WINDOW_NS:
+        stamp = None
+
+    if not refresh and stamp is not None:
+        # Camino rápido: PDF y carpeta -sorted sin cambios desde el índice
+        entry = _read(user_folder)['files'].get(name)
+        try:
+            if (entry is not None and entry['stamp'] == _file_stamp(os.path.join(user_folder, name))
+                    and entry.get('sorted') and entry['sorted']['stamp'] == stamp):
+                return list(entry['sorted']['outputs'])
+        except FileNotFoundError:
+            pass
+
+    def change(data):
+        changed = _refresh_entry(user_folder, data, name)
+        entry = data['files'].get(name)
+        if entry is None:
+            return changed
+        cached = entry.get('sorted')
+        if not refresh and stamp is not None and cached and cached['stamp'] == stamp:
+            return changed
+        fresh = {'stamp': stamp, 'outputs': list_outputs(sorted_folder)}
+        if fresh == cached:
+            return changed
+        entry['sorted'] = fresh
+        return True
+
+    entry = _update(user_folder, change)['files'].get(name)
+    if entry is None:
+        # PDF fuera del índice (p. ej. ya borrado): listar directamente
+        return list_outputs(sorted_folder)
+    return list(entry['sorted']['outputs'])
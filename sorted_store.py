@@ -0,0 +1,763 @@
+"""Operaciones sobre los PDFs clasificados (carpeta `<nombre>-sorted/`).
+
+Todas las escrituras del sorter pasan por `apply_operations`: recibe una lista
+ordenada de operaciones create/append/remove, abre una sola vez el PDF fuente y
+cada PDF destino, aplica todo en memoria y guarda cada destino una única vez.
+Si alguna operación o algún guardado falla no se modifica ningún archivo.
+Las escrituras sobre una misma carpeta se serializan con un lock por hilo y un
+flock (`storage.file_lock`), así que tampoco se pisan entre workers.
+
+Los destinos que ya existen se guardan de forma incremental (`saveIncr`): solo
+se agrega al final del archivo lo que cambió, en vez de reescribir el PDF
+entero en cada click. Antes de cada guardado incremental se escribe un journal
+con el tamaño previo del archivo; si el proceso muere a mitad de camino, el
+archivo se trunca a ese tamaño la próxima vez que se abre. Cuando se acumulan
+demasiadas actualizaciones (o demasiado tamaño extra) el PDF se compacta con
+un guardado completo (garbage + deflate); la compactación la hace un trabajo
+en segundo plano (`pending_compaction` dice si hace falta), y solo si se pasa
+de COMPACT_HARD_LIMIT_UPDATES se compacta dentro del mismo click.
+
+`split_outputs` crea muchos PDFs de una vez a partir de rangos del fuente
+(`/split`): cada salida se arma por tramos contiguos en el pool de procesos,
+en paralelo, y todas se mueven a la carpeta recién cuando están listas.
+
+Con SORTED_STORAGE=manifest los PDFs clasificados son "virtuales": cada uno se
+guarda como una lista de páginas del PDF fuente en `.manifest.json`, y cada
+click del sorter es solo una escritura de ese JSON. Los PDFs reales se
+construyen de una pasada (abriendo el fuente una vez) recién al exportar o
+descargar.
+"""
+import os
+import json
+import uuid
+import shutil
+import threading
+from contextlib import nullcontext, contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import fitz  # PyMuPDF
+
+import metrics
+from doc_pool import document_pool
+from render_pool import render_engine, RENDER_BACKGROUND_PROCESSES
+from storage import file_lock
+
+OPERATIONS = ('create', 'append', 'remove')
+
+# Cómo se guardan los PDFs clasificados: 'pdf' (archivos reales) o 'manifest'
+SORTED_STORAGE = os.environ.get('SORTED_STORAGE', 'pdf')
+
+MANIFEST_FILENAME = '.manifest.json'
+EXPORT_DIRNAME = '.export'
+
+# Guardar incrementalmente los PDFs destino que ya existen
+SORTED_INCREMENTAL = os.environ.get('SORTED_INCREMENTAL', '1') == '1'
+
+# Compactar tras esta cantidad de guardados incrementales...
+COMPACT_AFTER_UPDATES = int(os.environ.get('COMPACT_AFTER_UPDATES', '50'))
+
+# ...o cuando el archivo supera en este factor al tamaño tras la última compactación
+COMPACT_OVERHEAD_RATIO = float(os.environ.get('COMPACT_OVERHEAD_RATIO', '2.0'))
+
+# Si la compactación en segundo plano no llega, compactar en el click pasado este límite
+COMPACT_HARD_LIMIT_UPDATES = 4 * COMPACT_AFTER_UPDATES
+
+# PDFs que `split_outputs` construye a la vez (cada uno en un proceso del pool de lotes)
+SPLIT_PARALLEL = int(os.environ.get('SPLIT_PARALLEL', str(max(1, RENDER_BACKGROUND_PROCESSES))))
+
+_folder_locks_lock = threading.Lock()
+_folder_locks = {}  # carpeta sorted -> Lock
+
+
+class SortedOpError(Exception):
+    """Error de una operación sobre los PDFs clasificados."""
+
+    def __init__(self, message, status=400, index=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.index = index
+
+
+class ExportPending(Exception):
+    """Falta preparar la descarga (`export_outputs`, trabajo 'export') antes de enviar el ZIP."""
+
+
+def normalize_pdf_name(name):
+    """Agrega la extensión .pdf si el nombre no la tiene."""
+    if not name.lower().endswith('.pdf'):
+        name = name + '.pdf'
+    return name
+
+
+class _Target:
+    """Un PDF destino abierto durante un lote de operaciones."""
+
+    def __init__(self, path, doc, on_disk):
+        self.path = path
+        self.doc = doc
+        self.on_disk = on_disk
+        self.deleted = False
+        self.modified = False
+
+
+@contextmanager
+def _folder_lock(sorted_folder):
+    """Serializa las escrituras sobre una carpeta sorted (entre hilos y entre workers)."""
+    with _folder_locks_lock:
+        lock = _folder_locks.get(sorted_folder)
+        if lock is None:
+            lock = _folder_locks[sorted_folder] = threading.Lock()
+    with lock, file_lock(sorted_folder):
+        yield
+
+
+def _journal_path(path):
+    folder, name = os.path.split(path)
+    return os.path.join(folder, f".{name}.journal")
+
+
+def _state_path(path):
+    folder, name = os.path.split(path)
+    return os.path.join(folder, f".{name}.incr.json")
+
+
+def _read_state(path):
+    """Estado de guardados incrementales de un PDF: {'base_size': ..., 'updates': ...}."""
+    try:
+        with open(_state_path(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'base_size': os.path.getsize(path), 'updates': 0}
+
+
+def _write_state(path, state):
+    state_path = _state_path(path)
+    temp_path = f"{state_path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(temp_path, state_path)
+
+
+def _remove_sidecars(path):
+    for sidecar in (_state_path(path), _journal_path(path)):
+        try:
+            os.remove(sidecar)
+        except OSError:
+            pass
+
+
+def recover_incremental(path):
+    """Deshace un guardado incremental interrumpido (truncando al tamaño del journal)."""
+    journal = _journal_path(path)
+    if not os.path.exists(journal):
+        return False
+    try:
+        with open(journal) as f:
+            size = json.load(f)['size']
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+                os.fsync(f.fileno())
+            document_pool.invalidate(path)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error al recuperar {path}: {e}")
+    os.remove(journal)
+    return True
+
+
+def recover_folder(sorted_folder):
+    """Recupera todos los guardados incrementales interrumpidos de una carpeta sorted."""
+    if not os.path.isdir(sorted_folder):
+        return
+    for f in os.listdir(sorted_folder):
+        if f.endswith('.journal') and f.startswith('.'):
+            recover_incremental(os.path.join(sorted_folder, f[1:-len('.journal')]))
+
+
+def _needs_compaction(path, state):
+    if state['updates'] >= COMPACT_AFTER_UPDATES:
+        return True
+    return os.path.getsize(path) > state['base_size'] * COMPACT_OVERHEAD_RATIO
+
+
+def _load_target(targets, sorted_folder, name):
+    """Devuelve el destino `name`, abriéndolo del disco la primera vez."""
+    target = targets.get(name)
+    if target is None:
+        path = os.path.join(sorted_folder, name)
+        if not os.path.exists(path):
+            return None
+        recover_incremental(path)
+        with metrics.span('fitz_open'):
+            doc = fitz.open(path)
+        target = targets[name] = _Target(path, doc, on_disk=True)
+    if target.deleted:
+        return None
+    return target
+
+
+def _check_page(page_num, total_pages, index):
+    if not isinstance(page_num, int) or isinstance(page_num, bool):
+        raise SortedOpError('Número de página inválido', index=index)
+    if page_num < 1 or page_num > total_pages:
+        raise SortedOpError(f'La página {page_num} no existe', index=index)
+
+
+def apply_operations(source_path, sorted_folder, operations):
+    """Aplica un lote ordenado de operaciones y guarda cada destino una sola vez.
+
+    Cada operación es un dict:
+      {'op': 'create', 'page': N, 'name': 'nuevo.pdf'}
+      {'op': 'append', 'page': N, 'target': 'existente.pdf'}
+      {'op': 'remove', 'target': 'existente.pdf'}  (quita la última página)
+
+    Devuelve una lista de resultados (uno por operación). Lanza SortedOpError
+    sin tocar el disco si alguna operación no se puede aplicar.
+    """
+    if SORTED_STORAGE == 'manifest':
+        return _apply_manifest_operations(source_path, sorted_folder, operations)
+    return _apply_pdf_operations(source_path, sorted_folder, operations)
+
+
+def _apply_pdf_operations(source_path, sorted_folder, operations):
+    targets = {}  # nombre -> _Target
+    results = []
+
+    # El PDF fuente solo hace falta si hay páginas que copiar
+    needs_source = any(isinstance(op, dict) and op.get('op') in ('create', 'append')
+                       for op in operations)
+    source_context = document_pool.acquire(source_path) if needs_source else nullcontext()
+
+    with _folder_lock(sorted_folder):
+        try:
+            with source_context as source_doc:
+                total_pages = len(source_doc) if source_doc is not None else 0
+
+                for index, op in enumerate(operations):
+                    kind = op.get('op') if isinstance(op, dict) else None
+                    if kind not in OPERATIONS:
+                        raise SortedOpError(f'Operación desconocida: {kind}', index=index)
+
+                    if kind == 'create':
+                        name = normalize_pdf_name(op.get('name') or '')
+                        page_num = op.get('page')
+                        _check_page(page_num, total_pages, index)
+                        if _load_target(targets, sorted_folder, name) is not None:
+                            raise SortedOpError('Ya existe un PDF con este nombre', index=index)
+
+                        previous = targets.get(name)
+                        doc = fitz.open()
+                        with metrics.span('insert_pdf'):
+                            doc.insert_pdf(source_doc, from_page=page_num-1, to_page=page_num-1)
+                        target = targets[name] = _Target(
+                            os.path.join(sorted_folder, name), doc,
+                            on_disk=previous is not None and previous.on_disk
+                        )
+                        target.modified = True
+                        results.append({'op': kind, 'name': name, 'page_count': 1})
+
+                    elif kind == 'append':
+                        name = op.get('target') or ''
+                        page_num = op.get('page')
+                        _check_page(page_num, total_pages, index)
+                        target = _load_target(targets, sorted_folder, name)
+                        if target is None:
+                            raise SortedOpError('PDF destino no encontrado', status=404, index=index)
+
+                        with metrics.span('insert_pdf'):
+                            target.doc.insert_pdf(source_doc, from_page=page_num-1, to_page=page_num-1)
+                        target.modified = True
+                        results.append({'op': kind, 'target': name, 'page_count': len(target.doc)})
+
+                    else:
+                        name = op.get('target') or ''
+                        target = _load_target(targets, sorted_folder, name)
+                        if target is None:
+                            raise SortedOpError('PDF no encontrado', status=404, index=index)
+
+                        if len(target.doc) <= 1:
+                            # Si solo tiene 1 página, se elimina el PDF completo
+                            target.doc.close()
+                            target.deleted = True
+                            results.append({'op': kind, 'target': name, 'page_count': 0})
+                        else:
+                            target.doc.delete_page(-1)
+                            target.modified = True
+                            results.append({'op': kind, 'target': name, 'page_count': len(target.doc)})
+
+            _commit(sorted_folder, targets)
+        finally:
+            for target in targets.values():
+                if not target.deleted:
+                    target.doc.close()
+
+    return results
+
+
+def _commit(sorted_folder, targets):
+    """Guarda los destinos modificados con rollback si algo falla.
+
+    Los PDFs nuevos se guardan completos en temporales; los que ya existen se
+    guardan de forma incremental con journal (la compactación queda para el
+    trabajo en segundo plano, salvo que se pase el límite). Solo si todo se
+    escribió bien se reemplazan los temporales y se borran los journals.
+    """
+    if any(t.modified and not t.deleted for t in targets.values()):
+        os.makedirs(sorted_folder, exist_ok=True)
+
+    written = []  # (temporal, destino)
+    journaled = []  # (destino, tamaño previo, estado nuevo)
+    try:
+        for target in targets.values():
+            if target.deleted or not target.modified:
+                continue
+
+            state = _read_state(target.path) if target.on_disk else None
+            if (SORTED_INCREMENTAL and target.on_disk and target.doc.name == target.path
+                    and target.doc.can_save_incrementally()
+                    and state['updates'] < COMPACT_HARD_LIMIT_UPDATES):
+                journaled.append(_save_incremental(target, state))
+            else:
+                temp_path = f"{target.path}.{uuid.uuid4().hex}.tmp"
+                written.append((temp_path, target.path))
+                # Guardado completo: también compacta (elimina objetos huérfanos)
+                with metrics.span('save'):
+                    target.doc.save(temp_path, garbage=3, deflate=True)
+                metrics.inc('pdfsorter_bytes_written_total', os.path.getsize(temp_path),
+                            kind='sorted')
+    except Exception:
+        # Rollback: truncar los incrementales y descartar los temporales
+        for path, previous_size, _ in journaled:
+            with open(path, 'r+b') as f:
+                f.truncate(previous_size)
+            os.remove(_journal_path(path))
+        for temp_path, _ in written:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        raise
+
+    for path, _, state in journaled:
+        _write_state(path, state)
+        os.remove(_journal_path(path))
+        document_pool.invalidate(path)
+
+    for temp_path, path in written:
+        os.replace(temp_path, path)
+        _write_state(path, {'base_size': os.path.getsize(path), 'updates': 0})
+        document_pool.invalidate(path)
+
+    for target in targets.values():
+        if target.deleted and target.on_disk and os.path.exists(target.path):
+            os.remove(target.path)
+            _remove_sidecars(target.path)
+            document_pool.invalidate(target.path)
+
+
+def _save_incremental(target, state):
+    """Agrega los cambios de un destino al final de su archivo, con journal."""
+    previous_size = os.path.getsize(target.path)
+
+    # El journal guarda el tamaño previo para poder truncar si el proceso muere
+    journal = _journal_path(target.path)
+    with open(journal, 'w') as f:
+        json.dump({'size': previous_size}, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    try:
+        with metrics.span('save_incremental'):
+            target.doc.saveIncr()
+            with open(target.path, 'rb') as f:
+                os.fsync(f.fileno())
+    except Exception:
+        with open(target.path, 'r+b') as f:
+            f.truncate(previous_size)
+        os.remove(journal)
+        raise
+
+    metrics.inc('pdfsorter_bytes_written_total', os.path.getsize(target.path) - previous_size,
+                kind='sorted')
+    new_state = {'base_size': state['base_size'], 'updates': state['updates'] + 1}
+    return target.path, previous_size, new_state
+
+
+def compact(path):
+    """Reescribe un PDF completo (garbage + deflate) y reinicia su estado incremental."""
+    recover_incremental(path)
+    state = _read_state(path)
+    if state['updates'] == 0:
+        return False
+
+    doc = fitz.open(path)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with metrics.span('save'):
+            doc.save(temp_path, garbage=3, deflate=True)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        doc.close()
+
+    os.replace(temp_path, path)
+    size = os.path.getsize(path)
+    metrics.inc('pdfsorter_bytes_written_total', size, kind='compact')
+    _write_state(path, {'base_size': size, 'updates': 0})
+    document_pool.invalidate(path)
+    return True
+
+
+def compact_folder(sorted_folder, progress=None, only_needed=False):
+    """Compacta los PDFs de una carpeta sorted que tengan guardados incrementales.
+
+    Se usa antes de descargar, para que el ZIP no incluya el historial de
+    cambios (p. ej. páginas deshechas) dentro de cada PDF, y desde el trabajo
+    de compactación (`only_needed=True`: solo los que pasaron los umbrales).
+    `progress(hechos, total)` se llama después de cada PDF.
+    """
+    if not os.path.isdir(sorted_folder):
+        return
+    with _folder_lock(sorted_folder):
+        recover_folder(sorted_folder)
+        names = [f for f in os.listdir(sorted_folder) if f.lower().endswith('.pdf')]
+        for done, name in enumerate(names, start=1):
+            path = os.path.join(sorted_folder, name)
+            if not only_needed or _needs_compaction(path, _read_state(path)):
+                compact(path)
+            if progress is not None:
+                progress(done, len(names))
+
+
+def pending_compaction(sorted_folder):
+    """Indica si algún PDF de la carpeta pasó los umbrales de compactación."""
+    if SORTED_STORAGE == 'manifest' or not os.path.isdir(sorted_folder):
+        return False
+    for f in os.listdir(sorted_folder):
+        path = os.path.join(sorted_folder, f)
+        if f.lower().endswith('.pdf') and os.path.exists(_state_path(path)):
+            if _needs_compaction(path, _read_state(path)):
+                return True
+    return False
+
+
+# ---------- Consultas (independientes del modo de almacenamiento) ----------
+
+def list_outputs(sorted_folder):
+    """Nombres de los PDFs clasificados de una carpeta sorted, ordenados."""
+    if SORTED_STORAGE == 'manifest':
+        return sorted(read_manifest(sorted_folder)['outputs'])
+
+    pdfs = []
+    if os.path.exists(sorted_folder):
+        for f in os.listdir(sorted_folder):
+            if f.lower().endswith('.pdf'):
+                pdfs.append(f)
+    pdfs.sort()
+    return pdfs
+
+
+def output_exists(sorted_folder, name):
+    """Indica si ya existe un PDF clasificado con ese nombre."""
+    if SORTED_STORAGE == 'manifest':
+        return name in read_manifest(sorted_folder)['outputs']
+    return os.path.exists(os.path.join(sorted_folder, name))
+
+
+def outputs_stamp(sorted_folder):
+    """Marca que cambia cada vez que puede cambiar `list_outputs` ([] si no hay carpeta)."""
+    path = _manifest_path(sorted_folder) if SORTED_STORAGE == 'manifest' else sorted_folder
+    try:
+        st = os.stat(path)
+    except OSError:
+        return []
+    return [st.st_ino, st.st_mtime_ns]
+
+
+def export_outputs(source_path, sorted_folder, progress=None):
+    """Deja los PDFs clasificados listos para descargar y devuelve [(nombre, ruta)].
+
+    En modo pdf compacta los guardados incrementales pendientes; en modo
+    manifest construye los PDFs reales (solo si el manifest cambió).
+    `progress(hechos, total)` se llama después de cada PDF.
+    """
+    if SORTED_STORAGE == 'manifest':
+        return _materialize(source_path, sorted_folder, progress)
+
+    compact_folder(sorted_folder, progress)
+    return [(name, os.path.join(sorted_folder, name)) for name in list_outputs(sorted_folder)]
+
+
+def _export_pending(sorted_folder):
+    """Indica si `export_outputs` todavía tiene algo que hacer en la carpeta."""
+    if SORTED_STORAGE == 'manifest':
+        manifest = read_manifest(sorted_folder)
+        try:
+            with open(os.path.join(sorted_folder, EXPORT_DIRNAME, '.version')) as f:
+                return int(f.read()) != manifest['version']
+        except (OSError, ValueError):
+            return bool(manifest['outputs'])
+
+    for f in os.listdir(sorted_folder):
+        if f.startswith('.') and f.endswith('.journal'):
+            return True
+        path = os.path.join(sorted_folder, f)
+        if f.lower().endswith('.pdf') and _read_state(path)['updates'] > 0:
+            return True
+    return False
+
+
+@contextmanager
+def exported_outputs(sorted_folder):
+    """PDFs clasificados ya listos para descargar, [(nombre, ruta)], sin prepararlos.
+
+    Lanza ExportPending si antes hay que correr `export_outputs`. Mientras
+    dura el bloque la carpeta está bloqueada: alcanza para armar el plan del
+    ZIP sin que un click cambie los archivos en el medio.
+    """
+    if not os.path.isdir(sorted_folder):
+        yield []
+        return
+    with _folder_lock(sorted_folder):
+        if _export_pending(sorted_folder):
+            raise ExportPending()
+        if SORTED_STORAGE == 'manifest':
+            export_folder = os.path.join(sorted_folder, EXPORT_DIRNAME)
+            yield [(name, os.path.join(export_folder, name))
+                   for name in sorted(read_manifest(sorted_folder)['outputs'])]
+        else:
+            yield [(name, os.path.join(sorted_folder, name)) for name in list_outputs(sorted_folder)]
+
+
+# ---------- Modo manifest ----------
+
+def _manifest_path(sorted_folder):
+    return os.path.join(sorted_folder, MANIFEST_FILENAME)
+
+
+def read_manifest(sorted_folder):
+    """Lee el manifest de una carpeta sorted: {'version': N, 'outputs': {nombre: [páginas]}}."""
+    try:
+        with open(_manifest_path(sorted_folder)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'version': 0, 'outputs': {}}
+
+
+def _write_manifest(sorted_folder, manifest):
+    os.makedirs(sorted_folder, exist_ok=True)
+    path = _manifest_path(sorted_folder)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, path)
+
+
+def _apply_manifest_operations(source_path, sorted_folder, operations):
+    """Aplica el lote sobre el manifest: solo se escribe un JSON pequeño."""
+    results = []
+
+    with _folder_lock(sorted_folder):
+        manifest = read_manifest(sorted_folder)
+        outputs = manifest['outputs']
+
+        needs_source = any(isinstance(op, dict) and op.get('op') in ('create', 'append')
+                           for op in operations)
+        total_pages = document_pool.page_count(source_path) if needs_source else 0
+
+        for index, op in enumerate(operations):
+            kind = op.get('op') if isinstance(op, dict) else None
+            if kind not in OPERATIONS:
+                raise SortedOpError(f'Operación desconocida: {kind}', index=index)
+
+            if kind == 'create':
+                name = normalize_pdf_name(op.get('name') or '')
+                page_num = op.get('page')
+                _check_page(page_num, total_pages, index)
+                if name in outputs:
+                    raise SortedOpError('Ya existe un PDF con este nombre', index=index)
+                outputs[name] = [page_num]
+                results.append({'op': kind, 'name': name, 'page_count': 1})
+
+            elif kind == 'append':
+                name = op.get('target') or ''
+                page_num = op.get('page')
+                _check_page(page_num, total_pages, index)
+                if name not in outputs:
+                    raise SortedOpError('PDF destino no encontrado', status=404, index=index)
+                outputs[name].append(page_num)
+                results.append({'op': kind, 'target': name, 'page_count': len(outputs[name])})
+
+            else:
+                name = op.get('target') or ''
+                if name not in outputs:
+                    raise SortedOpError('PDF no encontrado', status=404, index=index)
+                outputs[name].pop()
+                if not outputs[name]:
+                    del outputs[name]
+                results.append({'op': kind, 'target': name, 'page_count': len(outputs.get(name, []))})
+
+        manifest['version'] += 1
+        _write_manifest(sorted_folder, manifest)
+
+    return results
+
+
+def page_runs(pages):
+    """Agrupa una lista de páginas en tramos contiguos [(desde, hasta), ...]."""
+    runs = []
+    for page_num in pages:
+        if runs and page_num == runs[-1][1] + 1:
+            runs[-1][1] = page_num
+        else:
+            runs.append([page_num, page_num])
+    return [tuple(run) for run in runs]
+
+
+def _materialize(source_path, sorted_folder, progress=None):
+    """Construye los PDFs reales del manifest en `.export/`, abriendo el fuente una vez."""
+    export_folder = os.path.join(sorted_folder, EXPORT_DIRNAME)
+    version_path = os.path.join(export_folder, '.version')
+
+    with _folder_lock(sorted_folder):
+        manifest = read_manifest(sorted_folder)
+        outputs = manifest['outputs']
+
+        try:
+            with open(version_path) as f:
+                up_to_date = int(f.read()) == manifest['version']
+        except (OSError, ValueError):
+            up_to_date = False
+
+        if not up_to_date:
+            if os.path.exists(export_folder):
+                shutil.rmtree(export_folder)
+            os.makedirs(export_folder)
+
+            if outputs:
+                with document_pool.acquire(source_path) as source_doc:
+                    for done, (name, pages) in enumerate(outputs.items(), start=1):
+                        doc = fitz.open()
+                        # Copiar por tramos contiguos: menos llamadas y recursos compartidos
+                        with metrics.span('insert_pdf'):
+                            for start, end in page_runs(pages):
+                                doc.insert_pdf(source_doc, from_page=start-1, to_page=end-1)
+                        path = os.path.join(export_folder, name)
+                        with metrics.span('save'):
+                            doc.save(path, garbage=3, deflate=True)
+                        doc.close()
+                        metrics.inc('pdfsorter_bytes_written_total', os.path.getsize(path),
+                                    kind='export')
+                        if progress is not None:
+                            progress(done, len(outputs))
+
+            with open(version_path, 'w') as f:
+                f.write(str(manifest['version']))
+
+    return [(name, os.path.join(export_folder, name)) for name in sorted(outputs)]
+
+
+# ---------- División en lote ----------
+
+def build_output(doc, runs, path, dedupe=False):
+    """Guarda en `path` un PDF con los tramos `runs` de `doc` (corre en el pool de procesos).
+
+    Con `dedupe` el guardado además une los objetos idénticos (fuentes e
+    imágenes repetidas en el fuente); es más lento pero el PDF queda más chico.
+    """
+    out = fitz.open()
+    try:
+        with metrics.span('insert_pdf'):
+            for start, end in runs:
+                out.insert_pdf(doc, from_page=start-1, to_page=end-1)
+        with metrics.span('save'):
+            out.save(path, garbage=4 if dedupe else 3, deflate=True)
+        metrics.inc('pdfsorter_bytes_written_total', os.path.getsize(path), kind='split')
+        return len(out)
+    finally:
+        out.close()
+
+
+def _check_split(outputs, total_pages, exists, replace):
+    for index, (name, pages) in enumerate(outputs):
+        if not pages:
+            raise SortedOpError('La salida no tiene páginas', index=index)
+        for page_num in pages:
+            _check_page(page_num, total_pages, index)
+        if not replace and exists(name):
+            raise SortedOpError('Ya existe un PDF con este nombre', status=409, index=index)
+
+
+def split_outputs(source_path, sorted_folder, outputs, replace=False, dedupe=False,
+                  progress=None, check=None):
+    """Crea varios PDFs clasificados de una vez a partir de páginas del fuente.
+
+    `outputs` es una lista [(nombre, [páginas])]. Si algún nombre ya existe
+    (y no se pidió `replace`) o alguna página no existe, lanza SortedOpError
+    sin tocar el disco. `progress(hechos, total)` se llama después de cada
+    PDF construido y `check()` mientras cada uno espera su turno en el pool
+    de lotes (`render_engine.run_background`). Devuelve [{'name', 'page_count'}].
+    """
+    if SORTED_STORAGE == 'manifest':
+        return _split_manifest(source_path, sorted_folder, outputs, replace)
+
+    def exists(name):
+        return os.path.exists(os.path.join(sorted_folder, name))
+
+    _check_split(outputs, document_pool.page_count(source_path), exists, replace)
+    os.makedirs(sorted_folder, exist_ok=True)
+
+    temps = {}  # nombre -> temporal
+    executor = ThreadPoolExecutor(max_workers=SPLIT_PARALLEL, thread_name_prefix='split')
+    try:
+        futures = {}
+        for name, pages in outputs:
+            temp_path = os.path.abspath(
+                f"{os.path.join(sorted_folder, name)}.{uuid.uuid4().hex}.tmp"
+            )
+            temps[name] = temp_path
+            future = executor.submit(render_engine.run_background, build_output, source_path,
+                                     page_runs(pages), temp_path, dedupe, check=check)
+            futures[future] = name
+
+        page_counts = {}
+        for done, future in enumerate(as_completed(futures), start=1):
+            page_counts[futures[future]] = future.result()
+            if progress is not None:
+                progress(done, len(outputs))
+
+        # Recién con todo construido: volver a verificar y mover a su lugar
+        with _folder_lock(sorted_folder):
+            _check_split(outputs, document_pool.page_count(source_path), exists, replace)
+            for name, _ in outputs:
+                path = os.path.join(sorted_folder, name)
+                _remove_sidecars(path)
+                os.replace(temps.pop(name), path)
+                _write_state(path, {'base_size': os.path.getsize(path), 'updates': 0})
+                document_pool.invalidate(path)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for temp_path in temps.values():
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    return [{'name': name, 'page_count': page_counts[name]} for name, _ in outputs]
+
+
+def _split_manifest(source_path, sorted_folder, outputs, replace):
+    """División en modo manifest: solo se agregan las listas de páginas al JSON."""
+    total_pages = document_pool.page_count(source_path)
+    with _folder_lock(sorted_folder):
+        manifest = read_manifest(sorted_folder)
+        _check_split(outputs, total_pages, manifest['outputs'].__contains__, replace)
+        for name, pages in outputs:
+            manifest['outputs'][name] = list(pages)
+        manifest['version'] += 1
+        _write_manifest(sorted_folder, manifest)
+
+    return [{'name': name, 'page_count': len(pages)} for name, pages in outputs]
@@ -0,0 +1,124 @@
+"""Lectura de los pedidos de división en lote (`/split`).
+
+Un pedido dice qué páginas del PDF fuente van a cada PDF nuevo. Se acepta:
+
+- JSON con un objeto nombre -> páginas:
+    {"outputs": {"A": "1-12", "B": "13-40, 45"}}
+- JSON con una lista (respeta el orden):
+    {"outputs": [{"name": "A", "pages": "1-12"}, {"name": "B", "pages": [13, "14-20"]}]}
+- CSV con filas `nombre,páginas` (encabezado opcional); un nombre repetido
+  agrega sus páginas a la misma salida:
+    A,1-12
+    B,13-40
+    A,41
+
+Las páginas se escriben como rangos separados por coma: "1-3, 7, 9-10"; un
+rango abierto ("41-") llega hasta la última página.
+"""
+import io
+import os
+import re
+import csv
+
+from sorted_store import normalize_pdf_name, SortedOpError
+
+# Máximo de PDFs que se pueden crear en un solo pedido
+SPLIT_MAX_OUTPUTS = int(os.environ.get('SPLIT_MAX_OUTPUTS', '500'))
+
+# "7", "1-12" o "41-"
+_RANGE_RE = re.compile(r"^(\d+)(?:\s*-\s*(\d*))?$")
+
+# Encabezados reconocidos en la primera fila de un CSV
+_CSV_HEADERS = {'name', 'nombre', 'pages', 'paginas', 'páginas'}
+
+
+def parse_pages(spec, total_pages):
+    """Convierte una especificación de páginas en una lista de números.
+
+    `spec` puede ser un número, un texto de rangos ("1-3, 7, 9-") o una
+    lista de ambos. Lanza ValueError si algún rango no es válido.
+    """
+    if isinstance(spec, bool):
+        raise ValueError('Número de página inválido')
+    if isinstance(spec, int):
+        return [spec]
+    if isinstance(spec, list):
+        pages = []
+        for item in spec:
+            pages.extend(parse_pages(item, total_pages))
+        return pages
+    if not isinstance(spec, str):
+        raise ValueError('Número de página inválido')
+
+    pages = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        match = _RANGE_RE.match(part)
+        if not match:
+            raise ValueError(f'Rango inválido: {part}')
+        start = int(match.group(1))
+        if match.group(2) is None:
+            end = start
+        else:
+            end = int(match.group(2)) if match.group(2) else total_pages
+        if end < start:
+            raise ValueError(f'Rango inválido: {part}')
+        if end > total_pages:
+            raise ValueError(f'La página {end} no existe')
+        pages.extend(range(start, end + 1))
+    return pages
+
+
+def _rows_from_json(outputs):
+    if isinstance(outputs, dict):
+        return list(outputs.items())
+    if isinstance(outputs, list):
+        rows = []
+        for item in outputs:
+            if not isinstance(item, dict):
+                raise SortedOpError('Cada salida debe tener "name" y "pages"', index=len(rows))
+            rows.append((item.get('name'), item.get('pages')))
+        return rows
+    raise SortedOpError('No se enviaron salidas')
+
+
+def _rows_from_csv(text):
+    rows = []
+    for line, row in enumerate(csv.reader(io.StringIO(text))):
+        row = [cell.strip() for cell in row]
+        if not any(row):
+            continue
+        if line == 0 and row[0].lower() in _CSV_HEADERS:
+            continue
+        if len(row) < 2:
+            raise SortedOpError(f'Fila {line + 1}: se esperaba "nombre,páginas"', index=len(rows))
+        # Las páginas pueden venir en varias columnas ("A,1-3,7")
+        rows.append((row[0], ','.join(row[1:])))
+    return rows
+
+
+def parse_split_request(data, csv_text, total_pages):
+    """Arma la lista ordenada [(nombre.pdf, [páginas])] de un pedido de división.
+
+    `data` es el JSON del pedido y `csv_text` el CSV (si se envió uno). Lanza
+    SortedOpError (con `index` de la salida) si el pedido no es válido.
+    """
+    rows = _rows_from_csv(csv_text) if csv_text is not None else _rows_from_json(data.get('outputs'))
+
+    outputs = {}  # nombre -> páginas (en orden de aparición)
+    for index, (name, spec) in enumerate(rows):
+        if not isinstance(name, str) or not name.strip():
+            raise SortedOpError('El nombre no puede estar vacío', index=index)
+        try:
+            pages = parse_pages(spec, total_pages)
+        except ValueError as e:
+            raise SortedOpError(str(e), index=index)
+        outputs.setdefault(normalize_pdf_name(name.strip()), []).extend(pages)
+
+    if not outputs:
+        raise SortedOpError('No se enviaron salidas')
+    if len(outputs) > SPLIT_MAX_OUTPUTS:
+        raise SortedOpError(f'Demasiadas salidas (máximo {SPLIT_MAX_OUTPUTS})')
+    return list(outputs.items())
@@ -0,0 +1,376 @@
+"""Almacenamiento de las sesiones: locks entre procesos y backends intercambiables.
+
+Locks: `file_lock(path)` toma un lock de aviso (fcntl.flock) sobre
+`.<nombre>.lock`, al lado de `path`. A diferencia de un threading.Lock, lo
+respetan todos los workers de gunicorn del nodo (y los de otros nodos si la
+carpeta está en un disco compartido con soporte de flock). Los temporales
+siempre llevan un nombre único (`temp_path`), así dos escrituras
+concurrentes del mismo archivo nunca pisan el mismo `.tmp`.
+
+Backends (`SESSION_STORE`):
+
+- 'local' (por defecto): las sesiones viven solo en BASE_PDF_FOLDER, que
+  todos los workers y réplicas deben compartir.
+- 's3': las sesiones se guardan en un bucket S3 o compatible (MinIO, moto
+  con `S3_ENDPOINT_URL`) y BASE_PDF_FOLDER es solo una caché de lectura: al
+  atender una sesión se traen los archivos que cambiaron en el bucket
+  (`pull`) y después de cada escritura se suben los que cambiaron en disco
+  (`push`). Así cualquier réplica puede atender cualquier sesión sin
+  sesiones pegajosas. Necesita `boto3`.
+
+Qué se sincroniza: los PDFs de la sesión y de sus carpetas -sorted, y de
+los archivos ocultos solo `.manifest.json` (la lista de páginas del modo
+manifest) y `.<pdf>.incr.json` (estado de guardados incrementales, para que
+la compactación siga contando en otra réplica). No se sincronizan los
+journals de guardados en curso (`.<pdf>.journal`: solo sirven para
+recuperar el disco del nodo que escribía), los locks (`.<nombre>.lock`), los
+temporales (`.tmp`) ni las carpetas ocultas: cachés, índices y trabajos
+(`.render-cache`, `.index`, `.jobs`, ...) son locales a cada nodo y se
+reconstruyen solos.
+
+`file_lock` solo ordena las escrituras dentro de un nodo. Entre réplicas,
+`push` sube cada archivo con escritura condicional (`If-Match` con el ETag
+que se vio por última vez, o `If-None-Match: *` si es nuevo) y borra con
+`If-Match`: si otra réplica lo cambió en el medio, el bucket gana, se trae
+su versión y se cuenta un conflicto en vez de pisarla.
+"""
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl  # No existe en Windows: ahí los locks son solo entre hilos
+except ImportError:
+    fcntl = None
+
+try:
+    import boto3  # Opcional: solo para SESSION_STORE=s3
+except ImportError:
+    boto3 = None
+
+# Backend de almacenamiento de las sesiones: 'local' o 's3'
+SESSION_STORE = os.environ.get('SESSION_STORE', 'local')
+
+# Bucket, prefijo y endpoint (MinIO/moto) para SESSION_STORE=s3
+S3_BUCKET = os.environ.get('S3_BUCKET', '')
+S3_PREFIX = os.environ.get('S3_PREFIX', 'sessions/')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None
+
+# Cada cuánto, como máximo, se consulta el bucket por cambios de una sesión
+STORE_PULL_INTERVAL = float(os.environ.get('STORE_PULL_INTERVAL', '2'))
+
+# Carpeta (dentro de la sesión) con el estado de sincronización
+STORE_DIRNAME = '.store'
+STORE_STATE_FILENAME = 'state.json'
+
+# Escrituras condicionales (If-Match / If-None-Match); desactivar solo para
+# backends compatibles que no las soporten
+S3_CONDITIONAL_WRITES = os.environ.get('S3_CONDITIONAL_WRITES', '1') == '1'
+
+# Archivos ocultos que se sincronizan: la lista de páginas del modo manifest...
+SYNCED_HIDDEN_FILES = {'.manifest.json'}
+
+# ...y el estado de guardados incrementales de cada PDF (`.<pdf>.incr.json`)
+SYNCED_HIDDEN_SUFFIXES = ('.incr.json',)
+
+# Errores del bucket que indican que otra réplica escribió primero
+_CONFLICT_CODES = {'PreconditionFailed', 'ConditionalRequestConflict', '412', '409'}
+
+
+def temp_path(path):
+    """Nombre de temporal único para escribir `path` y luego hacer os.replace."""
+    return f"{path}.{uuid.uuid4().hex}.tmp"
+
+
+def _lock_path(path):
+    folder, name = os.path.split(os.path.normpath(path))
+    return os.path.join(folder, f".{name}.lock")
+
+
+@contextmanager
+def file_lock(path, shared=False, blocking=True):
+    """Lock de aviso entre procesos sobre `path` (el archivo puede no existir).
+
+    Con `blocking=False` lanza BlockingIOError si otro lo tiene tomado.
+    """
+    if fcntl is None:
+        yield
+        return
+    lock_path = _lock_path(path)
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        fcntl.flock(fd, flags)
+        yield
+    finally:
+        # Cerrar el descriptor libera el lock
+        os.close(fd)
+
+
+def remove_lock(path):
+    """Borra el archivo de lock de `path` (cuando `path` ya no se va a usar)."""
+    try:
+        os.remove(_lock_path(path))
+    except OSError:
+        pass
+
+
+def _is_synced(relpath):
+    """Indica si un archivo de la sesión (ruta relativa) se guarda en el backend."""
+    parts = relpath.split('/')
+    if len(parts) > 2 or relpath.endswith('.tmp'):
+        return False
+    if any(p.startswith('.') for p in parts[:-1]):
+        return False
+    name = parts[-1]
+    if name.startswith('.'):
+        return name in SYNCED_HIDDEN_FILES or name.endswith(SYNCED_HIDDEN_SUFFIXES)
+    return True
+
+
+def _local_files(user_folder, relpath=''):
+    """Archivos sincronizables de la sesión bajo `relpath`: {ruta relativa: marca}."""
+    files = {}
+    top = os.path.join(user_folder, relpath) if relpath else user_folder
+    if os.path.isfile(top):
+        if _is_synced(relpath):
+            st = os.stat(top)
+            files[relpath] = [st.st_size, st.st_mtime_ns]
+        return files
+    for root, dirs, names in os.walk(top):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in names:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, user_folder).replace(os.sep, '/')
+            if _is_synced(rel):
+                st = os.stat(path)
+                files[rel] = [st.st_size, st.st_mtime_ns]
+    return files
+
+
+def _under(rel, relpath):
+    return not relpath or rel == relpath or rel.startswith(relpath.rstrip('/') + '/')
+
+
+class LocalStore:
+    """Sesiones solo en el disco local (compartido por todos los workers)."""
+
+    remote = False
+
+    def pull(self, session_id, user_folder, force=False):
+        """No hace nada: el disco es el almacenamiento."""
+
+    def push(self, session_id, user_folder, relpath=''):
+        """No hace nada: el disco es el almacenamiento."""
+
+    def stats(self):
+        return {'backend': 'local'}
+
+
+class S3Store:
+    """Sesiones en un bucket S3 (o compatible) con caché de lectura en disco local.
+
+    El estado de sincronización de cada sesión (`.store/state.json`) guarda,
+    por archivo, el ETag del bucket y la marca (tamaño, mtime) del archivo
+    local: así `pull` solo descarga lo que cambió en el bucket y `push` solo
+    sube lo que cambió en disco, condicionado a que el bucket siga teniendo
+    ese ETag.
+    """
+
+    remote = True
+
+    def __init__(self, bucket=S3_BUCKET, prefix=S3_PREFIX, endpoint_url=S3_ENDPOINT_URL,
+                 client=None):
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError('SESSION_STORE=s3 necesita boto3 (pip install boto3)')
+            client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._last_pull = {}  # id de sesión -> momento del último pull
+        self.downloaded = 0
+        self.uploaded = 0
+        self.deleted = 0
+        self.conflicts = 0
+
+    def _key(self, session_id, relpath):
+        return f"{self.prefix}{session_id}/{relpath}"
+
+    def _state_path(self, user_folder):
+        return os.path.join(user_folder, STORE_DIRNAME, STORE_STATE_FILENAME)
+
+    def _read_state(self, user_folder):
+        try:
+            with open(self._state_path(user_folder)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'files': {}}
+
+    def _write_state(self, user_folder, state):
+        path = self._state_path(user_folder)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = temp_path(path)
+        with open(temp, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp, path)
+
+    def _remote_files(self, session_id):
+        """Objetos de la sesión en el bucket: {ruta relativa: ETag}."""
+        prefix = self._key(session_id, '')
+        files = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                rel = obj['Key'][len(prefix):]
+                if _is_synced(rel):
+                    files[rel] = obj['ETag']
+        return files
+
+    def _download(self, session_id, user_folder, rel, known):
+        """Reemplaza la copia local de `rel` por la del bucket (False si ya no existe)."""
+        path = os.path.join(user_folder, *rel.split('/'))
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(session_id, rel))
+        except self.client.exceptions.NoSuchKey:
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = temp_path(path)
+        with open(temp, 'wb') as f:
+            for chunk in response['Body'].iter_chunks():
+                f.write(chunk)
+        os.replace(temp, path)
+        st = os.stat(path)
+        known[rel] = {'etag': response['ETag'], 'stamp': [st.st_size, st.st_mtime_ns]}
+        self.downloaded += 1
+        return True
+
+    def _conditions(self, entry):
+        """Parámetros de escritura condicional según el último ETag visto."""
+        if not S3_CONDITIONAL_WRITES:
+            return {}
+        if entry is None:
+            return {'IfNoneMatch': '*'}
+        return {'IfMatch': entry['etag']}
+
+    def _upload(self, session_id, user_folder, rel, entry):
+        """Sube `rel` si el bucket sigue con el ETag de `entry` (o sin el objeto, si es nuevo)."""
+        try:
+            with open(os.path.join(user_folder, *rel.split('/')), 'rb') as f:
+                return self.client.put_object(
+                    Bucket=self.bucket, Key=self._key(session_id, rel), Body=f,
+                    **self._conditions(entry)
+                )
+        except self.client.exceptions.NoSuchKey:
+            if entry is None:
+                raise
+            # Borrado en otra réplica mientras se modificaba acá: la
+            # modificación gana y el archivo se vuelve a crear
+            return self._upload(session_id, user_folder, rel, None)
+
+    def _conflict(self, session_id, user_folder, rel, known, error):
+        """Otra réplica cambió `rel` en el bucket: su versión gana sobre la local."""
+        code = error.response.get('Error', {}).get('Code')
+        if code not in _CONFLICT_CODES:
+            raise error
+        print(f"Conflicto al sincronizar {session_id}/{rel}: se usa la versión del bucket")
+        self.conflicts += 1
+        known.pop(rel, None)
+        self._download(session_id, user_folder, rel, known)
+
+    def pull(self, session_id, user_folder, force=False):
+        """Trae a disco los archivos de la sesión que cambiaron (o se borraron) en el bucket."""
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_pull.get(session_id)
+            if not force and last is not None and now - last < STORE_PULL_INTERVAL:
+                return
+            self._last_pull[session_id] = now
+
+        with file_lock(self._state_path(user_folder)):
+            state = self._read_state(user_folder)
+            known = state['files']
+            remote = self._remote_files(session_id)
+            local = _local_files(user_folder)
+            changed = False
+
+            for rel, etag in remote.items():
+                entry = known.get(rel)
+                if entry is not None and entry['etag'] == etag and rel in local:
+                    continue
+                self._download(session_id, user_folder, rel, known)
+                changed = True
+
+            # Borrado en otra réplica: quitar la copia local si no se modificó acá
+            for rel in [r for r in known if r not in remote]:
+                if local.get(rel) == known[rel]['stamp']:
+                    os.remove(os.path.join(user_folder, *rel.split('/')))
+                del known[rel]
+                changed = True
+
+            if changed:
+                self._write_state(user_folder, state)
+
+    def push(self, session_id, user_folder, relpath=''):
+        """Sube los archivos bajo `relpath` que cambiaron en disco y borra del bucket los que ya no están."""
+        with file_lock(self._state_path(user_folder)):
+            state = self._read_state(user_folder)
+            known = state['files']
+            local = _local_files(user_folder, relpath)
+            changed = False
+
+            for rel, stamp in local.items():
+                entry = known.get(rel)
+                if entry is not None and entry['stamp'] == stamp:
+                    continue
+                changed = True
+                try:
+                    response = self._upload(session_id, user_folder, rel, entry)
+                except self.client.exceptions.ClientError as e:
+                    self._conflict(session_id, user_folder, rel, known, e)
+                    continue
+                known[rel] = {'etag': response['ETag'], 'stamp': stamp}
+                self.uploaded += 1
+
+            for rel in [r for r in known if _under(r, relpath) and r not in local]:
+                changed = True
+                try:
+                    self.client.delete_object(Bucket=self.bucket, Key=self._key(session_id, rel),
+                                              **self._conditions(known[rel]))
+                except self.client.exceptions.NoSuchKey:
+                    pass
+                except self.client.exceptions.ClientError as e:
+                    self._conflict(session_id, user_folder, rel, known, e)
+                    continue
+                del known[rel]
+                self.deleted += 1
+
+            if changed:
+                self._write_state(user_folder, state)
+
+    def stats(self):
+        return {
+            'backend': 's3',
+            'bucket': self.bucket,
+            'downloaded': self.downloaded,
+            'uploaded': self.uploaded,
+            'deleted': self.deleted,
+            'conflicts': self.conflicts,
+        }
+
+
+def create_store():
+    """Backend configurado con SESSION_STORE."""
+    if SESSION_STORE == 's3':
+        return S3Store()
+    return LocalStore()
+
+
+session_store = create_store()
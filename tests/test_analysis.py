@@ -0,0 +1,49 @@
+"""Agrupamiento automático de páginas (analysis.propose_groups)."""
+import fitz  # PyMuPDF
+import numpy as np
+
+from analysis import extract_features, propose_groups, TEXT_DIM
+
+
+def make_doc(lines):
+    """PDF con una página por elemento: una línea de texto, o en blanco si es None."""
+    doc = fitz.open()
+    for line in lines:
+        page = doc.new_page()
+        if line is not None:
+            page.insert_text((72, 72), line, fontsize=11)
+    return doc
+
+
+def test_sparse_text_pages_are_not_blank():
+    doc = make_doc(['Factura numero cliente importe'] * 10)
+    features = extract_features(doc, 1, len(doc))
+    assert all(f['ink'] < 0.003 for f in features)  # poca tinta a 64px de ancho
+
+    proposal = propose_groups(features)
+    assert proposal['blank'] == []
+    assert sorted(p for g in proposal['groups'] for p in g['pages']) == list(range(1, 11))
+
+
+def test_pages_without_text_or_ink_are_blank():
+    doc = make_doc(['Factura numero cliente importe', None, 'Factura numero cliente importe'])
+    proposal = propose_groups(extract_features(doc, 1, len(doc)))
+    assert proposal['blank'] == [2]
+    assert sorted(p for g in proposal['groups'] for p in g['pages']) == [1, 3]
+
+
+def feature(page, text, size):
+    vector = np.zeros(TEXT_DIM, dtype=np.float32)
+    if text:
+        vector[0] = 1
+    return {'page': page, 'text': vector, 'keywords': [], 'dhash': 0x0F0F0F0F0F0F0F0F,
+            'ink': 0.1, 'size': size, 'rotation': 0}
+
+
+def test_hash_only_merge_needs_both_segments_without_text():
+    # 1-2 con texto, 3-4 y 5-6 escaneos sin texto; todos con el mismo dHash
+    features = [feature(1, True, (595, 842)), feature(2, True, (595, 842)),
+                feature(3, False, (612, 792)), feature(4, False, (612, 792)),
+                feature(5, False, (595, 842)), feature(6, False, (595, 842))]
+    groups = [g['pages'] for g in propose_groups(features)['groups']]
+    assert groups == [[1, 2], [3, 4, 5, 6]]
@@ -0,0 +1,25 @@
+"""Páginas repetidas a partir de las huellas (duplicates.find_duplicates)."""
+import fitz  # PyMuPDF
+
+from duplicates import page_fingerprints, find_duplicates
+
+
+def make_doc(lines):
+    """PDF con una página por elemento: una línea de texto, o en blanco si es None."""
+    doc = fitz.open()
+    for line in lines:
+        page = doc.new_page()
+        if line is not None:
+            page.insert_text((72, 72), line, fontsize=11)
+    return doc
+
+
+def test_repeated_sparse_text_pages_are_duplicates():
+    doc = make_doc(['Separador', 'Factura 1', 'Separador', 'Factura 2'])
+    pages = page_fingerprints(doc, 1, len(doc))
+    assert find_duplicates(pages) == [{'page': 3, 'duplicate_of': 1, 'match': 'exact'}]
+
+
+def test_blank_pages_are_not_duplicates():
+    doc = make_doc([None, 'Factura 1', None, 'Factura 2'])
+    assert find_duplicates(page_fingerprints(doc, 1, len(doc))) == []
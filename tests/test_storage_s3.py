@@ -0,0 +1,159 @@
+"""Sincronización de sesiones con S3 (S3Store) contra un bucket simulado con moto.
+
+Correr con: pip install boto3 moto pytest && python -m pytest tests
+"""
+import os
+
+import pytest
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+import storage
+from storage import S3Store
+
+BUCKET = 'pdfsorter-test'
+SESSION = 'abc123'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def replica(s3, tmp_path, name):
+    """Un nodo: su propia carpeta local y su propio S3Store sobre el mismo bucket."""
+    folder = tmp_path / name / SESSION
+    folder.mkdir(parents=True)
+    return S3Store(bucket=BUCKET, prefix='sessions/', client=s3), str(folder)
+
+
+def write(folder, relpath, data):
+    path = os.path.join(folder, *relpath.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(folder, relpath):
+    with open(os.path.join(folder, *relpath.split('/')), 'rb') as f:
+        return f.read()
+
+
+def remote_keys(s3):
+    response = s3.list_objects_v2(Bucket=BUCKET, Prefix=f'sessions/{SESSION}/')
+    return sorted(obj['Key'][len(f'sessions/{SESSION}/'):] for obj in response.get('Contents', []))
+
+
+def test_push_pull_syncs_pdfs_and_defined_sidecars(s3, tmp_path):
+    a, folder_a = replica(s3, tmp_path, 'a')
+    b, folder_b = replica(s3, tmp_path, 'b')
+
+    write(folder_a, 'doc.pdf', b'%PDF doc')
+    write(folder_a, 'doc-sorted/A.pdf', b'%PDF A')
+    write(folder_a, 'doc-sorted/.manifest.json', b'{}')
+    write(folder_a, 'doc-sorted/.A.pdf.incr.json', b'{"updates": 1}')
+    write(folder_a, 'doc-sorted/.A.pdf.journal', b'{"size": 3}')
+    write(folder_a, 'doc-sorted/.doc-sorted.lock', b'')
+    write(folder_a, '.render-cache/x.png', b'png')
+    a.push(SESSION, folder_a)
+
+    assert remote_keys(s3) == ['doc-sorted/.A.pdf.incr.json', 'doc-sorted/.manifest.json',
+                               'doc-sorted/A.pdf', 'doc.pdf']
+
+    b.pull(SESSION, folder_b, force=True)
+    assert read(folder_b, 'doc.pdf') == b'%PDF doc'
+    assert read(folder_b, 'doc-sorted/A.pdf') == b'%PDF A'
+    assert read(folder_b, 'doc-sorted/.A.pdf.incr.json') == b'{"updates": 1}'
+    assert not os.path.exists(os.path.join(folder_b, 'doc-sorted', '.A.pdf.journal'))
+    assert not os.path.exists(os.path.join(folder_b, '.render-cache'))
+    assert a.stats()['uploaded'] == 4 and b.stats()['downloaded'] == 4
+
+
+def test_delete_propagates_to_other_replica(s3, tmp_path):
+    a, folder_a = replica(s3, tmp_path, 'a')
+    b, folder_b = replica(s3, tmp_path, 'b')
+    write(folder_a, 'doc.pdf', b'%PDF doc')
+    a.push(SESSION, folder_a)
+    b.pull(SESSION, folder_b, force=True)
+
+    os.remove(os.path.join(folder_a, 'doc.pdf'))
+    a.push(SESSION, folder_a, 'doc.pdf')
+    assert remote_keys(s3) == []
+
+    b.pull(SESSION, folder_b, force=True)
+    assert not os.path.exists(os.path.join(folder_b, 'doc.pdf'))
+
+
+def test_concurrent_update_keeps_the_first_write(s3, tmp_path):
+    a, folder_a = replica(s3, tmp_path, 'a')
+    b, folder_b = replica(s3, tmp_path, 'b')
+    write(folder_a, 'doc.pdf', b'%PDF v1')
+    a.push(SESSION, folder_a)
+    b.pull(SESSION, folder_b, force=True)
+
+    # Las dos réplicas modifican el mismo archivo partiendo de v1
+    write(folder_a, 'doc.pdf', b'%PDF v2 from a')
+    write(folder_b, 'doc.pdf', b'%PDF v2 from replica b')
+    a.push(SESSION, folder_a)
+    b.push(SESSION, folder_b)
+
+    body = s3.get_object(Bucket=BUCKET, Key=f'sessions/{SESSION}/doc.pdf')['Body'].read()
+    assert body == b'%PDF v2 from a'
+    assert read(folder_b, 'doc.pdf') == b'%PDF v2 from a'
+    assert b.stats()['conflicts'] == 1
+
+    # Ya resuelto: la próxima escritura de b se sube normalmente
+    write(folder_b, 'doc.pdf', b'%PDF v3 from b')
+    b.push(SESSION, folder_b)
+    body = s3.get_object(Bucket=BUCKET, Key=f'sessions/{SESSION}/doc.pdf')['Body'].read()
+    assert body == b'%PDF v3 from b'
+
+
+def test_concurrent_create_keeps_the_first_write(s3, tmp_path):
+    a, folder_a = replica(s3, tmp_path, 'a')
+    b, folder_b = replica(s3, tmp_path, 'b')
+    write(folder_a, 'new.pdf', b'%PDF a')
+    write(folder_b, 'new.pdf', b'%PDF from b')
+    a.push(SESSION, folder_a)
+    b.push(SESSION, folder_b)
+
+    assert read(folder_b, 'new.pdf') == b'%PDF a'
+    assert b.stats()['conflicts'] == 1
+
+
+def test_delete_does_not_remove_a_newer_remote_version(s3, tmp_path):
+    a, folder_a = replica(s3, tmp_path, 'a')
+    b, folder_b = replica(s3, tmp_path, 'b')
+    write(folder_a, 'doc.pdf', b'%PDF v1')
+    a.push(SESSION, folder_a)
+    b.pull(SESSION, folder_b, force=True)
+
+    write(folder_a, 'doc.pdf', b'%PDF v2 from a')
+    a.push(SESSION, folder_a)
+    os.remove(os.path.join(folder_b, 'doc.pdf'))
+    b.push(SESSION, folder_b, 'doc.pdf')
+
+    assert remote_keys(s3) == ['doc.pdf']
+    assert read(folder_b, 'doc.pdf') == b'%PDF v2 from a'
+    assert b.stats()['conflicts'] == 1
+
+
+def test_unconditional_mode_overwrites(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'S3_CONDITIONAL_WRITES', False)
+    a, folder_a = replica(s3, tmp_path, 'a')
+    b, folder_b = replica(s3, tmp_path, 'b')
+    write(folder_a, 'doc.pdf', b'%PDF a')
+    write(folder_b, 'doc.pdf', b'%PDF from b')
+    a.push(SESSION, folder_a)
+    b.push(SESSION, folder_b)
+
+    body = s3.get_object(Bucket=BUCKET, Key=f'sessions/{SESSION}/doc.pdf')['Body'].read()
+    assert body == b'%PDF from b'
+    assert b.stats()['conflicts'] == 0
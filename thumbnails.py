@@ -0,0 +1,123 @@
+"""Miniaturas de páginas y hojas de miniaturas (sprites).
+
+MuPDF rasteriza cada página directamente al ancho pedido (sin renderizar a
+tamaño completo y reducir después). Las hojas juntan un rango de páginas en
+una sola imagen en grilla, con un mapa JSON de la posición de cada página,
+para que el panel de miniaturas del sorter haga una petición por bloque en
+lugar de una por página.
+
+Estas funciones corren dentro de los procesos de `render_pool`, así que solo
+dependen de PyMuPDF (y de Pillow, opcional, para WebP).
+"""
+import os
+import io
+
+import fitz  # PyMuPDF
+
+import metrics
+
+try:
+    from PIL import Image  # Opcional: solo para generar WebP
+except ImportError:
+    Image = None
+
+# Ancho por defecto, mínimo y máximo de una miniatura (en píxeles)
+THUMB_DEFAULT_WIDTH = 160
+THUMB_MIN_WIDTH = 40
+THUMB_MAX_WIDTH = 600
+
+# Los anchos se redondean a múltiplos de este paso (menos variantes en caché)
+THUMB_WIDTH_STEP = 20
+
+# Calidad de compresión de las miniaturas (JPEG/WebP)
+THUMB_QUALITY = int(os.environ.get('THUMB_QUALITY', '70'))
+
+# Máximo de páginas por hoja y columnas de la grilla
+THUMB_SHEET_MAX_PAGES = 50
+THUMB_SHEET_COLUMNS = 5
+
+# Tamaño del bloque de páginas que pide el sorter por hoja
+THUMB_SHEET_BLOCK = 25
+
+WEBP_AVAILABLE = Image is not None
+
+MIMETYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+
+def normalize_width(width):
+    """Ajusta un ancho pedido al rango permitido y al paso de redondeo."""
+    if width is None:
+        width = THUMB_DEFAULT_WIDTH
+    width = max(THUMB_MIN_WIDTH, min(THUMB_MAX_WIDTH, width))
+    return -(-width // THUMB_WIDTH_STEP) * THUMB_WIDTH_STEP
+
+
+def choose_format(accept_mimetypes):
+    """WebP si el navegador lo pide explícitamente y Pillow está instalado; si no, JPEG."""
+    # `*/*` no cuenta: solo los navegadores que listan image/webp lo muestran seguro
+    if WEBP_AVAILABLE and any(m == 'image/webp' and q > 0 for m, q in accept_mimetypes):
+        return 'webp'
+    return 'jpeg'
+
+
+def encode(pix, fmt):
+    """Codifica un pixmap RGB como JPEG o WebP."""
+    if fmt == 'webp':
+        img = Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+        buf = io.BytesIO()
+        img.save(buf, 'WEBP', quality=THUMB_QUALITY)
+        return buf.getvalue()
+    return pix.tobytes('jpeg', jpg_quality=THUMB_QUALITY)
+
+
+def _rasterize(page, width):
+    """Rasteriza una página al ancho pedido (la resolución sale del ancho)."""
+    zoom = width / page.rect.width
+    with metrics.span('get_pixmap'):
+        return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+
+
+def render_thumbnail(doc, page_num, width, fmt):
+    """Miniatura de una página, o None si la página no existe."""
+    if page_num < 1 or page_num > len(doc):
+        return None
+    pix = _rasterize(doc[page_num - 1], width)
+    with metrics.span(f'encode_{fmt}'):
+        return encode(pix, fmt)
+
+
+def render_sheet(doc, first, last, width, fmt):
+    """Hoja con las miniaturas de las páginas first..last en una grilla.
+
+    Devuelve (bytes de la imagen, layout) donde layout es
+    {'width', 'height', 'tiles': {página: [x, y, ancho, alto]}}, o None si el
+    rango no tiene páginas.
+    """
+    last = min(last, len(doc))
+    if first < 1 or first > last:
+        return None
+
+    pixmaps = [(page_num, _rasterize(doc[page_num - 1], width))
+               for page_num in range(first, last + 1)]
+    cell_width = max(pix.width for _, pix in pixmaps)
+
+    # Cada fila mide lo que su página más alta
+    tiles = {}
+    y = 0
+    for row_start in range(0, len(pixmaps), THUMB_SHEET_COLUMNS):
+        row = pixmaps[row_start:row_start + THUMB_SHEET_COLUMNS]
+        for col, (page_num, pix) in enumerate(row):
+            tiles[page_num] = [col * cell_width, y, pix.width, pix.height]
+        y += max(pix.height for _, pix in row)
+
+    columns = min(THUMB_SHEET_COLUMNS, len(pixmaps))
+    sheet = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, columns * cell_width, y), False)
+    sheet.clear_with(255)
+    for page_num, pix in pixmaps:
+        x, tile_y, _, _ = tiles[page_num]
+        pix.set_origin(x, tile_y)
+        sheet.copy(pix, pix.irect)
+
+    layout = {'width': sheet.width, 'height': sheet.height, 'tiles': tiles}
+    with metrics.span(f'encode_{fmt}'):
+        return encode(sheet, fmt), layout
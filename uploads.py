@@ -0,0 +1,205 @@
+"""Subidas reanudables por partes.
+
+Protocolo (al estilo tus):
+  POST   /uploads            {"filename": ..., "size": ...}  -> crea la subida
+  HEAD   /uploads/<id>       -> cabecera Upload-Offset con los bytes ya recibidos
+  PATCH  /uploads/<id>       cabecera Upload-Offset + bytes de la parte
+  DELETE /uploads/<id>       -> cancela la subida
+
+Cada parte se escribe directo al archivo `.part` dentro de la sesión a medida
+que llega, sin juntarla en memoria. El offset es siempre el tamaño real del
+`.part`, así que si la conexión se corta a mitad de una parte, el cliente
+pregunta el offset y sigue desde ahí. Al completar se valida el PDF con
+PyMuPDF y se mueve a la carpeta del usuario.
+"""
+import os
+import json
+import time
+import uuid
+import threading
+
+import fitz  # PyMuPDF
+
+import metrics
+from storage import file_lock, remove_lock
+
+# Carpeta (dentro de la sesión) con las subidas en curso
+UPLOADS_DIRNAME = '.uploads'
+
+# Tamaño máximo de un archivo subido por partes
+UPLOAD_MAX_SIZE = int(os.environ.get('UPLOAD_MAX_SIZE', str(2 * 1024 * 1024 * 1024)))  # 2GB
+
+# Tamaño de parte sugerido al cliente
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024)))  # 8MB
+
+# Las subidas sin actividad durante este tiempo se descartan
+UPLOAD_EXPIRY = 24 * 60 * 60  # 1 día en segundos
+
+# Tamaño de los bloques al copiar del request al disco
+STREAM_BLOCK_SIZE = 1024 * 1024
+
+_locks_lock = threading.Lock()
+_locks = {}  # id de subida -> Lock
+
+
+class UploadError(Exception):
+    """Error de una subida por partes."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _upload_lock(upload_id):
+    with _locks_lock:
+        lock = _locks.get(upload_id)
+        if lock is None:
+            lock = _locks[upload_id] = threading.Lock()
+        return lock
+
+
+def _paths(user_folder, upload_id):
+    # El id se usa en rutas de archivo: solo se aceptan ids generados por nosotros
+    try:
+        upload_id = uuid.UUID(upload_id).hex
+    except (ValueError, TypeError, AttributeError):
+        raise UploadError('Subida no encontrada', 404)
+    folder = os.path.join(user_folder, UPLOADS_DIRNAME)
+    return os.path.join(folder, f"{upload_id}.json"), os.path.join(folder, f"{upload_id}.part")
+
+
+def create_upload(user_folder, filename, size):
+    """Registra una subida nueva y devuelve su id."""
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        raise UploadError('Tamaño de archivo inválido')
+    if size > UPLOAD_MAX_SIZE:
+        raise UploadError(f'El archivo supera el máximo de {UPLOAD_MAX_SIZE // (1024 * 1024)}MB', 413)
+
+    upload_id = uuid.uuid4().hex
+    meta_path, part_path = _paths(user_folder, upload_id)
+    os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+
+    open(part_path, 'wb').close()
+    with open(meta_path, 'w') as f:
+        json.dump({'filename': filename, 'size': size, 'created_at': time.time()}, f)
+    return upload_id
+
+
+def get_upload(user_folder, upload_id):
+    """Devuelve (metadatos, offset actual) de una subida."""
+    meta_path, part_path = _paths(user_folder, upload_id)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        offset = os.path.getsize(part_path)
+    except (OSError, ValueError):
+        raise UploadError('Subida no encontrada', 404)
+    return meta, offset
+
+
+def write_chunk(user_folder, upload_id, offset, stream):
+    """Escribe en disco una parte leída de `stream` a partir de `offset`.
+
+    Devuelve el nuevo offset. Lo recibido antes de un corte queda guardado.
+    """
+    lock = _upload_lock(upload_id)
+    if not lock.acquire(blocking=False):
+        raise UploadError('Ya se está recibiendo una parte de esta subida', 409)
+
+    _, part_path = _paths(user_folder, upload_id)
+    try:
+        # Otro worker podría estar recibiendo una parte de la misma subida
+        with file_lock(part_path, blocking=False):
+            return _write_chunk(user_folder, upload_id, offset, stream)
+    except BlockingIOError:
+        raise UploadError('Ya se está recibiendo una parte de esta subida', 409)
+    finally:
+        lock.release()
+
+
+def _write_chunk(user_folder, upload_id, offset, stream):
+    meta, current = get_upload(user_folder, upload_id)
+    if offset != current:
+        raise UploadError(f'Offset incorrecto: se esperaba {current}', 409)
+
+    _, part_path = _paths(user_folder, upload_id)
+    with open(part_path, 'r+b') as f:
+        f.seek(offset)
+        while True:
+            block = stream.read(STREAM_BLOCK_SIZE)
+            if not block:
+                break
+            if current + len(block) > meta['size']:
+                raise UploadError('Se recibieron más bytes que el tamaño declarado')
+            f.write(block)
+            current += len(block)
+            metrics.inc('pdfsorter_bytes_written_total', len(block), kind='upload')
+    return current
+
+
+def finish_upload(user_folder, upload_id, final_path):
+    """Valida el PDF completo y lo mueve a `final_path`. Devuelve la cantidad de páginas."""
+    meta_path, part_path = _paths(user_folder, upload_id)
+    try:
+        page_count = validate_pdf(part_path)
+    except UploadError:
+        discard_upload(user_folder, upload_id)
+        raise
+
+    os.replace(part_path, final_path)
+    os.remove(meta_path)
+    remove_lock(part_path)
+    with _locks_lock:
+        _locks.pop(upload_id, None)
+    return page_count
+
+
+def discard_upload(user_folder, upload_id):
+    """Borra una subida en curso."""
+    meta_path, part_path = _paths(user_folder, upload_id)
+    for path in (meta_path, part_path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    remove_lock(part_path)
+    with _locks_lock:
+        _locks.pop(upload_id, None)
+
+
+def validate_pdf(path):
+    """Verifica que el archivo sea un PDF legible y devuelve su cantidad de páginas."""
+    try:
+        doc = fitz.open(path, filetype='pdf')
+    except Exception:
+        raise UploadError('El archivo no es un PDF válido')
+    try:
+        if not doc.is_pdf or doc.needs_pass:
+            raise UploadError('El archivo no es un PDF válido o está protegido con contraseña')
+        page_count = len(doc)
+        if page_count == 0:
+            raise UploadError('El PDF no tiene páginas')
+        return page_count
+    finally:
+        doc.close()
+
+
+def cleanup_stale_uploads(user_folder, max_age=UPLOAD_EXPIRY):
+    """Descarta las subidas sin actividad reciente de una sesión."""
+    folder = os.path.join(user_folder, UPLOADS_DIRNAME)
+    if not os.path.isdir(folder):
+        return
+    now = time.time()
+    for f in os.listdir(folder):
+        if not f.endswith('.json'):
+            continue
+        upload_id = f[:-len('.json')]
+        try:
+            meta_path, part_path = _paths(user_folder, upload_id)
+            # La actividad se mide por la última parte recibida
+            activity_path = part_path if os.path.exists(part_path) else meta_path
+            if now - os.path.getmtime(activity_path) > max_age:
+                discard_upload(user_folder, upload_id)
+        except (OSError, UploadError):
+            pass
@@ -0,0 +1,281 @@
+"""ZIP generado al vuelo (sin archivos temporales) para las descargas.
+
+Los PDFs ya vienen comprimidos, así que se guardan sin compresión (ZIP_STORED).
+Con eso la estructura del ZIP depende solo de los nombres y tamaños de los
+archivos: se conoce el tamaño total antes de enviar el primer byte
+(Content-Length) y se puede servir cualquier rango de bytes (descargas
+reanudables con Range / If-Range).
+
+El CRC-32 de cada archivo va en un "data descriptor" después de sus datos y en
+el directorio central al final, así que se calcula mientras se envían los
+datos; solo si un rango salta datos de un archivo se lee ese archivo aparte.
+Cada archivo se abre recién al enviar sus datos (no hay un descriptor abierto
+por archivo durante toda la descarga); si cambió desde que se armó el plan,
+la descarga se corta en vez de mezclar versiones.
+"""
+import os
+import time
+import zlib
+import struct
+import hashlib
+import zipfile
+import threading
+import unicodedata
+from collections import OrderedDict
+from urllib.parse import quote
+
+import metrics
+
+# Tamaño de los bloques que se envían al cliente
+ZIP_CHUNK_SIZE = 256 * 1024
+
+# Límites del formato ZIP clásico (sin ZIP64)
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP32_MAX_ENTRIES = 0xFFFF
+
+_FLAG_DATA_DESCRIPTOR = 0x0008
+_FLAG_UTF8 = 0x0800
+
+# Máximo de CRCs de archivos que se recuerdan en memoria
+ZIP_CRC_MEMO_SIZE = 4096
+
+_crc_lock = threading.Lock()
+_crc_memo = OrderedDict()  # (inode, tamaño, mtime_ns) -> crc
+
+
+def _dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class _Entry:
+    """Un archivo dentro del ZIP; se abre recién cuando se envían sus datos."""
+
+    def __init__(self, arcname, path):
+        self.arcname = arcname
+        self.path = path
+        self.name_bytes = arcname.replace(os.sep, '/').encode('utf-8')
+        self.flags = _FLAG_DATA_DESCRIPTOR
+        if not arcname.isascii():
+            self.flags |= _FLAG_UTF8
+        st = os.stat(path)
+        self.size = st.st_size
+        self.stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self.dos_time, self.dos_date = _dos_datetime(st.st_mtime)
+        self.offset = 0
+        with _crc_lock:
+            self.crc = _crc_memo.get(self.stamp)
+            if self.crc is not None:
+                _crc_memo.move_to_end(self.stamp)
+
+    def open(self):
+        """Abre el archivo, verificando que sea la versión con la que se armó el plan."""
+        f = open(self.path, 'rb')
+        st = os.fstat(f.fileno())
+        if (st.st_ino, st.st_size, st.st_mtime_ns) != self.stamp:
+            f.close()
+            raise IOError(f"{self.arcname} cambió durante la descarga")
+        return f
+
+    def local_header(self):
+        return struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 20, self.flags, zipfile.ZIP_STORED,
+            self.dos_time, self.dos_date, 0, 0, 0, len(self.name_bytes), 0
+        ) + self.name_bytes
+
+    def data_descriptor(self):
+        return struct.pack('<IIII', 0x08074b50, self.get_crc(), self.size, self.size)
+
+    def central_header(self):
+        return struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 20, 20, self.flags,
+            zipfile.ZIP_STORED, self.dos_time, self.dos_date, self.get_crc(),
+            self.size, self.size, len(self.name_bytes), 0, 0, 0, 0,
+            (0o100644 << 16), self.offset
+        ) + self.name_bytes
+
+    def set_crc(self, crc):
+        self.crc = crc
+        with _crc_lock:
+            _crc_memo[self.stamp] = crc
+            _crc_memo.move_to_end(self.stamp)
+            while len(_crc_memo) > ZIP_CRC_MEMO_SIZE:
+                _crc_memo.popitem(last=False)
+
+    def get_crc(self):
+        """CRC-32 del archivo (se lee completo solo si no se calculó al enviarlo)."""
+        if self.crc is None:
+            crc = 0
+            with self.open() as f:
+                for chunk in iter(lambda: f.read(ZIP_CHUNK_SIZE), b''):
+                    crc = zlib.crc32(chunk, crc)
+            self.set_crc(crc)
+        return self.crc
+
+    def read_range(self, start, end):
+        """Bytes [start, end) del archivo, calculando el CRC si se lee entero."""
+        crc = 0 if (start == 0 and end == self.size and self.crc is None) else None
+        with self.open() as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(ZIP_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError(f"{self.arcname} cambió de tamaño durante la descarga")
+                remaining -= len(chunk)
+                if crc is not None:
+                    crc = zlib.crc32(chunk, crc)
+                yield chunk
+        if crc is not None:
+            self.set_crc(crc)
+
+
+class ZipStream:
+    """Plan de un ZIP sin compresión: segmentos de bytes fijos, datos de archivo y CRCs."""
+
+    def __init__(self, files):
+        """files: lista de (nombre dentro del ZIP, ruta en disco)."""
+        self.entries = [_Entry(arcname, path) for arcname, path in files]
+
+        # Segmentos: (largo, generador(desde, hasta))
+        self.segments = []
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            header = entry.local_header()
+            self._add_bytes(lambda h=header: h, len(header))
+            self.segments.append((entry.size, entry.read_range))
+            self._add_bytes(entry.data_descriptor, 16)
+            offset += len(header) + entry.size + 16
+
+        central_size = 0
+        for entry in self.entries:
+            length = 46 + len(entry.name_bytes)
+            self._add_bytes(entry.central_header, length)
+            central_size += length
+
+        end_record = struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, len(self.entries), len(self.entries),
+            central_size, offset, 0
+        )
+        self._add_bytes(lambda: end_record, len(end_record))
+        self.size = offset + central_size + len(end_record)
+
+    def _add_bytes(self, produce, length):
+        def read(start, end):
+            yield produce()[start:end]
+        self.segments.append((length, read))
+
+    @property
+    def fits_zip32(self):
+        """Indica si el ZIP entra en el formato clásico (sin ZIP64)."""
+        return (len(self.entries) < ZIP32_MAX_ENTRIES and self.size < ZIP32_LIMIT
+                and all(e.size < ZIP32_LIMIT for e in self.entries))
+
+    @property
+    def etag(self):
+        """Identifica esta versión del ZIP (para If-Range al reanudar)."""
+        digest = hashlib.sha1()
+        for entry in self.entries:
+            digest.update(entry.name_bytes)
+            digest.update(repr(entry.stamp).encode())
+        return digest.hexdigest()
+
+    def iter_range(self, start=0, end=None):
+        """Genera los bytes [start, end) del ZIP."""
+        end = self.size if end is None else end
+        position = 0
+        for length, read in self.segments:
+            seg_start, seg_end = position, position + length
+            position = seg_end
+            if seg_end <= start:
+                continue
+            if seg_start >= end:
+                break
+            yield from read(max(start, seg_start) - seg_start, min(end, seg_end) - seg_start)
+
+
+class _StreamSink:
+    """Destino de solo escritura para zipfile: acumula lo escrito para ir enviándolo."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def iter_zip64(files):
+    """Genera un ZIP (con ZIP64) al vuelo cuando no entra en el formato clásico.
+
+    No se conoce el tamaño de antemano, así que no admite rangos.
+    """
+    sink = _StreamSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as zipf:
+        for arcname, path in files:
+            zinfo = zipfile.ZipInfo.from_file(path, arcname)
+            zinfo.compress_type = zipfile.ZIP_STORED
+            with open(path, 'rb') as src, zipf.open(zinfo, 'w', force_zip64=True) as dest:
+                for chunk in iter(lambda: src.read(ZIP_CHUNK_SIZE), b''):
+                    dest.write(chunk)
+                    yield from sink.pop()
+            yield from sink.pop()
+    yield from sink.pop()
+
+
+def _content_disposition(download_name):
+    """Cabecera Content-Disposition con nombre ASCII y, si hace falta, filename* UTF-8."""
+    simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+    simple = simple.replace('"', '')
+    value = f'attachment; filename="{simple}"'
+    if simple != download_name:
+        value += f"; filename*=UTF-8''{quote(download_name, safe='')}"
+    return {'Content-Disposition': value}
+
+
+def zip_response(files, download_name, request, response_class):
+    """Respuesta HTTP con el ZIP de `files`, con Content-Length y soporte de Range."""
+    archive = ZipStream(files)
+    disposition = _content_disposition(download_name)
+
+    if not archive.fits_zip32:
+        response = response_class(metrics.timed(iter_zip64(files), 'zip_write'),
+                                  mimetype='application/zip', headers=disposition)
+        return response
+
+    etag = archive.etag
+    start, end, status = 0, archive.size, 200
+
+    # Reanudar: solo si el ZIP no cambió desde la descarga anterior (If-Range)
+    if_range = request.if_range
+    unchanged = (if_range.etag is None and if_range.date is None) or if_range.etag == etag
+    if request.range is not None and unchanged:
+        byte_range = request.range.range_for_length(archive.size)
+        if byte_range is None:
+            response = response_class(status=416)
+            response.headers['Content-Range'] = f'bytes */{archive.size}'
+            return response
+        start, end = byte_range
+        status = 206
+
+    response = response_class(metrics.timed(archive.iter_range(start, end), 'zip_write'),
+                              status=status, mimetype='application/zip',
+                              headers=disposition, direct_passthrough=True)
+    response.content_length = end - start
+    response.accept_ranges = 'bytes'
+    response.set_etag(etag)
+    if status == 206:
+        response.headers['Content-Range'] = f'bytes {start}-{end - 1}/{archive.size}'
+    return response